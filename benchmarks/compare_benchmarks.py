@@ -0,0 +1,49 @@
+from argparse import ArgumentParser
+import json
+import sys
+
+# Compares two benchmark result files from run_benchmarks.py, e.g. from two commits.
+# Exits with status 1 if any stage got slower (or used more memory) than the threshold.
+
+METRICS = ["wall_seconds", "cpu_seconds", "peak_rss_mb"]
+
+def compare(old_results, new_results, threshold):
+    """
+    Returns a list of (stage, metric, old value, new value, ratio, is_regression) for every
+    metric of every stage in both results.
+    """
+    comparisons = list()
+    for stage, new_stage in new_results["stages"].items():
+        old_stage = old_results["stages"].get(stage)
+        if old_stage is None:
+            continue
+        for metric in METRICS:
+            old_value, new_value = old_stage[metric], new_stage[metric]
+            ratio = new_value / old_value if old_value else float("inf") if new_value else 1.0
+            comparisons.append((stage, metric, old_value, new_value, ratio, ratio > 1 + threshold))
+    return comparisons
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('old', type=str, help='Benchmark results of the baseline commit.')
+    parser.add_argument('new', type=str, help='Benchmark results of the commit being tested.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative increase of a metric that counts as a regression.')
+    options = parser.parse_args()
+
+    with open(options.old) as inf:
+        old_results = json.load(inf)
+    with open(options.new) as inf:
+        new_results = json.load(inf)
+    if old_results.get("parameters") != new_results.get("parameters"):
+        print("WARNING: the benchmarks were run with different parameters.")
+
+    regressions = int()
+    for stage, metric, old_value, new_value, ratio, is_regression in compare(old_results, new_results, options.threshold):
+        print("%-14s %-13s %12.3f %12.3f %7.2fx%s" % (stage, metric, old_value, new_value, ratio, "  REGRESSION" if is_regression else ""))
+        regressions += is_regression
+
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
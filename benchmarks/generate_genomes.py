@@ -0,0 +1,122 @@
+from argparse import ArgumentParser
+import os
+import random
+
+# Generates a synthetic reference and N mutated assemblies of it, plus a seqFile, for
+# benchmarking the aligner.
+
+COMPLEMENT = str.maketrans("ACGT", "TGCA")
+
+def random_sequence(rng, length):
+    return "".join(rng.choices("ACGT", k=length))
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+def mutate(rng, seq, snp_rate, indel_rate, max_indel_length, inversions, inversion_length):
+    """
+    Returns a copy of seq with SNPs and indels at the given per-base rates, after
+    reverse-complementing inversions randomly placed segments of inversion_length.
+    """
+    seq = list(seq)
+    for i in range(inversions):
+        if len(seq) <= inversion_length:
+            break
+        start = rng.randrange(len(seq) - inversion_length)
+        seq[start:start + inversion_length] = reverse_complement("".join(seq[start:start + inversion_length]))
+
+    event_rate = snp_rate + indel_rate
+    if event_rate <= 0:
+        return "".join(seq)
+
+    pieces = list()
+    prev = 0
+    pos = int(rng.expovariate(event_rate))
+    while pos < len(seq):
+        pieces.append("".join(seq[prev:pos]))
+        if rng.random() < snp_rate / event_rate:
+            pieces.append(rng.choice("ACGT".replace(seq[pos], "")))
+            prev = pos + 1
+        elif rng.random() < 0.5:
+            # insertion
+            pieces.append(random_sequence(rng, rng.randint(1, max_indel_length)) + seq[pos])
+            prev = pos + 1
+        else:
+            # deletion
+            prev = pos + rng.randint(1, max_indel_length)
+        pos = max(prev, pos + 1) + int(rng.expovariate(event_rate))
+    pieces.append("".join(seq[prev:]))
+    return "".join(pieces)
+
+def write_fasta(path, contigs, line_length=60):
+    with open(path, "w") as outf:
+        for contig_id, seq in contigs:
+            outf.write(">" + contig_id + "\n")
+            for i in range(0, len(seq), line_length):
+                outf.write(seq[i:i + line_length] + "\n")
+
+def generate_genomes(out_dir, assemblies=3, contigs=2, contig_length=100000, snp_rate=0.005, indel_rate=0.0005,
+                     max_indel_length=20, inversions=1, inversion_length=5000, novel_length=10000, duplicate_ids=True, seed=0):
+    """
+    Writes ref.fa, asm_1.fa ... asm_N.fa and seqFile to out_dir. Each assembly is a
+    mutated copy of every reference contig, plus a random novel contig of novel_length
+    (shared by half of the assemblies, so that there are poorly mapped segments with
+    homology between assemblies). If duplicate_ids, assemblies reuse the reference contig
+    ids, so that contig id deduplication has work to do.
+
+    Returns the path of the seqFile.
+    """
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    reference = [("ref_contig_" + str(i), random_sequence(rng, contig_length)) for i in range(contigs)]
+    write_fasta(os.path.join(out_dir, "ref.fa"), reference)
+    shared_novel = random_sequence(rng, novel_length)
+
+    asm_files = {"ref": os.path.join(out_dir, "ref.fa")}
+    for asm in range(1, assemblies + 1):
+        asm_contigs = list()
+        for contig_id, seq in reference:
+            if not duplicate_ids:
+                contig_id = "asm_" + str(asm) + "_" + contig_id
+            asm_contigs.append((contig_id, mutate(rng, seq, snp_rate, indel_rate, max_indel_length, inversions, inversion_length)))
+        if novel_length:
+            novel = shared_novel if asm % 2 else random_sequence(rng, novel_length)
+            asm_contigs.append(("asm_" + str(asm) + "_novel", mutate(rng, novel, snp_rate, indel_rate, max_indel_length, 0, 0)))
+        asm_files["asm_" + str(asm)] = os.path.join(out_dir, "asm_" + str(asm) + ".fa")
+        write_fasta(asm_files["asm_" + str(asm)], asm_contigs)
+
+    seqfile = os.path.join(out_dir, "seqFile")
+    with open(seqfile, "w") as outf:
+        outf.write("(" + ",".join(asm_files) + ");\n")
+        for asm, asm_file in asm_files.items():
+            outf.write(asm + " " + os.path.abspath(asm_file) + "\n")
+    return seqfile
+
+def add_generator_options(parser):
+    parser.add_argument('--assemblies', type=int, default=3, help='Number of non-reference assemblies.')
+    parser.add_argument('--contigs', type=int, default=2, help='Number of reference contigs.')
+    parser.add_argument('--contig_length', type=int, default=100000, help='Length of each reference contig.')
+    parser.add_argument('--snp_rate', type=float, default=0.005, help='Per-base SNP rate of the assemblies.')
+    parser.add_argument('--indel_rate', type=float, default=0.0005, help='Per-base indel rate of the assemblies.')
+    parser.add_argument('--max_indel_length', type=int, default=20, help='Maximum length of each indel.')
+    parser.add_argument('--inversions', type=int, default=1, help='Number of inversions per assembly contig.')
+    parser.add_argument('--inversion_length', type=int, default=5000, help='Length of each inversion.')
+    parser.add_argument('--novel_length', type=int, default=10000, help='Length of the non-reference contig in each assembly.')
+    parser.add_argument('--unique_ids', action='store_true', help="Don't reuse the reference contig ids in the assemblies.")
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+
+def generate_genomes_from_options(out_dir, options):
+    return generate_genomes(out_dir, options.assemblies, options.contigs, options.contig_length, options.snp_rate,
+                            options.indel_rate, options.max_indel_length, options.inversions, options.inversion_length,
+                            options.novel_length, not options.unique_ids, options.seed)
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('out_dir', type=str, help='Directory to write the reference, assemblies and seqFile to.')
+    add_generator_options(parser)
+    options = parser.parse_args()
+    print(generate_genomes_from_options(options.out_dir, options))
+
+if __name__ == "__main__":
+    main()
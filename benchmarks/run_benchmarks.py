@@ -0,0 +1,225 @@
+from argparse import ArgumentParser
+import datetime
+import importlib.util
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# insert at 1, 0 is the script path (or '' in REPL)
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(1, REPO_DIR)
+sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+
+from src import compression
+from src import fasta_preprocessing
+from src import paf_to_lastz
+import generate_genomes
+
+# Benchmarks each stage of the aligner on its own, then the whole toil workflow on the
+# local single_machine batch system, on synthetic genomes from generate_genomes.py. Each
+# stage runs in its own process, so that its peak RSS (including subprocesses like
+# minimap2) can be measured in isolation. Results are written as JSON, for comparison
+# between commits with compare_benchmarks.py.
+
+ALIGNER_SCRIPT = os.path.join(REPO_DIR, "reference-based-cactus-aligner.py")
+STAGES = ["dedup", "import", "mapping", "conversion", "consolidation", "workflow"]
+# the stages whose outputs each stage reads.
+STAGE_PREREQUISITES = {"conversion": ["mapping"], "consolidation": ["conversion"]}
+# seconds between checks that a stage's process is still running, while waiting for its result.
+POLL_SECONDS = 5
+
+def load_aligner():
+    """
+    The aligner is a script with a dash in its name, so it can't be imported normally.
+    """
+    spec = importlib.util.spec_from_file_location("reference_based_cactus_aligner", ALIGNER_SCRIPT)
+    aligner = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(aligner)
+    return aligner
+
+def run_measured(stage_fn, *args):
+    """
+    Runs stage_fn(*args) in a child process. Returns a dictionary of the wall time, CPU
+    time and peak RSS of the child (and its own subprocesses), plus whatever dictionary
+    stage_fn returned. Raises a RuntimeError if the stage fails, or if its process dies
+    without a result (e.g. killed for running out of memory).
+    """
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    process = context.Process(target=measure_in_child, args=(results, stage_fn, args))
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = results.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            if not process.is_alive():
+                # the result may have been sent just before the process exited.
+                try:
+                    result = results.get(timeout=POLL_SECONDS)
+                except queue.Empty:
+                    break
+    process.join()
+    if result is None:
+        raise RuntimeError(stage_fn.__name__ + " exited with status " + str(process.exitcode) + " without a result")
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    return result
+
+def measure_in_child(queue, stage_fn, args):
+    try:
+        start = time.perf_counter()
+        details = stage_fn(*args) or dict()
+        wall = time.perf_counter() - start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        result = {"wall_seconds": wall,
+                  "cpu_seconds": usage.ru_utime + usage.ru_stime + child_usage.ru_utime + child_usage.ru_stime,
+                  # ru_maxrss is in kilobytes on linux.
+                  "peak_rss_mb": max(usage.ru_maxrss, child_usage.ru_maxrss) / 1024}
+        result.update(details)
+        queue.put(result)
+    except Exception as e:
+        queue.put({"error": repr(e)})
+
+## stages:
+
+def dedup_stage(asms, ref_id, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    new_asms = {asm: os.path.join(out_dir, os.path.basename(asm_file)) for asm, asm_file in asms.items()}
+    deduplicated = fasta_preprocessing.rename_duplicate_contig_ids(asms, ref_id, new_asms)
+    with open(os.path.join(out_dir, "deduplicated.json"), "w") as outf:
+        json.dump(deduplicated, outf)
+    return {"input_bytes": sum(os.path.getsize(asm_file) for asm_file in asms.values())}
+
+def import_stage(asms, job_store):
+    from toil.common import Toil
+    from toil.job import Job
+
+    options = Job.Runner.getDefaultOptions(job_store)
+    options.logLevel = "CRITICAL"
+    options.clean = "always"
+    with Toil(options) as workflow:
+        for asm_file in asms.values():
+            workflow.importFile("file://" + os.path.abspath(asm_file))
+    return {"input_bytes": sum(os.path.getsize(asm_file) for asm_file in asms.values())}
+
+def mapping_stage(asms, ref_id, out_dir):
+    aligner = load_aligner()
+    os.makedirs(out_dir, exist_ok=True)
+    index = os.path.join(out_dir, "ref.mmi")
+    subprocess.run(["minimap2"] + aligner.MINIMAP2_INDEX_ARGS + ["-d", index, asms[ref_id]], check=True, stderr=subprocess.DEVNULL)
+    for asm, asm_file in asms.items():
+        if asm != ref_id:
+            subprocess.run(["minimap2"] + aligner.MINIMAP2_MAP_ARGS + ["-o", os.path.join(out_dir, asm + ".paf"), index, asm_file],
+                           check=True, stderr=subprocess.DEVNULL)
+    return {"paf_bytes": sum(os.path.getsize(os.path.join(out_dir, paf)) for paf in os.listdir(out_dir) if paf.endswith(".paf"))}
+
+def conversion_stage(paf_dir, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    records = int()
+    for paf in sorted(os.listdir(paf_dir)):
+        if paf.endswith(".paf"):
+            paf_to_lastz.split_paf_to_lastz(os.path.join(paf_dir, paf), os.path.join(out_dir, paf + ".primary.cigar"),
+                                            os.path.join(out_dir, paf + ".secondary.cigar"))
+            with open(os.path.join(paf_dir, paf)) as inf:
+                records += sum(1 for line in inf)
+    return {"records": records}
+
+def consolidation_stage(lastz_dir, out_dir):
+    for kind in ("primary", "secondary"):
+        lastz_files = sorted(os.path.join(lastz_dir, lastz) for lastz in os.listdir(lastz_dir) if lastz.endswith("." + kind + ".cigar"))
+        compression.concatenate_files(lastz_files, os.path.join(out_dir, kind + ".cigar"))
+    return {"output_bytes": sum(os.path.getsize(os.path.join(out_dir, kind + ".cigar")) for kind in ("primary", "secondary"))}
+
+def workflow_stage(seqfile, ref_id, work_dir, extra_args):
+    subprocess.run([sys.executable, ALIGNER_SCRIPT, os.path.join(work_dir, "jobstore"), seqfile, ref_id,
+                    "--batchSystem", "single_machine", "--logLevel", "CRITICAL", "--clean", "always",
+                    "--assembly_save_dir", os.path.join(work_dir, "unique_id_assemblies") + "/",
+                    "--primary", os.path.join(work_dir, "primary.cigar"), "--secondary", os.path.join(work_dir, "secondary.cigar")] + extra_args,
+                   check=True, cwd=work_dir)
+    return {"output_bytes": sum(os.path.getsize(os.path.join(work_dir, kind + ".cigar")) for kind in ("primary", "secondary"))}
+
+## main fxn and interface:
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_needed_stages(stages):
+    """
+    Returns the set of stages, including their prerequisites, that must run to benchmark stages.
+    """
+    needed_stages = set()
+    to_add = list(stages)
+    while to_add:
+        stage = to_add.pop()
+        if stage not in needed_stages:
+            needed_stages.add(stage)
+            to_add += STAGE_PREREQUISITES.get(stage, list())
+    return needed_stages
+
+def get_options():
+    parser = ArgumentParser()
+    parser.add_argument('--out', type=str, default="benchmark_results.json", help='JSON file to write the results to.')
+    parser.add_argument('--work_dir', type=str, default="./benchmark_work/",
+                        help='Directory in which each run makes a new scratch directory; only the scratch directory is deleted when the benchmarks finish, unless --keep_work_dir.')
+    parser.add_argument('--keep_work_dir', action='store_true', help="Don't delete the scratch directory at the end.")
+    parser.add_argument('--stages', type=str, nargs='+', default=STAGES, choices=STAGES,
+                        help='Stages to benchmark. The stages whose outputs they read (mapping for conversion, conversion for consolidation) also run, but are only benchmarked if selected.')
+    parser.add_argument('--workflow_args', type=str, default="", help='Extra arguments for the full workflow run, as a single string.')
+    generate_genomes.add_generator_options(parser)
+    return parser.parse_args()
+
+def main():
+    options = get_options()
+    # a new directory, so nothing already in --work_dir is ever deleted.
+    os.makedirs(options.work_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="benchmark_", dir=os.path.abspath(options.work_dir))
+    print("working in", work_dir)
+
+    seqfile = generate_genomes.generate_genomes_from_options(os.path.join(work_dir, "genomes"), options)
+    aligner = load_aligner()
+    asms = aligner.get_asms_from_seqfile(seqfile)
+    ref_id = "ref"
+
+    results = {"commit": get_git_commit(),
+               "date": datetime.datetime.now().isoformat(),
+               "parameters": {key: value for key, value in vars(options).items() if key not in ("out", "work_dir", "keep_work_dir")},
+               "stages": dict()}
+
+    stage_args = {"dedup": (dedup_stage, asms, ref_id, os.path.join(work_dir, "dedup")),
+                  "import": (import_stage, asms, os.path.join(work_dir, "import_jobstore")),
+                  "mapping": (mapping_stage, asms, ref_id, os.path.join(work_dir, "mapping")),
+                  "conversion": (conversion_stage, os.path.join(work_dir, "mapping"), os.path.join(work_dir, "conversion")),
+                  "consolidation": (consolidation_stage, os.path.join(work_dir, "conversion"), work_dir),
+                  "workflow": (workflow_stage, seqfile, ref_id, work_dir, options.workflow_args.split())}
+    needed_stages = get_needed_stages(options.stages)
+    for stage in STAGES:
+        if stage in options.stages:
+            print("benchmarking", stage)
+            results["stages"][stage] = run_measured(*stage_args[stage])
+            print(json.dumps(results["stages"][stage]))
+        elif stage in needed_stages:
+            # the scratch directory is new, so the outputs of the stages it reads are made first, without being recorded.
+            print("running", stage, "(not benchmarked)")
+            run_measured(*stage_args[stage])
+
+    with open(options.out, "w") as outf:
+        json.dump(results, outf, indent=2)
+
+    if not options.keep_work_dir:
+        shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,131 @@
 from toil.common import Toil
 from toil.job import Job
 
-import subprocess
 import os
+import tempfile
+import shutil
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
+from src import aligners
 from src import paf_to_lastz
+from src import columnar
 from src import fasta_preprocessing
-
+from src import fasta_index
+from src import poor_mappings
+from src import segments
+from src import sharding
+from src import mapping_cache
+from src import compression
+from src import resources
+from src import instrumentation
+from src import local_executor
+from src import sketches
+from src import secondary_filter
+from src import manifest
+from src import masking
+from src import sorted_output
+from src import cigar_validation
+from src import depth
+from src import collinear_merge
+
+# minimap2 arguments for indexing and mapping. The minimap2 index is built with the same preset used for mapping.
+MINIMAP2_INDEX_ARGS = ["-x", "asm5"]
+MINIMAP2_MAP_ARGS = ["-cx", "asm5"]
 
 ## utilitary fxns:
 
-def unpack_promise(job, iterable, i):
-    """
-    passed an iterable and a location i, returns ith item.
-    """
-    return iterable[i]
-
-def consolidate_mappings(job, mapping_files):
+@instrumentation.instrumented("consolidation")
+def consolidate_mappings(job, mapping_files, segment_mapping_files=None, compress=False):
     """
     Warning: discards headers of all mapping files.
     Given a list of mapping files, consolidates the contents (not counting headers) into a
-    single file.
+    single file. Mappings in segment_mapping_files have segments as queries (see 
+    src/segments.py); they are lifted back to the coordinates of the original contigs.
+    If compress, the consolidated file is gzip compressed.
     """
     consolidated_mappings = job.fileStore.getLocalTempFile()
-    with open(consolidated_mappings,"w") as outfile:
+    with compression.open_output(consolidated_mappings, compress, threads=int(job.cores)) as outfile:
         for mapping_file in mapping_files.values():
-            with open(job.fileStore.readGlobalFile(mapping_file)) as inf:
+            with compression.open_input(job.fileStore.readGlobalFile(mapping_file)) as inf:
                 for line in inf:
                     if not line.startswith("@"):
                         outfile.write(line)
+                        instrumentation.count_records(job, mappings=1)
+        for mapping_file in (segment_mapping_files or dict()).values():
+            with compression.open_input(job.fileStore.readGlobalFile(mapping_file)) as inf:
+                for line in inf:
+                    if not line.startswith("@"):
+                        outfile.write(segments.lift_paf_line(line))
+                        instrumentation.count_records(job, segment_mappings=1)
     return job.fileStore.writeGlobalFile(consolidated_mappings)
 
+@instrumentation.instrumented("concatenation")
+def concatenate_lastz_mappings(job, lastz_mappings, segment_lastz_mappings=None, compress=False):
+    """
+    Given dictionaries of [primary, secondary] lastz cigar files, concatenates all the
+    primary files and all the secondary files, those of lastz_mappings first. Returns
+    [primary, secondary]. With --intermediate_format columnar, the dictionaries' values
+    are columnar mappings files instead, which are converted to lastz cigars here (gzip
+    compressed if compress).
+    """
+    mapping_files = list(lastz_mappings.values()) + list((segment_lastz_mappings or dict()).values())
+    out_files = [job.fileStore.getLocalTempFile() for i in range(2)]
+    instrumentation.count_records(job, files=len(mapping_files))
+    local_files = list()
+    for files in mapping_files:
+        if isinstance(files, list):
+            local_files.append([job.fileStore.readGlobalFile(file) for file in files])
+        else:
+            local_files.append([job.fileStore.getLocalTempFile() for i in range(2)])
+            instrumentation.count_records(job, **columnar.split_columnar_to_lastz(job.fileStore.readGlobalFile(files), local_files[-1][0],
+                                                                                 local_files[-1][1], compress, int(job.cores)))
+    for i in range(2):
+        compression.concatenate_files([files[i] for files in local_files], out_files[i])
+    return [job.fileStore.writeGlobalFile(out_file) for out_file in out_files]
+
+@instrumentation.instrumented("sort")
+def sort_lastz_mappings(job, lastz_file, options):
+    """
+    Sorts the lastz cigar file by target contig and start, and writes it in the 
+    --sorted_output mode (see src/sorted_output.py). Returns a dictionary with key: name
+    of each output file (relative to the --primary or --secondary directory in "split"
+    mode, or the suffix of its name in "indexed" mode), value: global file.
+    """
+    out_dir = job.fileStore.getLocalTempDir()
+    out_path = os.path.join(out_dir, "sorted.cigar")
+    out_files = sorted_output.write_sorted_output(job.fileStore.readGlobalFile(lastz_file), out_path, options.sorted_output,
+                                                  options.sort_buffer_size, options.index_block_size, options.compress_outputs, out_dir)
+    instrumentation.count_records(job, files=len(out_files))
+    if options.sorted_output == "split":
+        return {name: job.fileStore.writeGlobalFile(os.path.join(out_path, name)) for name in out_files}
+    return {out_file[len(out_path):]: job.fileStore.writeGlobalFile(out_file) for out_file in out_files}
+
+def export_lastz_mappings(workflow, lastz_mappings, path, options):
+    """
+    Exports the primary or secondary lastz cigar file to path, or with --sorted_output,
+    the files of the sorted output (see sort_lastz_mappings).
+    """
+    if not options.sorted_output:
+        workflow.exportFile(lastz_mappings, 'file://' + os.path.abspath(path))
+    elif options.sorted_output == "split":
+        os.makedirs(path, exist_ok=True)
+        for name, lastz_file in lastz_mappings.items():
+            workflow.exportFile(lastz_file, 'file://' + os.path.abspath(os.path.join(path, name)))
+    else:
+        for suffix, lastz_file in lastz_mappings.items():
+            workflow.exportFile(lastz_file, 'file://' + os.path.abspath(path + suffix))
+
 def get_asms_from_seqfile(seqfile):
+    """
+    Returns a dictionary of the assemblies in seqfile, with key: asm_name, value: fasta
+    path. Raises a ValueError listing every problem with the entries (see check_asm_files),
+    so that a bad entry fails before anything is imported.
+    """
     asm_files = dict()
+    duplicate_names = list()
 
-    with open(seqfile) as inf:
+    with compression.open_input(seqfile) as inf:
         #skip the Newick tree on the first line:
         next(inf)
         
@@ -43,25 +133,89 @@ def get_asms_from_seqfile(seqfile):
             parsed = line.split()
             if len(parsed) >= 2:
                 #note: fastas can be in a directory containing single consecutive spaces. Two spaces in a row breaks my file parsing system. 
-                if parsed[0][0] == "*":
-                    asm_files[parsed[0][1:]] = " ".join(parsed[1:])
-                else:
-                    asm_files[parsed[0]] = " ".join(parsed[1:])
-
+                asm_name = parsed[0][1:] if parsed[0][0] == "*" else parsed[0]
+                if asm_name in asm_files:
+                    duplicate_names.append(asm_name)
+                asm_files[asm_name] = " ".join(parsed[1:])
+
+    problems = ["assembly name " + asm_name + " is used more than once" for asm_name in duplicate_names] + check_asm_files(asm_files)
+    if problems:
+        raise ValueError("Invalid seqFile " + seqfile + ":\n" + "\n".join(problems))
     return asm_files
 
-def import_asms(options, workflow):
+def check_asm_files(asm_files):
+    """
+    Returns the list of problems with the fasta files in asm_files (key: asm_name, value:
+    path): files that don't exist, can't be read or are empty.
+    """
+    problems = list()
+    for asm_name, asm_file in asm_files.items():
+        if not os.path.isfile(asm_file):
+            problems.append("the fasta of " + asm_name + ", " + asm_file + ", doesn't exist")
+        elif not os.access(asm_file, os.R_OK):
+            problems.append("the fasta of " + asm_name + ", " + asm_file + ", isn't readable")
+        elif os.path.getsize(asm_file) == 0:
+            problems.append("the fasta of " + asm_name + ", " + asm_file + ", is empty")
+    return problems
+
+def import_files(workflow, paths, options, symlink=True):
+    """
+    Imports the local files at paths into the job store, up to --import_threads at a time,
+    since each import mostly waits on (possibly network) storage. Returns their global
+    files, in the order of paths.
+    """
+    with ThreadPoolExecutor(max(1, options.import_threads)) as executor:
+        return list(executor.map(lambda path: workflow.importFile('file://' + os.path.abspath(path), symlink=symlink), paths))
+
+def import_asms(options, workflow, previous_manifest=None, run_manifest=None):
     """Import asms; deduplicating contig ids if not --all_unique_ids
 
     Args:
         seqfile ([type]): [description]
         workflow ([type]): [description]
+        previous_manifest (dict): see deduplicate_asms.
+        run_manifest (dict): see deduplicate_asms.
 
     Returns:
         [type]: [description]
     """
     # asms is dictionary of all asms (not counting reference) with key: asm_name, value: imported global toil file.
-    asms = get_asms_from_seqfile(options.seqFile)
+    asms, fasta_indexes = deduplicate_asms(options, previous_manifest, run_manifest)
+
+    # Import asms, and their fasta indexes (see src/fasta_index.py) next to them, concurrently.
+    asm_ids = list(asms)
+    with tempfile.TemporaryDirectory(dir=options.workDir) as fai_dir:
+        fai_files = [os.path.join(fai_dir, str(i) + ".fai") for i in range(len(asm_ids))]
+        for asm_id, fai_file in zip(asm_ids, fai_files):
+            fasta_index.write_index(fasta_indexes[asm_id], fai_file)
+        # copied, not symlinked, since the temporary files are deleted.
+        fasta_indexes = dict(zip(asm_ids, import_files(workflow, fai_files, options, symlink=False)))
+    asms = dict(zip(asm_ids, import_files(workflow, [asms[asm_id] for asm_id in asm_ids], options)))
+
+    return asms, fasta_indexes
+
+def deduplicate_asms(options, previous_manifest=None, run_manifest=None):
+    """
+    Returns a dictionary of the fasta of each asm in the seqFile (key: asm_name, value:
+    path), with contig ids deduplicated if not --all_unique_ids, and a dictionary of their
+    fasta indexes (key: asm_name, value: index, see src/fasta_index.py).
+
+    With --update, assemblies that are unchanged since the run of previous_manifest keep
+    the deduplicated fasta and contig renames of that run, and only the other assemblies
+    are deduplicated, against the contig ids of the unchanged ones. If run_manifest is
+    given, the assemblies are recorded in it (see src/manifest.py).
+    """
+    all_asms = get_asms_from_seqfile(options.seqFile)
+    fasta_indexes = dict()
+
+    if run_manifest is not None:
+        source_records = manifest.get_source_records(all_asms, previous_manifest["assemblies"] if previous_manifest else None)
+        unchanged = manifest.get_unchanged_asms(previous_manifest, source_records, options.refID)
+        rename_state, fasta_indexes = manifest.get_rename_state(previous_manifest, unchanged, options.manifest_dir)
+    else:
+        unchanged = dict()
+        rename_state = None
+    asms = {asm_id: asm for asm_id, asm in all_asms.items() if asm_id not in unchanged}
 
     if not options.all_unique_ids:
         # deduplicate contig id names, if user hasn't guaranteed unique contig ids.
@@ -69,7 +223,7 @@ def import_asms(options, workflow):
         if options.overwrite_assemblies:
             # overwrite the original assemblies. Note that the reference is never overwritten, as it is never altered. 
             # (Code assumes that the reference is internally free of duplicate ids, and just ensures other asms don't use reference ids.)
-            asms = fasta_preprocessing.rename_duplicate_contig_ids(asms, options.refID, asms)
+            asms = fasta_preprocessing.rename_duplicate_contig_ids(asms, options.refID, asms, fasta_indexes=fasta_indexes, rename_state=rename_state)
         else:
             # don't overwrite the original assemblies.
             # first, determine the new asm save locations.
@@ -84,68 +238,446 @@ def import_asms(options, workflow):
                     # reference file never needs deduplication of contig ids, since ref contig ids are counted before all other asms.
                     new_asms[asm_id] = asm
                     
-            asms = fasta_preprocessing.rename_duplicate_contig_ids(asms, options.refID, new_asms)
+            asms = fasta_preprocessing.rename_duplicate_contig_ids(asms, options.refID, new_asms, fasta_indexes=fasta_indexes, rename_state=rename_state)
+    else:
+        fasta_indexes.update(fasta_preprocessing.get_indexes(asms))
+
+    # in the order of the seqFile.
+    asms = {asm_id: unchanged[asm_id]["fasta"] if asm_id in unchanged else asms[asm_id] for asm_id in all_asms}
+    if run_manifest is not None:
+        manifest.record_assemblies(run_manifest, asms, fasta_indexes, source_records, unchanged, rename_state, options.manifest_dir)
 
-    # Import asms.
-    for asm_id, asm in asms.items():
-        asms[asm_id] = workflow.importFile('file://' + os.path.abspath(asm))
+    return asms, fasta_indexes
 
-    return asms
+## mapping fxns:
 
-def empty(job):
+def map_all_to_ref(job, assembly_files, options, previous=None, fasta_indexes=None, masking_outputs=None):
     """
-    An empty job, for easier toil job organization.
+    Primarily for use with --all_to_ref_only. Otherwise, use map_all_to_ref_and_get_poor_mappings.
+    fasta_indexes are only used by --validate_outputs and --mask_repeats. With
+    --mask_repeats, the assemblies are masked first, unless they're already masked
+    (masking_outputs, see masking.mask_assemblies).
     """
-    return
+    if options.mask_repeats and masking_outputs is None:
+        mask_job = add_masking_job(job, assembly_files, fasta_indexes, options, previous)
+        return job.addFollowOnJobFn(map_all_to_ref, mask_job.rv("masked_assemblies"), options, previous, fasta_indexes, masking_outputs=mask_job.rv(),
+                                    **resources.empty_job_requirements(options)).rv()
+    previous = previous or manifest.new_outputs()
+    lead_job, reference_index = add_reference_index_job(job, assembly_files[options.refID], options, previous)
 
-## mapping fxns:
+    # map all assemblies to the reference. Don't map reference to reference, though.
+    sequence_lengths = get_sequence_lengths(job, fasta_indexes) if options.shard_size else dict()
+    ref_mappings, lastz_mappings, depth_tracks = add_ref_mapping_jobs(lead_job, assembly_files, reference_index, options, previous, sequence_lengths)
 
-def map_all_to_ref(job, assembly_files, reference, debug_export):
+    outputs = {"indexes": {options.refID: reference_index}, "ref_mappings": ref_mappings, "lastz_mappings": lastz_mappings,
+               "depth_tracks": depth_tracks}
+    outputs.update(masking_outputs or dict())
+    return add_output_jobs(job, ref_mappings, lastz_mappings, options, outputs=outputs, fasta_indexes=fasta_indexes)
+
+def map_all_to_ref_and_get_poor_mappings(job, assembly_files, fasta_indexes, options, previous=None, masking_outputs=None):
+    """
+    Maps all assemblies to the reference. Then, the segments of each assembly that map
+    poorly (or not at all) to the reference are re-mapped to all the other non-reference
+    assemblies. Mappings of the poorly mapped segments are lifted back to the coordinates
+    of their original contigs during conversion. fasta_indexes are the global files of the
+    assemblies' fasta indexes, used to extract the poorly mapped segments.
+
+    previous holds the outputs of a previous run that are reused instead of recomputed,
+    for --update (see manifest.import_outputs). With --mask_repeats, the assemblies are
+    masked first, unless they're already masked (masking_outputs, see
+    masking.mask_assemblies).
+    """
+    if options.mask_repeats and masking_outputs is None:
+        mask_job = add_masking_job(job, assembly_files, fasta_indexes, options, previous)
+        return job.addFollowOnJobFn(map_all_to_ref_and_get_poor_mappings, mask_job.rv("masked_assemblies"), fasta_indexes, options, previous,
+                                    masking_outputs=mask_job.rv(), **resources.empty_job_requirements(options)).rv()
+    previous = previous or manifest.new_outputs()
+    lead_job, reference_index = add_reference_index_job(job, assembly_files[options.refID], options, previous)
+
+    # map all assemblies to the reference, and index them for the re-mapping of poorly mapped segments.
+    sequence_lengths = get_sequence_lengths(job, fasta_indexes) if options.shard_size else dict()
+    ref_mappings, lastz_mappings, depth_tracks = add_ref_mapping_jobs(lead_job, assembly_files, reference_index, options, previous, sequence_lengths)
+    asm_indexes = dict()
+    asm_sketches = dict()
+    for assembly, assembly_file in assembly_files.items():
+        if assembly != options.refID:
+            if assembly in previous["indexes"]:
+                asm_indexes[assembly] = previous["indexes"][assembly]
+            else:
+                asm_indexes[assembly] = lead_job.addChildJobFn(index_fasta, assembly_file, options,
+                                                               **resources.requirements(resources.index_requirements, options, assembly_file)).rv()
+            if options.remap_top_k and assembly in previous["sketches"]:
+                asm_sketches[assembly] = previous["sketches"][assembly]
+            elif options.remap_top_k:
+                # sketched, to choose which assemblies the poorly mapped segments are re-mapped to.
+                asm_sketches[assembly] = lead_job.addChildJobFn(sketches.sketch_assembly, assembly_file, options.sketch_kmer_length, options.sketch_scale,
+                                                                **resources.requirements(resources.sketch_requirements, options, assembly_file)).rv()
+
+    # map the poorly mapped segments of each assembly to the other non-reference assemblies.
+    remap_job = lead_job.addFollowOnJobFn(remap_poor_segments, assembly_files, fasta_indexes, ref_mappings, asm_indexes, asm_sketches, options, previous)
+    segment_mappings = remap_job.rv(0)
+    segment_lastz_mappings = remap_job.rv(1)
+
+    outputs = {"indexes": dict(asm_indexes, **{options.refID: reference_index}), "sketches": asm_sketches,
+               "ref_mappings": ref_mappings, "lastz_mappings": lastz_mappings, "segments": remap_job.rv(2),
+               "segment_mappings": segment_mappings, "segment_lastz_mappings": segment_lastz_mappings, "depth_tracks": depth_tracks}
+    outputs.update(masking_outputs or dict())
+    return add_output_jobs(job, ref_mappings, lastz_mappings, options, segment_mappings, segment_lastz_mappings, outputs, fasta_indexes)
+
+def get_sequence_lengths(job, fasta_indexes):
     """
-    Primarily for use with option_all_to_ref_only. Otherwise, use map_all_to_ref_and_get_poor_mappings.
+    Returns a dictionary with key: assembly, value: the total length of its contigs, read
+    from fasta_indexes (global files of the assemblies' fasta indexes). Gzipped assemblies
+    hold several times more sequence than the size of their file.
     """
-    lead_job = job.addChildJobFn(empty)
+    return {assembly: sum(entry.length for entry in fasta_index.read_index(job.fileStore.readGlobalFile(index_file)))
+            for assembly, index_file in (fasta_indexes or dict()).items()}
 
-    # map all assemblies to the reference. Don't map reference to reference, though.
+def add_masking_job(job, assembly_files, fasta_indexes, options, previous=None):
+    """
+    Adds the masking of all the assemblies as a child of job (see src/masking.py), reusing
+    the k-mer counts and masked assemblies in previous. Masked assemblies have the same
+    layout, so fasta_indexes (global files of the assemblies' fasta indexes) still apply
+    to them. Returns the job; its rv() is the outputs of masking.mask_assemblies, and
+    rv("masked_assemblies") a dictionary with key: assembly, value: global file of the
+    masked assembly.
+    """
+    return job.addChildJobFn(masking.mask_assemblies, assembly_files, (fasta_indexes or dict()).get(options.refID), options, previous,
+                             **resources.empty_job_requirements(options))
+
+def add_reference_index_job(job, reference_file, options, previous):
+    """
+    Adds the indexing of the reference as a child of job, so that every mapping job can
+    share the index. If the index is reused from a previous run, an empty job takes its
+    place. Returns (the job, the index).
+    """
+    if options.refID in previous["indexes"]:
+        lead_job = Job(**resources.empty_job_requirements(options))
+        job.addChild(lead_job)
+        return lead_job, previous["indexes"][options.refID]
+    lead_job = job.addChildJobFn(index_fasta, reference_file, options,
+                                 **resources.requirements(resources.index_requirements, options, reference_file))
+    return lead_job, lead_job.rv()
+
+def add_ref_mapping_jobs(job, assembly_files, reference_index, options, previous, sequence_lengths=None):
+    """
+    Adds the mapping of each non-reference assembly to the reference as a child of job,
+    unless its mappings are reused from a previous run. Each assembly's mappings are
+    converted to lastz cigars by the job that mapped them. sequence_lengths (see
+    get_sequence_lengths) size the jobs that shard the assemblies. Returns (ref_mappings,
+    lastz_mappings, depth_tracks), dictionaries with key: assembly, value: the paf, the
+    [primary, secondary] lastz cigar files and, with --depth_track, the coverage track
+    (see src/depth.py) of the mappings, respectively.
+    """
     ref_mappings = dict()
+    lastz_mappings = dict()
+    depth_tracks = dict()
     for assembly, assembly_file in assembly_files.items():
-        if assembly != reference:
-            ref_mappings[assembly] = lead_job.addChildJobFn(map_a_to_b, assembly_file, assembly_files[reference]).rv()
-    
-    consolidate_job = lead_job.addFollowOnJobFn(consolidate_mappings, ref_mappings)
-    paf_mappings = consolidate_job.rv()
+        if assembly == options.refID:
+            continue
+        if assembly in previous["ref_mappings"] and assembly in previous["lastz_mappings"] and \
+                (not options.depth_track or assembly in previous["depth_tracks"]):
+            ref_mappings[assembly] = previous["ref_mappings"][assembly]
+            lastz_mappings[assembly] = previous["lastz_mappings"][assembly]
+            if options.depth_track:
+                depth_tracks[assembly] = previous["depth_tracks"][assembly]
+        else:
+            mapping_job = add_mapping_job(job, assembly_file, reference_index, options, depth_track=bool(options.depth_track),
+                                          sequence_length=(sequence_lengths or dict()).get(assembly))
+            ref_mappings[assembly] = mapping_job.rv(0)
+            lastz_mappings[assembly] = mapping_job.rv(1)
+            if options.depth_track:
+                depth_tracks[assembly] = mapping_job.rv(2)
+    return ref_mappings, lastz_mappings, depth_tracks
+
+def remap_poor_segments(job, assembly_files, fasta_indexes, ref_mappings, asm_indexes, asm_sketches, options, previous=None):
+    """
+    Extracts the poorly mapped segments of each assembly from its mappings to the
+    reference (see poor_mappings.extract_poor_mappings), unless they're reused from a
+    previous run, then maps them to the other non-reference assemblies (see 
+    map_poor_segments). Returns the promised output of map_poor_segments.
+    """
+    previous = previous or manifest.new_outputs()
+    to_extract = [assembly for assembly in ref_mappings if assembly not in previous["segments"]]
+    sequence_lengths = get_sequence_lengths(job, {assembly: fasta_indexes[assembly] for assembly in to_extract})
+    poor_segments = dict()
+    for assembly in ref_mappings:
+        if assembly in previous["segments"]:
+            poor_segments[assembly] = previous["segments"][assembly]
+            continue
+        poor_segments[assembly] = job.addChildJobFn(poor_mappings.extract_poor_mappings, assembly_files[assembly], fasta_indexes[assembly],
+                                                    ref_mappings[assembly], options.poor_mapping_min_length, options.poor_mapping_min_identity,
+                                                    **resources.requirements(resources.fasta_requirements, options, assembly_files[assembly], ref_mappings[assembly],
+                                                                             sequence_length=sequence_lengths[assembly])).rv()
+
+    return job.addFollowOnJobFn(map_poor_segments, poor_segments, asm_indexes, asm_sketches, options, previous,
+                                **resources.requirements(resources.sketch_requirements, options, *poor_segments.values(), *asm_sketches.values())).rv()
+
+@instrumentation.instrumented("remap_partners")
+def map_poor_segments(job, poor_segments, asm_indexes, asm_sketches, options, previous=None):
+    """
+    Maps the poorly mapped segments of each assembly to every other non-reference assembly
+    or, with --remap_top_k, only to the --remap_top_k assemblies that contain the most of
+    the segments' k-mers (estimated from their sketches, see src/sketches.py). That keeps
+    the number of re-mappings linear in the number of assemblies.
+
+    Args:
+        poor_segments (dict): key: assembly, value: global fasta of its poorly mapped segments.
+        asm_indexes (dict): key: assembly, value: minimap2 index of the assembly, as returned by index_fasta.
+        asm_sketches (dict): key: assembly, value: global sketch file of the assembly. Empty without --remap_top_k.
+        previous (dict): outputs of a previous run to reuse (see manifest.import_outputs).
+
+    Returns:
+        tuple: (segment_mappings, lastz_mappings) dictionaries with key: assembly + "_to_" + other assembly, value:
+        the paf and the [primary, secondary] lastz cigar files of the mappings, respectively; and poor_segments.
+    """
+    previous = previous or manifest.new_outputs()
+    if options.remap_top_k:
+        partners = sketches.choose_remap_partners({assembly: job.fileStore.readGlobalFile(segments) for assembly, segments in poor_segments.items()},
+                                                  {assembly: job.fileStore.readGlobalFile(sketch) for assembly, sketch in asm_sketches.items()},
+                                                  options.remap_top_k, options.remap_min_containment, options.sketch_kmer_length, options.sketch_scale)
+    else:
+        partners = {assembly: [other_assembly for other_assembly in asm_indexes if other_assembly != assembly] for assembly in poor_segments}
+
+    segment_mappings = dict()
+    lastz_mappings = dict()
+    for assembly, assembly_partners in partners.items():
+        instrumentation.count_records(job, remappings=len(assembly_partners), skipped_remappings=len(asm_indexes) - 1 - len(assembly_partners))
+        for other_assembly in assembly_partners:
+            pair = assembly + "_to_" + other_assembly
+            if pair in previous["segment_mappings"] and pair in previous["segment_lastz_mappings"]:
+                segment_mappings[pair] = previous["segment_mappings"][pair]
+                lastz_mappings[pair] = previous["segment_lastz_mappings"][pair]
+                instrumentation.count_records(job, reused_remappings=1)
+                continue
+            mapping_job = add_mapping_job(job, poor_segments[assembly], asm_indexes[other_assembly], options, lift_segments=True)
+            segment_mappings[pair] = mapping_job.rv(0)
+            lastz_mappings[pair] = mapping_job.rv(1)
+
+    return (segment_mappings, lastz_mappings, poor_segments)
+
+def add_output_jobs(job, ref_mappings, lastz_mappings, options, segment_mappings=None, segment_lastz_mappings=None, outputs=None,
+                    fasta_indexes=None):
+    """
+    Adds the concatenation of all the converted lastz cigar files as a follow-on to job,
+    which runs once all mapping and conversion is done. The mappings of poorly mapped
+    segments (possibly promised dictionaries, see map_poor_segments) come last. Returns
+    the promised output of the mapping workflow. With --manifest_dir, outputs (the
+    outputs of each assembly and pair of assemblies, see manifest.new_outputs) are
+    returned last, to be saved for later runs. With --validate_outputs, the concatenated
+    files are validated against the contig lengths in fasta_indexes (global files of the
+    assemblies' fasta indexes), and the workflow fails if they aren't valid. With
+    --depth_track, the coverage tracks of the assemblies (outputs["depth_tracks"]) are
+    summed, and the depth outputs (see depth.write_depth_outputs) are returned before
+    outputs.
+    """
+    extra_outputs = (outputs,) if options.manifest_dir else tuple()
+    if options.depth_track:
+        depth_tracks = list(outputs["depth_tracks"].values())
+        merge_job = job.addFollowOnJobFn(depth.merge_depth_tracks, depth_tracks, options,
+                                         **resources.requirements(resources.depth_requirements, options, *depth_tracks))
+        depth_job = merge_job.addFollowOnJobFn(depth.write_depth_outputs, merge_job.rv(), (fasta_indexes or dict()).get(options.refID), options.compress_outputs,
+                                               **resources.requirements(resources.depth_requirements, options, merge_job.rv()))
+        extra_outputs = (depth_job.rv(),) + extra_outputs
+    concatenate_job = job.addFollowOnJobFn(concatenate_lastz_mappings, lastz_mappings, segment_lastz_mappings, options.compress_outputs,
+                                           **resources.requirements(resources.paf_requirements, options, *lastz_mappings.values(), segment_lastz_mappings))
+    primary_mappings = concatenate_job.rv(0)
+    secondary_mappings = concatenate_job.rv(1)
+    if options.validate_outputs:
+        concatenate_job.addFollowOnJobFn(cigar_validation.validate_outputs, concatenate_job.rv(), fasta_indexes,
+                                         **resources.requirements(resources.validation_requirements, options, concatenate_job.rv()))
+    if options.sorted_output:
+        primary_mappings, secondary_mappings = [concatenate_job.addFollowOnJobFn(sort_lastz_mappings, mappings, options,
+                                                                                 **resources.requirements(resources.sort_requirements, options, mappings)).rv()
+                                                for mappings in (primary_mappings, secondary_mappings)]
+
+    if options.debug_export:
+        # the consolidated paf is only needed for debugging.
+        consolidate_job = job.addFollowOnJobFn(consolidate_mappings, ref_mappings, segment_mappings, compress=options.compress_outputs,
+                                               **resources.requirements(resources.paf_requirements, options, *ref_mappings.values(), segment_mappings))
+        return (primary_mappings, secondary_mappings, ref_mappings, consolidate_job.rv() ) + extra_outputs
+    else:
+        return (primary_mappings, secondary_mappings) + extra_outputs
 
-    conversion_job = consolidate_job.addFollowOnJobFn(paf_to_lastz.paf_to_lastz, paf_mappings)
-    lastz_mappings = conversion_job.rv()
+@instrumentation.instrumented("index")
+def index_fasta(job, fasta, options):
+    """Builds a minimap2 index of fasta, with the same preset used by map_a_to_b, with
+    the --aligner backend (see src/aligners.py). With --mapping_cache_dir, the index is
+    reused from the cache if fasta is unchanged.
 
-    primary_mappings = conversion_job.addChildJobFn(unpack_promise, lastz_mappings, 0).rv()
-    secondary_mappings = conversion_job.addChildJobFn(unpack_promise, lastz_mappings, 1).rv()
+    Args:
+        fasta (global file): fasta file to index. In map_all_to_ref, this is the reference.
+
+    Returns:
+        tuple: (global file of the minimap2 index (.mmi) of fasta, sha256 digest of fasta 
+        or None if there's no --mapping_cache_dir). map_a_to_b takes this tuple as b.
+    """
+    fasta = job.fileStore.readGlobalFile(fasta)
+    index = job.fileStore.getLocalTempFileName() + ".mmi"
+
+    if options.mapping_cache_dir:
+        fasta_digest = mapping_cache.file_digest(fasta)
+        cache_key = mapping_cache.get_cache_key([fasta_digest], MINIMAP2_INDEX_ARGS, aligners.get_version(options.aligner))
+        if mapping_cache.lookup(options.mapping_cache_dir, cache_key, index):
+            job.log("mapping cache hit for index " + cache_key)
+            instrumentation.count_records(job, cache_hits=1)
+            return (job.fileStore.writeGlobalFile(index), fasta_digest)
+        job.log("mapping cache miss for index " + cache_key)
+        instrumentation.count_records(job, cache_misses=1)
+    else:
+        fasta_digest = None
 
-    if debug_export:
-        return (primary_mappings, secondary_mappings, ref_mappings, paf_mappings )
+    if options.aligner == "mappy":
+        aligners.build_index(fasta, index, aligners.get_preset(MINIMAP2_INDEX_ARGS), int(job.cores))
     else:
-        return (primary_mappings, secondary_mappings)
+        instrumentation.run_command(job, ["minimap2"] + MINIMAP2_INDEX_ARGS + ["-t", str(int(job.cores)), "-d", index, fasta])
+
+    if options.mapping_cache_dir:
+        mapping_cache.store(options.mapping_cache_dir, cache_key, index, options.mapping_cache_max_size)
+    return (job.fileStore.writeGlobalFile(index), fasta_digest)
 
-def map_a_to_b(job, a, b):
-    """Maps fasta a to fasta b.
+@instrumentation.instrumented("mapping")
+def map_a_to_b(job, a, b, options, convert=True, lift_segments=False, depth_track=False):
+    """Maps fasta a to the minimap2 index of fasta b, with the --aligner backend (see
+    src/aligners.py). With --mapping_cache_dir, the mapping is reused from the cache if
+    neither a nor b changed.
 
     Args:
         a (global file): fasta file a. In map_all_to_ref, a is an assembly fasta.
-        b (global file): fasta file b. In map_all_to_ref, b is the reference.
+        b (tuple): minimap2 index of fasta file b and digest of b, as returned by index_fasta. In map_all_to_ref, b is the reference index.
+        convert (bool): also convert the mappings to lastz cigars, in this job (see upload_mappings).
+        lift_segments (bool): a is a fasta of segments; lift their mappings back to contig coordinates when converting.
+        depth_track (bool): also record the coverage of b by the primary mappings when converting (see upload_mappings).
 
     Returns:
-        [type]: [description]
+        tuple: (global file of the paf of the mappings of a to b, [primary, secondary] lastz cigar files[, coverage track]) if convert, otherwise just the paf.
     """
-    
-    # map_to_ref_paf = job.fileStore.writeGlobalFile(job.fileStore.getLocalTempFile())
-    tmp = job.fileStore.getLocalTempFile()
-    map_to_ref_paf = job.fileStore.writeGlobalFile(tmp)
+    index, b_digest = b
+    a = job.fileStore.readGlobalFile(a)
+    map_to_ref_paf = job.fileStore.getLocalTempFileName()
+
+    cached = False
+    if options.mapping_cache_dir:
+        cache_key = mapping_cache.get_cache_key([mapping_cache.file_digest(a), b_digest], MINIMAP2_MAP_ARGS, aligners.get_version(options.aligner))
+        cached = mapping_cache.lookup(options.mapping_cache_dir, cache_key, map_to_ref_paf)
+        job.log("mapping cache " + ("hit" if cached else "miss") + " for mapping " + cache_key)
+        instrumentation.count_records(job, cache_hits=int(cached), cache_misses=int(not cached))
+
+    paf_lines = None
+    if not cached:
+        if options.aligner == "mappy":
+            preset = aligners.get_preset(MINIMAP2_MAP_ARGS)
+            paf_lines = aligners.map_fasta(aligners.load_index(job.fileStore.readGlobalFile(index), preset, key=str(index)), a, int(job.cores),
+                                           aligners.PRESET_SCORING.get(preset))
+            if convert:
+                # the mappings stream straight into the conversion, and the paf is written in the same pass.
+                paf_lines = aligners.tee_paf(paf_lines, map_to_ref_paf)
+            else:
+                aligners.write_paf(paf_lines, map_to_ref_paf)
+                paf_lines = None
+        else:
+            instrumentation.run_command(job, ["minimap2"] + MINIMAP2_MAP_ARGS + ["-t", str(int(job.cores)), "-o", map_to_ref_paf, job.fileStore.readGlobalFile(index), a])
 
+    if convert:
+        outputs = upload_mappings(job, map_to_ref_paf, options, lift_segments, depth_track, paf_lines)
+    if not cached and options.mapping_cache_dir:
+        mapping_cache.store(options.mapping_cache_dir, cache_key, map_to_ref_paf, options.mapping_cache_max_size)
+    instrumentation.count_records(job, mappings=instrumentation.count_lines(map_to_ref_paf))
 
-    subprocess.call(["minimap2", "-cx", "asm5", "-o", job.fileStore.readGlobalFile(map_to_ref_paf),
-                    job.fileStore.readGlobalFile(b), job.fileStore.readGlobalFile(a)])
-    
-    return map_to_ref_paf
+    if convert:
+        return outputs
+    return job.fileStore.writeGlobalFile(map_to_ref_paf)
+
+def upload_mappings(job, paf, options, lift_segments=False, depth_track=False, paf_lines=None):
+    """
+    Converts the local paf to lastz cigars (see paf_to_lastz.paf_to_lastz), filtering the
+    secondary mappings as configured (see src/secondary_filter.py), then uploads the paf. Each file is written to the job store once, and the paf is never downloaded
+    again for the conversion. Returns (global file of the paf, [primary, secondary] lastz
+    cigar files), or with --intermediate_format columnar, (global file of the paf,
+    columnar mappings file) (see src/columnar.py). If depth_track, the coverage of the
+    reference by the primary mappings is recorded during the conversion, and its track
+    (see src/depth.py) is returned last. If paf_lines is given, it's converted instead of
+    reading the paf back, which must be written by the time it's exhausted. With
+    --merge_collinear_gap, collinear mappings are merged before they are converted (see
+    src/collinear_merge.py); the uploaded paf is unmerged.
+    """
+    coverage = depth.AssemblyCoverage() if depth_track else None
+    merger = collinear_merge.from_options(options, MINIMAP2_MAP_ARGS)
+    if merger is not None:
+        # segments are lifted before they're merged, so neighbouring segments can be merged.
+        paf_lines = merger.merge(paf, lift_segments, job.fileStore.getLocalTempDir(), paf_lines)
+        lift_segments = False
+    if options.intermediate_format == "columnar":
+        lastz_mappings = columnar.paf_to_columnar(job, paf, lift_segments, secondary_filter.from_options(options), coverage, paf_lines)
+    else:
+        lastz_mappings = paf_to_lastz.paf_to_lastz(job, paf, options.compress_outputs, lift_segments, secondary_filter.from_options(options), coverage,
+                                                   paf_lines)
+    if merger is not None:
+        instrumentation.count_records(job, merged_mappings=merger.merged)
+    if coverage is not None:
+        track_file = job.fileStore.getLocalTempFile()
+        depth.write_track(coverage.get_track(), track_file)
+        return (job.fileStore.writeGlobalFile(paf), lastz_mappings, job.fileStore.writeGlobalFile(track_file))
+    return (job.fileStore.writeGlobalFile(paf), lastz_mappings)
+
+def add_mapping_job(job, a, b, options, lift_segments=False, depth_track=False, sequence_length=None):
+    """
+    Adds the mapping of fasta a to the minimap2 index of fasta b as a child of job. The 
+    mapping is split into shards if --shard_size is given, by a job sized by the total
+    sequence_length of a, if known (see resources.fasta_requirements). Returns the mapping job; its
+    rv(0) is the paf, and its rv(1) the [primary, secondary] lastz cigar files (or the
+    columnar mappings file, see upload_mappings). If depth_track, its rv(2) is the
+    coverage track of the mappings.
+    """
+    if options.shard_size:
+        return job.addChildJobFn(map_a_to_b_sharded, a, b, options, lift_segments, depth_track,
+                                 **resources.requirements(resources.fasta_requirements, options, a, sequence_length=sequence_length))
+    else:
+        return job.addChildJobFn(map_a_to_b, a, b, options, lift_segments=lift_segments, depth_track=depth_track,
+                                 **resources.requirements(resources.mapping_requirements, options, a, b))
+
+@instrumentation.instrumented("sharding")
+def map_a_to_b_sharded(job, a, b, options, lift_segments=False, depth_track=False):
+    """Maps fasta a to the minimap2 index of fasta b, mapping chunks of about
+    --shard_size bases of a in parallel. Contigs longer than --split_contig_length are
+    split into overlapping windows first (see sharding.shard_fasta).
+
+    Args:
+        a (global file): fasta file a.
+        b (tuple): minimap2 index of fasta file b and digest of b, as returned by index_fasta.
+        lift_segments (bool): a is a fasta of segments; lift their mappings back to contig coordinates when converting.
+        depth_track (bool): as in map_a_to_b.
+
+    Returns:
+        tuple: as map_a_to_b: (the paf of all the shards' mappings, in the coordinates of a, [primary, secondary] lastz cigar files[, coverage track]).
+    """
+    shards, window_cores = sharding.shard_fasta(job.fileStore.readGlobalFile(a), job.fileStore.getLocalTempFile,
+                                                options.shard_size, options.split_contig_length, options.split_contig_overlap)
+
+    instrumentation.count_records(job, shards=len(shards))
+    shard_mappings = list()
+    for shard in shards:
+        shard = job.fileStore.writeGlobalFile(shard)
+        shard_mappings.append(job.addChildJobFn(map_a_to_b, shard, b, options, convert=False,
+                                                **resources.requirements(resources.mapping_requirements, options, shard, b)).rv())
+
+    return job.addFollowOnJobFn(merge_shard_mappings, shard_mappings, options, lift_segments, depth_track, window_cores,
+                                **resources.requirements(resources.shard_merge_requirements, options, *shard_mappings)).rv()
+
+@instrumentation.instrumented("shard_merge")
+def merge_shard_mappings(job, shard_mappings, options, lift_segments=False, depth_track=False, window_cores=None):
+    """
+    Merges the pafs of all shards mapped by map_a_to_b_sharded, lifting windows (the keys
+    of window_cores, see sharding.shard_fasta) back to contig coordinates and clipping
+    their mappings to the cores of the windows, so that the overlaps of windows are aligned
+    once. The merged paf is converted to lastz cigars in this job, as in map_a_to_b.
+    """
+    merged_mappings = job.fileStore.getLocalTempFile()
+    discarded = sharding.merge_shard_mappings([job.fileStore.readGlobalFile(mapping_file) for mapping_file in shard_mappings], merged_mappings,
+                                              window_cores)
+    instrumentation.count_records(job, discarded_mappings=discarded)
+
+    return upload_mappings(job, merged_mappings, options, lift_segments, depth_track)
 
 
 ## main fxn and interface:
@@ -172,6 +704,114 @@ def get_options():
     parser.add_argument('--assembly_save_dir', type=str, default='./unique_id_assemblies/',
                         help='While deduplicating contig ids in the input fastas, save the assemblies in this directory. Ignored when used in conjunction with --overwrite_assemblies.')
                         
+    parser.add_argument('--import_threads', type=int, default=8,
+                        help='Number of assemblies (and other input files) imported into the job store at the same time.')
+
+    parser.add_argument('--compress_outputs', action='store_true',
+                        help='Keep the consolidated paf and the primary and secondary lastz cigar files gzip compressed, both in the job store and when written to --primary and --secondary.')
+    parser.add_argument('--aligner', choices=aligners.BACKENDS, default="minimap2",
+                        help="How assemblies are indexed and mapped: minimap2 runs the minimap2 binary, mappy maps in process with minimap2's python binding, streaming the mappings straight into the conversion to lastz cigars. mappy doesn't report minimap2's alignment scores, which are computed from the cigars instead, or flag inversions (see src/aligners.py).")
+    parser.add_argument('--intermediate_format', choices=["lastz", "columnar"], default="lastz",
+                        help='Format of the converted mappings of each mapping job until they are concatenated. "columnar": a compact binary file of numpy columns with interned contig names and packed cigars, that is memory-mapped by the concatenation, which writes the lastz cigars (see src/columnar.py). Not compressed by --compress_outputs. --primary and --secondary are the same either way.')
+
+    parser.add_argument('--sorted_output', choices=["split", "indexed"], default=None,
+                        help='Sort --primary and --secondary by target contig and start, with an external merge sort. "split": --primary and --secondary are directories with one file per contig, listed in contigs.tsv. "indexed": --primary and --secondary are single files, with an index of the byte offset of each block of each contig in --primary.idx and --secondary.idx (see src/sorted_output.py).')
+    parser.add_argument('--sort_buffer_size', type=int, default=256 * 1024**2,
+                        help='With --sorted_output or --merge_collinear_gap, sort runs of at most this many bytes of lines in memory.')
+    parser.add_argument('--index_block_size', type=int, default=100000,
+                        help='With --sorted_output indexed, index blocks of alignments starting in windows of this many bases of a contig.')
+
+    # options for mapping:
+    parser.add_argument('--all_to_ref_only', action='store_true',
+                        help="Only map the assemblies to the reference. Don't re-map the poorly mapped segments to the other assemblies.")
+    parser.add_argument('--poor_mapping_min_length', type=int, default=500,
+                        help='Segments of an assembly that are not covered by a mapping to the reference are re-mapped to the other assemblies if they are at least this long.')
+    parser.add_argument('--poor_mapping_min_identity', type=float, default=0.9,
+                        help='Mappings to the reference with identity below this threshold are considered poor, and don\'t count as covering the assembly. Identity is matching bases/aligned (M, = and X) bases of the cigar, so indels don\'t lower it: the inserted bases of a good mapping are already left uncovered, and re-mapped. Mappings without a cigar use matching bases/alignment block length.')
+
+    parser.add_argument('--secondary_top_n', type=int, default=0,
+                        help='Only write the (up to) this many best scoring secondary mappings starting in each --secondary_region_length window of a query to --secondary. 0 (the default) keeps them all.')
+    parser.add_argument('--secondary_region_length', type=int, default=10000,
+                        help='Length of the query windows for --secondary_top_n.')
+    parser.add_argument('--secondary_max_containment', type=float, default=0,
+                        help='Drop secondary mappings that have at least this fraction of their query and target intervals inside a primary or better scoring secondary mapping of the same query on the same target and strand, e.g. 0.9. 0 (the default) keeps them.')
+    parser.add_argument('--secondary_min_length', type=int, default=0,
+                        help='Drop secondary mappings with an alignment block shorter than this.')
+    parser.add_argument('--secondary_min_identity', type=float, default=0,
+                        help='Drop secondary mappings with identity (matching bases/alignment block length) below this.')
+    parser.add_argument('--secondary_min_mapq', type=int, default=0,
+                        help='Drop secondary mappings with a mapping quality below this. Note that minimap2 gives most secondary mappings a mapping quality of 0.')
+    parser.add_argument('--merge_collinear_gap', type=int, default=0,
+                        help='Merge each mapping with the previous mapping of the same query on the same target, strand and type (primary or secondary) if it follows it on both the query and the target after gaps of at most this many bases, stitching the gaps into the cigar as an insertion and a deletion. Gives fewer, longer lastz cigar lines. 0 (the default) doesn\'t merge. The mappings of each assembly are sorted on disk with --sort_buffer_size bytes of memory (see src/collinear_merge.py).')
+
+    parser.add_argument('--remap_top_k', type=int, default=0,
+                        help='Only re-map the poorly mapped segments of each assembly to the (up to) this many other assemblies that share the most k-mers with them, estimated from FracMinHash sketches. 0 (the default) re-maps them to every other assembly.')
+    parser.add_argument('--remap_min_containment', type=float, default=0.01,
+                        help='With --remap_top_k, also skip assemblies that contain less than this fraction of the k-mers of the poorly mapped segments.')
+    parser.add_argument('--sketch_kmer_length', type=int, default=21,
+                        help='Length of the k-mers sketched for --remap_top_k (at most 32).')
+    parser.add_argument('--sketch_scale', type=int, default=1000,
+                        help='Sketches for --remap_top_k keep about one in this many distinct k-mers.')
+
+    parser.add_argument('--shard_size', type=int, default=0,
+                        help='Split each assembly into chunks of about this many bases, and map the chunks in parallel. 0 (the default) maps each assembly in a single job.')
+    parser.add_argument('--split_contig_length', type=int, default=0,
+                        help='When sharding (see --shard_size), also split contigs longer than this into overlapping windows. 0 (the default) never splits contigs.')
+    parser.add_argument('--split_contig_overlap', type=int, default=10000,
+                        help='Number of bases by which neighbouring windows of a split contig overlap (see --split_contig_length). Each window only keeps its mappings up to the middle of its overlaps, so every base is aligned by one window.')
+
+    # options for caching mappings between runs:
+    parser.add_argument('--mapping_cache_dir', type=str, default=None,
+                        help='Directory for a persistent cache of minimap2 indexes and mappings, shared between runs. Must be accessible from all workers. Mappings of unchanged assemblies are reused from the cache.')
+    parser.add_argument('--mapping_cache_max_size', type=int, default=500 * 1024**3,
+                        help='Maximum size of the mapping cache in bytes. The least recently used files are evicted when the cache grows larger.')
+
+    # options for adding assemblies to the outputs of a previous run:
+    parser.add_argument('--manifest_dir', type=str, default=None,
+                        help='Directory where the outputs of each assembly and pair of assemblies are saved at the end of the run, along with a manifest of the assemblies\' checksums and contig renames, for --update.')
+    parser.add_argument('--update', action='store_true',
+                        help='Only deduplicate, map and convert the assemblies that are new or changed since the run that wrote the manifest in --manifest_dir, reusing its outputs for the others. --primary and --secondary still include all the assemblies of the seqFile.')
+
+    # options for sizing the cores, memory and disk requested by each job from the sizes of its inputs:
+    parser.add_argument('--max_job_cores', type=int, default=8,
+                        help='Maximum number of cores requested by a single indexing or mapping job (and the number of threads given to minimap2).')
+    parser.add_argument('--mapping_bases_per_core', type=int, default=200 * 1024**2,
+                        help='Indexing and mapping jobs request one core per this many bytes of input fasta.')
+    parser.add_argument('--index_memory_factor', type=float, default=4.0,
+                        help='Indexing jobs request this many times the size of the fasta in memory, plus --job_memory_overhead.')
+    parser.add_argument('--mapping_memory_factor', type=float, default=1.5,
+                        help='Mapping jobs request this many times the size of the minimap2 index in memory, plus --job_memory_overhead.')
+    parser.add_argument('--job_memory_overhead', type=int, default=2 * 1024**3,
+                        help='Memory in bytes requested by every job on top of its input-dependent memory requirement.')
+    parser.add_argument('--disk_factor', type=float, default=3.0,
+                        help='Jobs request this many times the total size of their input files in disk (plus 1 GiB).')
+
+    # options for running without toil:
+    parser.add_argument('--local_fast', '--local-fast', action='store_true',
+                        help="Run on this machine with a process pool instead of toil, piping minimap2's output straight into the conversion to lastz cigars. Faster for small and medium inputs on a single machine, and uses no job store (the jobStore argument is ignored). --primary and --secondary are the same as those of the toil workflow. --shard_size, --mapping_cache_dir, --debug_export, --manifest_dir and --update aren't supported.")
+
+    # options for performance reporting:
+    parser.add_argument('--report', type=str, default=None,
+                        help='Write the wall time, CPU time, peak RSS, bytes read and written and record counts of every job to this file at the end of the run: as TSV if it ends with .tsv, otherwise as JSON. Turns on toil\'s --stats.')
+    parser.add_argument('--critical_path_summary', type=str, default=None,
+                        help='Write the jobs on the critical path of the run to this file, in the collapsed stack format of flame graph tools. Turns on toil\'s --stats.')
+
+    # options for masking repeats before mapping:
+    parser.add_argument('--mask_repeats', action='store_true',
+                        help="Before indexing and mapping, count the k-mers of the reference in parallel shards, and replace with N the bases of every assembly that are in k-mers seen at least --mask_min_count times in the reference, or in low-complexity sequence. minimap2 doesn't seed in masked sequence, which cuts mapping time and secondary mappings on repeat-rich assemblies. Masked assemblies keep their layout, so coordinates are unchanged. The run report counts the masked bases of each assembly (see src/masking.py).")
+    parser.add_argument('--mask_kmer_length', type=int, default=19,
+                        help='With --mask_repeats, length of the k-mers counted in the reference.')
+    parser.add_argument('--mask_min_count', type=int, default=100,
+                        help='With --mask_repeats, mask k-mers seen at least this many times in the reference (at most 255).')
+    parser.add_argument('--mask_dust_threshold', type=float, default=20,
+                        help='With --mask_repeats, mask windows of 64 bases whose DUST score is above this, as low-complexity. 0 masks no low-complexity sequence.')
+
+    # for quality control:
+    parser.add_argument('--depth_track', type=str, default=None,
+                        help="Write the number of assemblies whose primary mappings cover each base of the reference to this prefix + .depth.npz (run-length encoded, see src/depth.py) and + .bedGraph (gzip compressed with --compress_outputs). The coverage is recorded while each assembly's mappings are converted, and summed in a tree of jobs.")
+    parser.add_argument('--validate_outputs', action='store_true',
+                        help="Check that every line of --primary and --secondary is a well-formed lastz cigar whose cigar spans its query and target coordinates, on the right strand and within its contigs, in a final job with a worker process per core. The run fails with a summary of the problems if any line isn't (see src/cigar_validation.py).")
+
     # for debugging:
     parser.add_argument('--debug_export', action='store_true',
                         help='Export several other files for debugging inspection.')
@@ -182,15 +822,55 @@ def get_options():
 
 def main():
     options = get_options()
+    aligners.check_backend(options.aligner)
+    if options.mask_repeats and not 0 < options.mask_min_count <= masking.MAX_COUNT:
+        raise ValueError("--mask_min_count must be between 1 and " + str(masking.MAX_COUNT) + ", not " + str(options.mask_min_count))
+    if options.merge_collinear_gap < 0:
+        raise ValueError("--merge_collinear_gap can't be negative, not " + str(options.merge_collinear_gap))
+
+    if options.local_fast:
+        main_local(options)
+        return
+
+    if options.mapping_cache_dir:
+        options.mapping_cache_dir = os.path.abspath(options.mapping_cache_dir)
+
+    # fail on a bad seqFile before the job store is even created.
+    get_asms_from_seqfile(options.seqFile)
+
+    previous_manifest = None
+    run_manifest = None
+    if options.manifest_dir:
+        options.manifest_dir = os.path.abspath(options.manifest_dir)
+        if options.update:
+            previous_manifest = manifest.load_for_update(options, MINIMAP2_INDEX_ARGS, MINIMAP2_MAP_ARGS)
+        run_manifest = manifest.new_manifest(options, MINIMAP2_INDEX_ARGS, MINIMAP2_MAP_ARGS, previous_manifest)
+    elif options.update:
+        print("WARNING: --update is ignored without --manifest_dir.")
+
+    # the mapping cache is shared with other runs, so this run's hits and misses are counted from its own jobs' metrics.
+    report = options.report or options.critical_path_summary or options.mapping_cache_dir
+    if report:
+        # the job metrics are read from the stats files once the workflow is done, so toil mustn't delete the job store
+        # (see the cleanup below).
+        clean = options.clean
+        options.stats = True
+        options.clean = "never"
 
     with Toil(options) as workflow:
         ## Preprocessing:
         # Import asms; deduplicating contig ids if not --all_unique_ids
-        asms = import_asms(options, workflow)
+        with instrumentation.measure("import", "import_asms") as import_metrics:
+            asms, fasta_indexes = import_asms(options, workflow, previous_manifest, run_manifest)
+            # with --update, the outputs of unchanged assemblies are reused.
+            previous = manifest.import_outputs(lambda paths: import_files(workflow, paths, options), previous_manifest, run_manifest, options)
             
         ## Perform alignments:
         if not workflow.options.restart:
-            alignments = workflow.start(Job.wrapJobFn(map_all_to_ref, asms, options.refID, options.debug_export))
+            if options.all_to_ref_only:
+                alignments = workflow.start(Job.wrapJobFn(map_all_to_ref, asms, options, previous, fasta_indexes))
+            else:
+                alignments = workflow.start(Job.wrapJobFn(map_all_to_ref_and_get_poor_mappings, asms, fasta_indexes, options, previous))
 
         else:
             alignments = workflow.restart()
@@ -204,8 +884,49 @@ def main():
             workflow.exportFile(alignments[3], 'file://' + os.path.abspath("debug_paf_mappings.txt"))
 
         ## Save alignments:
-        workflow.exportFile(alignments[0], 'file://' + os.path.abspath(options.primary))
-        workflow.exportFile(alignments[1], 'file://' + os.path.abspath(options.secondary))
+        export_lastz_mappings(workflow, alignments[0], options.primary, options)
+        export_lastz_mappings(workflow, alignments[1], options.secondary, options)
+        if options.depth_track:
+            # the depth outputs come just before the outputs saved to --manifest_dir.
+            for suffix, depth_file in alignments[-2 if run_manifest is not None else -1].items():
+                workflow.exportFile(depth_file, 'file://' + os.path.abspath(options.depth_track + suffix))
+        if run_manifest is not None:
+            manifest.export_outputs(workflow, alignments[-1], previous, previous_manifest, run_manifest, options.manifest_dir)
+
+        ## Report the performance of the run:
+        if report:
+            job_metrics = [import_metrics] + instrumentation.collect_metrics(options.jobStore)
+            if options.mapping_cache_dir:
+                print("mapping cache:", sum(metrics["records"].get("cache_hits", 0) for metrics in job_metrics), "hits,",
+                      sum(metrics["records"].get("cache_misses", 0) for metrics in job_metrics), "misses.")
+            if options.report:
+                instrumentation.write_report(job_metrics, options.report)
+            if options.critical_path_summary:
+                instrumentation.write_critical_path_summary(job_metrics, options.critical_path_summary)
+
+    if report and clean in ("onSuccess", "always"):
+        Toil.resumeJobStore(options.jobStore).destroy()
+
+def main_local(options):
+    """
+    main() for --local_fast.
+    """
+    for option in ("shard_size", "mapping_cache_dir", "debug_export", "manifest_dir", "update"):
+        if getattr(options, option):
+            print("WARNING: --" + option + " is ignored with --local_fast.")
+    if options.intermediate_format != "lastz":
+        # minimap2's output is piped straight into the conversion to lastz cigars.
+        print("WARNING: --intermediate_format is ignored with --local_fast.")
+
+    with instrumentation.measure("import", "deduplicate_asms") as dedup_metrics:
+        asms, fasta_indexes = deduplicate_asms(options)
+
+    job_metrics = [dedup_metrics] + local_executor.run_local(asms, options, MINIMAP2_INDEX_ARGS, MINIMAP2_MAP_ARGS, fasta_indexes)
+
+    if options.report:
+        instrumentation.write_report(job_metrics, options.report)
+    if options.critical_path_summary:
+        instrumentation.write_critical_path_summary(job_metrics, options.critical_path_summary)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,162 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from src import mapping_cache
+
+try:
+    import mappy
+except ImportError:
+    mappy = None
+
+# Aligner backends (--aligner): how assemblies are indexed and mapped.
+#
+# minimap2 runs the minimap2 binary, which writes the paf to disk for the conversion to read
+# back. mappy maps in process with minimap2's python binding instead: the index is loaded
+# once per worker process, the contigs of the query are mapped by a pool of threads (mappy
+# releases the GIL while it maps), and the paf lines of their mappings stream straight into
+# the conversion to lastz cigars, the paf being written in the same pass. This saves the
+# process spawn and the paf round trip, which matter for many small assemblies.
+#
+# The mappings are minimap2's, with two differences in the paf lines: mappy doesn't report
+# the alignment score, so the AS tag is computed from the cigar and the scoring of the
+# preset (ambiguous bases are scored as mismatches), and mappy doesn't flag inversions, so
+# there are no tp:A:I mappings.
+
+BACKENDS = ["minimap2", "mappy"]
+
+# (match, mismatch, gap open, gap extension, long gap open, long gap extension) scores of minimap2's presets: a gap of
+# length l costs min(gap open + l * gap extension, long gap open + l * long gap extension).
+PRESET_SCORING = {"asm5": (1, 19, 39, 3, 81, 1),
+                  "asm10": (1, 9, 16, 2, 41, 1),
+                  "asm20": (1, 4, 6, 2, 26, 1)}
+# bases of query contigs read and mapped at a time, like minimap2's -K.
+BATCH_BASES = 500 * 1000**2
+
+# the index loaded by this worker process, reused by the mappings to it that the process runs.
+loaded_indexes = dict()
+
+def check_backend(aligner):
+    """
+    Raises a RuntimeError if aligner can't run here.
+    """
+    if aligner == "mappy" and mappy is None:
+        raise RuntimeError("--aligner mappy needs minimap2's python binding: pip install mappy")
+
+def get_version(aligner):
+    """
+    The version of the aligner, part of the mapping cache keys and of the run manifest's settings.
+    """
+    if aligner == "mappy":
+        return "mappy " + mappy.__version__
+    return mapping_cache.get_minimap2_version()
+
+def get_preset(minimap2_args):
+    """
+    Returns the preset (-x) of minimap2_args, e.g. asm5 for ["-cx", "asm5"].
+    """
+    for i, arg in enumerate(minimap2_args[:-1]):
+        if arg.startswith("-") and not arg.startswith("--") and arg.endswith("x"):
+            return minimap2_args[i + 1]
+    raise ValueError("No preset in the minimap2 arguments " + " ".join(minimap2_args))
+
+def build_index(fasta, index, preset, threads=1):
+    """
+    Writes the minimap2 index of fasta with preset to index, with mappy.
+    """
+    if not mappy.Aligner(fasta, preset=preset, n_threads=threads, fn_idx_out=index):
+        raise RuntimeError("mappy failed to index " + fasta)
+
+def load_index(index, preset, key=None):
+    """
+    Returns the mappy.Aligner of the minimap2 index file index, mapping with preset. The
+    last index loaded by the process is kept, under key if given (e.g. the global file of
+    the index, whose local path changes from job to job), otherwise under its path.
+    """
+    key = (key or index, preset)
+    if key not in loaded_indexes:
+        # only one index is held at a time.
+        loaded_indexes.clear()
+        aligner = mappy.Aligner(index, preset=preset)
+        if not aligner:
+            raise RuntimeError("mappy failed to load the minimap2 index " + index)
+        loaded_indexes[key] = aligner
+    return loaded_indexes[key]
+
+def map_fasta(aligner, fasta, threads=1, scoring=None):
+    """
+    Maps the contigs of fasta with aligner (see load_index), threads at a time, and yields
+    the paf lines of their mappings in the order minimap2 writes them. If scoring (see
+    PRESET_SCORING) is given, the lines have an AS tag.
+    """
+    buffers = threading.local()
+    def map_contig(contig):
+        if not hasattr(buffers, "buffer"):
+            buffers.buffer = mappy.ThreadBuffer()
+        name, seq = contig
+        return [get_paf_line(name, len(seq), hit, scoring) for hit in aligner.map(seq, buf=buffers.buffer)]
+
+    with ThreadPoolExecutor(threads) as executor:
+        for batch in read_batches(fasta):
+            for lines in executor.map(map_contig, batch):
+                yield from lines
+
+def read_batches(fasta):
+    """
+    Yields lists of the (name, sequence) of the contigs of fasta, of about BATCH_BASES bases each.
+    """
+    batch, batch_bases = list(), 0
+    for name, seq, qual in mappy.fastx_read(fasta):
+        batch.append((name, seq))
+        batch_bases += len(seq)
+        if batch_bases >= BATCH_BASES:
+            yield batch
+            batch, batch_bases = list(), 0
+    if batch:
+        yield batch
+
+def get_paf_line(query, query_length, hit, scoring=None):
+    """
+    Returns the paf line (with the trailing newline) of the mappy.Alignment hit of query.
+    """
+    fields = [query, str(query_length), str(hit.q_st), str(hit.q_en), "+" if hit.strand > 0 else "-", hit.ctg, str(hit.ctg_len),
+              str(hit.r_st), str(hit.r_en), str(hit.mlen), str(hit.blen), str(hit.mapq), "NM:i:" + str(hit.NM)]
+    if scoring is not None:
+        fields.append("AS:i:" + str(get_score(hit, scoring)))
+    fields.append("tp:A:" + ("P" if hit.is_primary else "S"))
+    fields.append("cg:Z:" + hit.cigar_str)
+    return "\t".join(fields) + "\n"
+
+def get_score(hit, scoring):
+    """
+    The alignment score of hit (a mappy.Alignment) with scoring (see PRESET_SCORING), as
+    minimap2 computes it for the AS tag, but for ambiguous bases.
+    """
+    match, mismatch = scoring[:2]
+    aligned = 0
+    score = 0
+    for length, op in hit.cigar:
+        if op == 0:
+            aligned += length
+        elif op in (1, 2):
+            score -= get_gap_cost(length, scoring)
+    return score + match * hit.mlen - mismatch * (aligned - hit.mlen)
+
+def get_gap_cost(length, scoring):
+    """
+    The cost of a gap of length bases with scoring (see PRESET_SCORING).
+    """
+    match, mismatch, gap_open, gap_extension, long_gap_open, long_gap_extension = scoring
+    return min(gap_open + length * gap_extension, long_gap_open + length * long_gap_extension)
+
+def tee_paf(paf_lines, paf_file):
+    """
+    Yields paf_lines, writing them to paf_file on the way.
+    """
+    with open(paf_file, "w") as outf:
+        for line in paf_lines:
+            outf.write(line)
+            yield line
+
+def write_paf(paf_lines, paf_file):
+    with open(paf_file, "w") as outf:
+        outf.writelines(paf_lines)
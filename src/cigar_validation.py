@@ -0,0 +1,257 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from src import compression
+from src import fasta_index
+from src import instrumentation
+
+# Validation of lastz cigar outputs (--validate_outputs): every line must be a well-formed
+# "cigar: query_id query_start query_end query_strand target_id target_start target_end +
+# score [op len]..." line whose cigar spans exactly its query and target coordinates, with
+# its query coordinates in the order of its strand (see paf_to_lastz.paf_line_to_lastz),
+# and with both intervals within the lengths of their contigs.
+#
+# The files are read in batches of about BATCH_BYTES bytes of whole lines, which are
+# validated by a pool of worker processes. Each batch is parsed with numpy, without
+# splitting it into python strings: tokens are found from the positions of the spaces and
+# newlines, numbers are parsed from their digits all at once, and the spans of the cigars
+# are summed per line with np.bincount.
+
+# bytes of lines read and validated at once. Validating a batch takes about 50 times its size in memory.
+BATCH_BYTES = 1024**2
+# problem lines reported in the summary.
+MAX_EXAMPLES = 10
+# longest number parsed; longer ones would overflow int64.
+MAX_DIGITS = 18
+# contig names longer than this are looked up one line at a time, rather than as rows of a padded array.
+MAX_NAME_ROW = 256
+
+SPACE, NEWLINE = ord(" "), ord("\n")
+CIGAR_TAG = np.frombuffer(b"cigar:", dtype=np.uint8)
+VALID_OPS = np.zeros(256, dtype=bool)
+QUERY_OPS = np.zeros(256, dtype=np.int64)
+TARGET_OPS = np.zeros(256, dtype=np.int64)
+for op in b"MIDNSHP=X":
+    VALID_OPS[op] = True
+for op in b"MIS=X":
+    QUERY_OPS[op] = 1
+for op in b"MDN=X":
+    TARGET_OPS[op] = 1
+# the kinds of problems, in the order they're reported.
+PROBLEMS = ["malformed", "strand", "query_span", "target_span", "unknown_contig", "query_bounds", "target_bounds"]
+
+@instrumentation.instrumented("validation")
+def validate_outputs(job, lastz_files, fasta_indexes=None):
+    """
+    Validates the [primary, secondary] lastz cigar files (global files), with as many
+    processes as the job has cores. fasta_indexes (key: asm_id, value: global file of its
+    fasta index, as imported by import_asms) give the contig lengths; without them, the
+    coordinates aren't checked against them. Raises a RuntimeError with the summary of
+    the problems if any are found, which fails the workflow.
+    """
+    contig_lengths = None
+    if fasta_indexes:
+        contig_lengths = get_contig_lengths(fasta_index.read_index(job.fileStore.readGlobalFile(fai_file)) for fai_file in fasta_indexes.values())
+    local_files = {name: job.fileStore.readGlobalFile(lastz_file) for name, lastz_file in zip(["primary", "secondary"], lastz_files)}
+    summary = validate_lastz_files(local_files, contig_lengths, int(job.cores))
+    instrumentation.count_records(job, lines=summary["lines"], problem_lines=summary["problem_lines"])
+    if summary["problem_lines"]:
+        raise RuntimeError(format_summary(summary))
+    job.log(format_summary(summary))
+
+def get_contig_lengths(indexes):
+    """
+    Returns a dictionary with key: contig id (as bytes), value: contig length, of all the
+    contigs of indexes (fasta indexes, see src/fasta_index.py).
+    """
+    contig_lengths = dict()
+    for index in indexes:
+        contig_lengths.update((entry.name.encode(), entry.length) for entry in index)
+    return contig_lengths
+
+def validate_lastz_files(lastz_files, contig_lengths=None, processes=1, batch_bytes=BATCH_BYTES):
+    """
+    Validates the lines of the local lastz cigar files lastz_files (key: name used in the
+    summary, value: path; possibly gzip compressed) in batches, in processes worker
+    processes. Returns the summary: a dictionary of the number of lines and of lines with
+    problems, the number of lines with each kind of problem (see PROBLEMS) and up to
+    MAX_EXAMPLES (name, line number, problems, line) examples of lines with problems.
+    """
+    summary = {"lines": 0, "problem_lines": 0, "problems": {problem: 0 for problem in PROBLEMS}, "examples": list()}
+    def add_batch_summary(name, first_line, batch_summary):
+        summary["lines"] += batch_summary["lines"]
+        summary["problem_lines"] += batch_summary["problem_lines"]
+        for problem, count in batch_summary["problems"].items():
+            summary["problems"][problem] += count
+        for line_number, problems, line in batch_summary["examples"][:MAX_EXAMPLES - len(summary["examples"])]:
+            summary["examples"].append((name, first_line + line_number, problems, line))
+
+    if processes <= 1:
+        for name, lastz_file in lastz_files.items():
+            for first_line, batch in read_batches(lastz_file, batch_bytes):
+                add_batch_summary(name, first_line, validate_batch(batch, contig_lengths))
+        return summary
+
+    with ProcessPoolExecutor(processes, initializer=set_worker_contig_lengths, initargs=(contig_lengths,)) as executor:
+        pending = list()
+        for name, lastz_file in lastz_files.items():
+            for first_line, batch in read_batches(lastz_file, batch_bytes):
+                # at most two batches per process are held in memory, waiting to be validated.
+                if len(pending) >= 2 * processes:
+                    done_name, done_first_line, future = pending.pop(0)
+                    add_batch_summary(done_name, done_first_line, future.result())
+                pending.append((name, first_line, executor.submit(validate_worker_batch, batch)))
+        for name, first_line, future in pending:
+            add_batch_summary(name, first_line, future.result())
+    return summary
+
+def read_batches(lastz_file, batch_bytes=BATCH_BYTES):
+    """
+    Yields (number of the first line, bytes of whole lines) batches of about batch_bytes
+    bytes of lastz_file, which may be gzip compressed. Line numbers start at 1.
+    """
+    first_line = 1
+    with compression.open_input(lastz_file, "rb") as inf:
+        while True:
+            batch = inf.read(batch_bytes)
+            if not batch:
+                break
+            if not batch.endswith(b"\n"):
+                batch += inf.readline()
+            yield first_line, batch
+            first_line += batch.count(b"\n") + (not batch.endswith(b"\n"))
+
+# the contig lengths of the worker processes of validate_lastz_files, sent once rather than with every batch.
+worker_contig_lengths = None
+
+def set_worker_contig_lengths(contig_lengths):
+    global worker_contig_lengths
+    worker_contig_lengths = contig_lengths
+
+def validate_worker_batch(batch):
+    return validate_batch(batch, worker_contig_lengths)
+
+def get_tokens(buf):
+    """
+    Returns the start and end (exclusive) offsets of the tokens (runs of bytes other than
+    spaces and newlines) of buf, a uint8 array of whole lines.
+    """
+    separator = (buf == SPACE) | (buf == NEWLINE)
+    token = ~separator
+    starts = np.flatnonzero(token & np.concatenate(([True], separator[:-1])))
+    ends = np.flatnonzero(token & np.concatenate((separator[1:], [True]))) + 1
+    return starts, ends
+
+def parse_numbers(buf, starts, ends):
+    """
+    Parses the decimal numbers of buf[starts[i]:ends[i]] all at once, a digit of every
+    number at a time. Returns (values, valid), where valid is False for tokens that aren't
+    non-negative numbers of at most MAX_DIGITS digits.
+    """
+    lengths = ends - starts
+    values = np.zeros(len(starts), dtype=np.int64)
+    valid = (lengths <= MAX_DIGITS)
+    numbers = np.arange(len(starts))
+    for digit in range(min(MAX_DIGITS, int(lengths.max(initial=0)))):
+        # the numbers that have this digit.
+        numbers = numbers[lengths[numbers] > digit]
+        digits = buf[starts[numbers] + digit].astype(np.int64) - ord("0")
+        valid[numbers] &= (digits >= 0) & (digits <= 9)
+        values[numbers] = values[numbers] * 10 + digits
+    return values, valid
+
+def get_contig_lengths_of_tokens(batch, buf, starts, ends, contig_lengths):
+    """
+    Returns the lengths in contig_lengths of the contigs named by the tokens, or -1 for
+    unknown contigs. Each distinct name is looked up once: the names are compared as rows
+    of their bytes, padded to the longest name.
+    """
+    lengths = ends - starts
+    width = int(lengths.max(initial=0))
+    if not len(starts) or width > MAX_NAME_ROW:
+        return np.array([contig_lengths.get(batch[start:end], -1) for start, end in zip(starts.tolist(), ends.tolist())], dtype=np.int64)
+    offsets = np.arange(width)
+    rows = np.where(offsets < lengths[:, None], buf[np.minimum(starts[:, None] + offsets, len(buf) - 1)], 0)
+    rows = np.ascontiguousarray(rows).view(np.dtype((np.void, width))).ravel()
+    names, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    name_lengths = np.array([contig_lengths.get(batch[starts[i]:ends[i]], -1) for i in first.tolist()], dtype=np.int64)
+    return name_lengths[inverse.ravel()]
+
+def validate_batch(batch, contig_lengths=None):
+    """
+    Validates batch, bytes of whole lastz cigar lines. Returns its summary, as in
+    validate_lastz_files, with line numbers counted from 0 in the batch.
+    """
+    if not batch.endswith(b"\n"):
+        batch += b"\n"
+    buf = np.frombuffer(batch, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == NEWLINE)
+    line_count = len(newlines)
+    starts, ends = get_tokens(buf)
+    token_lines = np.searchsorted(newlines, starts)
+    token_counts = np.bincount(token_lines, minlength=line_count)
+    first_tokens = np.cumsum(token_counts) - token_counts
+    problems = {problem: np.zeros(line_count, dtype=bool) for problem in PROBLEMS}
+
+    # the fixed fields, and an even number of cigar tokens.
+    malformed = problems["malformed"]
+    malformed |= (token_counts < 10) | ((token_counts - 10) % 2 == 1)
+    lines = np.flatnonzero(~malformed)
+    field = lambda i: first_tokens[lines] + i
+    tag_bytes = buf[np.minimum(starts[field(0)][:, None] + np.arange(len(CIGAR_TAG)), len(buf) - 1)]
+    malformed[lines] |= (ends[field(0)] - starts[field(0)] != len(CIGAR_TAG)) | ~np.all(tag_bytes == CIGAR_TAG, axis=1)
+    strands = buf[starts[field(4)]]
+    malformed[lines] |= (ends[field(4)] - starts[field(4)] != 1) | ((strands != ord("+")) & (strands != ord("-")))
+    malformed[lines] |= (ends[field(8)] - starts[field(8)] != 1) | (buf[starts[field(8)]] != ord("+"))
+
+    # the numbers: query_start, query_end, target_start, target_end, score, then the length of each cigar op.
+    numbers = [field(i) for i in (2, 3, 6, 7, 9)]
+    positions = np.arange(len(starts)) - first_tokens[token_lines]
+    cigar_lengths = np.flatnonzero(~malformed[token_lines] & (positions >= 10) & (positions % 2 == 1))
+    values, valid = parse_numbers(buf, starts[np.concatenate(numbers + [cigar_lengths])], ends[np.concatenate(numbers + [cigar_lengths])])
+    # lines have several numbers, so their problems are counted per line.
+    malformed |= np.bincount(np.concatenate([lines] * len(numbers) + [token_lines[cigar_lengths]]), weights=~valid, minlength=line_count) > 0
+    ops = buf[starts[cigar_lengths - 1]]
+    malformed |= np.bincount(token_lines[cigar_lengths], weights=(ends[cigar_lengths - 1] - starts[cigar_lengths - 1] != 1) | ~VALID_OPS[ops],
+                             minlength=line_count) > 0
+
+    # only lines that could be parsed are checked further.
+    query_start, query_end, target_start, target_end = [values[i * len(lines):(i + 1) * len(lines)] for i in range(4)]
+    op_lengths = values[len(numbers) * len(lines):]
+    query_spans = np.bincount(token_lines[cigar_lengths], weights=op_lengths * QUERY_OPS[ops], minlength=line_count)[lines].astype(np.int64)
+    target_spans = np.bincount(token_lines[cigar_lengths], weights=op_lengths * TARGET_OPS[ops], minlength=line_count)[lines].astype(np.int64)
+    parsed = ~malformed[lines]
+    reverse = strands == ord("-")
+    problems["strand"][lines] = parsed & np.where(reverse, query_start < query_end, query_start > query_end)
+    problems["query_span"][lines] = parsed & (np.abs(query_end - query_start) != query_spans)
+    problems["target_span"][lines] = parsed & (target_end - target_start != target_spans)
+
+    if contig_lengths is not None:
+        query_lengths = get_contig_lengths_of_tokens(batch, buf, starts[field(1)], ends[field(1)], contig_lengths)
+        target_lengths = get_contig_lengths_of_tokens(batch, buf, starts[field(5)], ends[field(5)], contig_lengths)
+        problems["unknown_contig"][lines] = parsed & ((query_lengths < 0) | (target_lengths < 0))
+        problems["query_bounds"][lines] = parsed & (query_lengths >= 0) & (np.maximum(query_start, query_end) > query_lengths)
+        problems["target_bounds"][lines] = parsed & (target_lengths >= 0) & (target_end > target_lengths)
+
+    any_problem = np.zeros(line_count, dtype=bool)
+    for problem_lines in problems.values():
+        any_problem |= problem_lines
+    examples = list()
+    for line in np.flatnonzero(any_problem)[:MAX_EXAMPLES].tolist():
+        line_start = newlines[line - 1] + 1 if line else 0
+        examples.append((line, [problem for problem in PROBLEMS if problems[problem][line]], batch[line_start:newlines[line]].decode(errors="replace")))
+    return {"lines": line_count, "problem_lines": int(any_problem.sum()),
+            "problems": {problem: int(problem_lines.sum()) for problem, problem_lines in problems.items()}, "examples": examples}
+
+def format_summary(summary):
+    """
+    Returns the summary of validate_lastz_files as text.
+    """
+    if not summary["problem_lines"]:
+        return "lastz cigar validation: all " + str(summary["lines"]) + " lines are valid."
+    out = ["lastz cigar validation: " + str(summary["problem_lines"]) + " of " + str(summary["lines"]) + " lines have problems:"]
+    out.extend("    " + problem + ": " + str(count) for problem, count in summary["problems"].items() if count)
+    out.append("first lines with problems:")
+    out.extend("    " + name + ":" + str(line_number) + " (" + ", ".join(problems) + "): " + line for name, line_number, problems, line in summary["examples"])
+    return "\n".join(out)
@@ -0,0 +1,207 @@
+import contextlib
+import re
+import tempfile
+
+from src import aligners
+from src import compression
+from src import paf_to_lastz
+from src import segments
+from src import sorted_output
+
+# Merging of collinear mappings (--merge_collinear_gap). minimap2 often breaks one
+# homologous region into several mappings that follow each other on both the query and the
+# target, separated by small gaps (at larger indels, or diverged stretches it didn't
+# extend through), and each becomes its own lastz cigar line.
+#
+# The paf lines of a mapping job are sorted by query, target, strand and type (tp tag), then
+# target start, with the external merge sort of src/sorted_output.py, holding about
+# --sort_buffer_size bytes of lines in memory. Each mapping is then joined to the one before
+# it in the same group if it starts at most --merge_collinear_gap bases after it ends on
+# both the query and the target, in the direction of the strand. The gaps between them are
+# stitched into the cigar as an insertion of the query gap and a deletion of the target
+# gap, so the cigar still spans exactly the coordinates of the merged mapping.
+#
+# Merged paf lines have the summed matches, alignment block lengths and NM (counting the
+# bases of the gaps), the lower of the mapping qualities, and the summed alignment scores
+# less the cost of the gaps under the scoring of the preset (see aligners.PRESET_SCORING).
+# The other tags (cm, s1, de, ...) no longer describe the mapping, so merged lines only
+# have NM, AS, tp and cg. Mappings that aren't merged are unchanged, but all come out in
+# the sorted order instead of minimap2's.
+
+TP_TAG_RE = re.compile(r"\ttp:A:(\S)")
+NM_TAG_RE = re.compile(r"\tNM:i:(\d+)")
+
+def from_options(options, map_args):
+    """
+    Returns a new CollinearMerger for --merge_collinear_gap, scoring gaps with the preset
+    of the minimap2 arguments map_args, or None if merging is off.
+    """
+    if not options.merge_collinear_gap:
+        return None
+    return CollinearMerger(options.merge_collinear_gap, options.sort_buffer_size, aligners.PRESET_SCORING.get(aligners.get_preset(map_args)))
+
+def get_sort_key(line):
+    """
+    Paf lines are sorted by query, target, strand and type, then by target start and end
+    and query start.
+    """
+    parsed = line.split("\t", 9)
+    kind = TP_TAG_RE.search(line)
+    return parsed[0], parsed[5], parsed[4], kind.group(1) if kind is not None else "", int(parsed[7]), int(parsed[8]), int(parsed[2])
+
+def append_op(cigar, length, op):
+    """
+    Returns cigar followed by length op, adding length to the last op of cigar if it's op.
+    """
+    if not length:
+        return cigar
+    if cigar.endswith(op):
+        digits = len(cigar) - 1
+        while digits > 0 and cigar[digits - 1].isdigit():
+            digits -= 1
+        return cigar[:digits] + str(int(cigar[digits:-1]) + length) + op
+    return cigar + str(length) + op
+
+def join_cigars(left, query_gap, target_gap, right):
+    """
+    Returns the cigar of left, then an insertion of query_gap and a deletion of
+    target_gap bases, then right, with adjacent ops of the same kind combined.
+    """
+    cigar = append_op(append_op(left, query_gap, "I"), target_gap, "D")
+    first = paf_to_lastz.CIGAR_OP_RE.match(right)
+    if first is None:
+        return cigar
+    return append_op(cigar, int(first.group(1)), first.group(2)) + right[first.end():]
+
+class PafMapping:
+    """
+    The fields of a paf line that are merged. line is the original line until the mapping
+    is joined to another one.
+    """
+    __slots__ = ["line", "query", "query_length", "query_start", "query_end", "strand", "target", "target_length",
+                 "target_start", "target_end", "matches", "block_length", "mapq", "kind", "edit_distance", "score", "cigar"]
+
+    def __init__(self, line):
+        self.line = line
+        parsed = line.split("\t", 12)
+        self.query, self.query_length = parsed[0], parsed[1]
+        self.query_start, self.query_end = int(parsed[2]), int(parsed[3])
+        self.strand = parsed[4]
+        self.target, self.target_length = parsed[5], parsed[6]
+        self.target_start, self.target_end = int(parsed[7]), int(parsed[8])
+        self.matches, self.block_length, self.mapq = int(parsed[9]), int(parsed[10]), int(parsed[11])
+        kind = TP_TAG_RE.search(line)
+        self.kind = kind.group(1) if kind is not None else None
+        edit_distance = NM_TAG_RE.search(line)
+        self.edit_distance = int(edit_distance.group(1)) if edit_distance is not None else None
+        score = paf_to_lastz.AS_TAG_RE.search(line)
+        self.score = int(score.group(1)) if score is not None else None
+        cigar = paf_to_lastz.CG_TAG_RE.search(line)
+        self.cigar = cigar.group(1) if cigar is not None else None
+
+    def get_gaps(self, other, max_gap):
+        """
+        Returns the (query, target) gaps between this mapping and other, which starts after
+        it on the target, if other can be joined to it: the same query, target, strand and
+        type, both with cigars, and gaps of 0 to max_gap bases. Otherwise, returns None.
+        """
+        if (other.query != self.query or other.target != self.target or other.strand != self.strand or other.kind != self.kind
+                or self.cigar is None or other.cigar is None):
+            return None
+        target_gap = other.target_start - self.target_end
+        if self.strand == "+":
+            query_gap = other.query_start - self.query_end
+        else:
+            # "-" strand mappings go backwards along the query as they go forwards along the target.
+            query_gap = self.query_start - other.query_end
+        if not (0 <= query_gap <= max_gap and 0 <= target_gap <= max_gap):
+            return None
+        return query_gap, target_gap
+
+    def join(self, other, query_gap, target_gap, scoring=None):
+        """
+        Extends this mapping with other, across the gaps returned by get_gaps.
+        """
+        gap_bases = query_gap + target_gap
+        self.line = None
+        self.query_start = min(self.query_start, other.query_start)
+        self.query_end = max(self.query_end, other.query_end)
+        self.target_end = other.target_end
+        self.matches += other.matches
+        self.block_length += other.block_length + gap_bases
+        self.mapq = min(self.mapq, other.mapq)
+        if self.edit_distance is not None and other.edit_distance is not None:
+            self.edit_distance += other.edit_distance + gap_bases
+        else:
+            self.edit_distance = None
+        if self.score is not None and other.score is not None:
+            self.score += other.score
+            if scoring is not None:
+                self.score -= sum(aligners.get_gap_cost(gap, scoring) for gap in (query_gap, target_gap) if gap)
+            # AS tags are never negative.
+            self.score = max(0, self.score)
+        else:
+            self.score = None
+        self.cigar = join_cigars(self.cigar, query_gap, target_gap, other.cigar)
+
+    def get_line(self):
+        if self.line is not None:
+            return self.line
+        fields = [self.query, self.query_length, str(self.query_start), str(self.query_end), self.strand, self.target, self.target_length,
+                  str(self.target_start), str(self.target_end), str(self.matches), str(self.block_length), str(self.mapq)]
+        if self.edit_distance is not None:
+            fields.append("NM:i:" + str(self.edit_distance))
+        if self.score is not None:
+            fields.append("AS:i:" + str(self.score))
+        if self.kind is not None:
+            fields.append("tp:A:" + self.kind)
+        fields.append("cg:Z:" + self.cigar)
+        return "\t".join(fields) + "\n"
+
+class CollinearMerger:
+    """
+    Merges the collinear mappings of the paf lines of a mapping job (see merge). merged
+    counts the mappings that were joined to the one before them. Each converted paf needs
+    its own merger.
+    """
+    def __init__(self, max_gap, buffer_size, scoring=None):
+        self.max_gap = max_gap
+        self.buffer_size = buffer_size
+        self.scoring = scoring
+        self.merged = 0
+
+    def merge(self, paf_file, lift_segments=False, tmp_dir=None, paf_lines=None):
+        """
+        Yields the paf lines of the local paf_file (possibly gzip compressed), or of
+        paf_lines if given, sorted and with collinear mappings merged. If lift_segments,
+        mappings of segments are lifted back to their contig coordinates first, so that
+        mappings of neighbouring segments can be merged. The sorted runs are written to a
+        temporary directory in tmp_dir, which is deleted once the lines are exhausted.
+        """
+        with (contextlib.nullcontext(paf_lines) if paf_lines is not None else compression.open_input(paf_file)) as inf, \
+                tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+            lines = (line if line.endswith("\n") else line + "\n" for line in inf)
+            if lift_segments:
+                lines = (segments.lift_paf_line(line) for line in lines)
+            sorted_file = sorted_output.merge_runs(sorted_output.write_runs(lines, run_dir, self.buffer_size, get_sort_key), run_dir, get_sort_key)
+            with open(sorted_file) as sortedf:
+                yield from self.join_mappings(sortedf)
+
+    def join_mappings(self, sorted_lines):
+        """
+        Yields sorted_lines (sorted by get_sort_key), joining each mapping to the one
+        before it if they are collinear.
+        """
+        previous = None
+        for line in sorted_lines:
+            mapping = PafMapping(line)
+            if previous is not None:
+                gaps = previous.get_gaps(mapping, self.max_gap)
+                if gaps is not None:
+                    previous.join(mapping, *gaps, self.scoring)
+                    self.merged += 1
+                    continue
+                yield previous.get_line()
+            previous = mapping
+        if previous is not None:
+            yield previous.get_line()
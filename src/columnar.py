@@ -0,0 +1,280 @@
+from array import array
+import contextlib
+import json
+import os
+import re
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+from src import compression
+from src import instrumentation
+from src import paf_to_lastz
+from src import segments
+
+# A compact columnar intermediate format for the mappings of one mapping job
+# (--intermediate_format columnar), in place of the [primary, secondary] lastz cigar files.
+# The paf is parsed once, in the mapping job; every later step works on fixed-width numpy
+# columns, and lastz cigar text is only written when the mappings are concatenated into
+# --primary and --secondary.
+#
+# A file is:
+#     - MAGIC, then the byte offset of the header (little-endian uint64).
+#     - the records: a RECORD_DTYPE array, one element per mapping, in paf order.
+#     - the cigars: all the cigar operations of all the mappings, packed as minimap2 packs
+#       them (length << 4 | op code, op codes as in CIGAR_OPS) in a uint32 array. Record i's
+#       operations are cigars[cigar_offset:cigar_offset + cigar_length].
+#     - the header: json of the number of records and cigar operations, the offset of the
+#       cigars and the contig names. Query and target contig names are interned: the query
+#       and target columns are indexes into the names.
+# Both arrays are read with np.memmap (see ColumnarMappings), so only the columns and
+# records that are used are read from disk.
+
+MAGIC = b"RBCAMAP1"
+DATA_OFFSET = len(MAGIC) + 8
+SUFFIX = ".columnar"
+
+# 8-byte fields first, so that they stay aligned.
+RECORD_DTYPE = np.dtype([("query_length", "<i8"), ("query_start", "<i8"), ("query_end", "<i8"),
+                         ("target_length", "<i8"), ("target_start", "<i8"), ("target_end", "<i8"),
+                         ("matches", "<i8"), ("block_length", "<i8"), ("score", "<i8"), ("cigar_offset", "<u8"),
+                         ("query", "<u4"), ("target", "<u4"), ("cigar_length", "<u4"),
+                         ("strand", "i1"), ("mapq", "u1"), ("type", "u1")])
+CIGAR_OPS = "MIDNSHP=X"
+CIGAR_OP_CODES = {op: code for code, op in enumerate(CIGAR_OPS)}
+# the tp:A tag, as its character code; 0 if the line has none.
+TP_TAG_RE = re.compile(r"\ttp:A:(\S)")
+PRIMARY_TYPES = [ord("P"), ord("I")]
+# records are parsed and written in chunks of this many, to bound memory.
+CHUNK_RECORDS = 65536
+
+def paf_to_columnar(job, paf_file, lift_segments=False, secondary_filter=None, coverage=None, paf_lines=None):
+    """
+    The --intermediate_format columnar counterpart of paf_to_lastz.paf_to_lastz: writes
+    the mappings of the local paf_file (possibly gzip compressed) to a columnar file,
+    lifting segments, filtering secondary mappings, recording coverage and reading
+    paf_lines instead of paf_file in the same way. Returns the global file.
+    """
+    out_file = job.fileStore.getLocalTempFile()
+    with (contextlib.nullcontext(paf_lines) if paf_lines is not None else compression.open_input(paf_file)) as inf:
+        counts = write_columnar(coverage.observe(inf) if coverage is not None else inf, out_file, lift_segments, secondary_filter)
+    instrumentation.count_records(job, **counts)
+    if counts["skipped"]:
+        print("WARNING: skipped", counts["skipped"], "paf lines without the 'cg' tag while converting to columnar mappings.")
+    return job.fileStore.writeGlobalFile(out_file)
+
+def write_columnar(paf_lines, outfile, lift_segments=False, secondary_filter=None):
+    """
+    Writes paf_lines (any iterable of paf lines) to the columnar file outfile. Mappings are
+    kept, lifted and filtered as in paf_to_lastz.write_lastz_lines, and returns the same
+    counts. Secondary mappings kept by secondary_filter are written once their query is
+    done, so the records of each type are in the order of their lastz cigar lines.
+    """
+    counts = {"primary": 0, "secondary": 0, "skipped": 0}
+    with ColumnarWriter(outfile, lift_segments) as writer:
+        for line in paf_lines:
+            if paf_to_lastz.CG_TAG_RE.search(line) is None:
+                counts["skipped"] += 1
+                continue
+            primary = "tp:A:P" in line or "tp:A:I" in line
+            if secondary_filter is not None:
+                # the filter compares lifted coordinates; the records are lifted by the writer, a chunk at a time.
+                kept = secondary_filter.add(segments.lift_paf_line(line) if lift_segments else line, primary, line)
+                for kept_line in kept:
+                    writer.add(kept_line)
+                counts["secondary"] += len(kept)
+            if primary:
+                writer.add(line)
+                counts["primary"] += 1
+            elif secondary_filter is None:
+                writer.add(line)
+                counts["secondary"] += 1
+        if secondary_filter is not None:
+            kept = secondary_filter.finish()
+            for kept_line in kept:
+                writer.add(kept_line)
+            counts["secondary"] += len(kept)
+            counts["filtered"] = secondary_filter.filtered
+    return counts
+
+class ColumnarWriter:
+    """
+    Writes paf lines with a cg tag to a columnar file, a chunk of records at a time. The
+    cigars go to a temporary file next to outfile until the records are all written. If
+    lift_segments, the queries of segment mappings are lifted back to their contigs (as
+    in segments.lift_paf_line), with numpy, one chunk at a time: each name is parsed as a
+    segment name once, when it is interned.
+    """
+    def __init__(self, outfile, lift_segments=False):
+        self.outfile = outfile
+        self.lift_segments = lift_segments
+        self.names = list()
+        self.name_ids = dict()
+        # by name id: the id of the contig it is lifted to, the offset of the segment in the contig and the contig
+        # length (-1 for names that aren't segments).
+        self.lift_ids = list()
+        self.lift_offsets = list()
+        self.lift_lengths = list()
+        self.rows = list()
+        self.cigars = array("I")
+        self.record_count = 0
+        self.cigar_count = 0
+        self.outf = open(outfile, "wb")
+        self.outf.write(MAGIC + struct.pack("<Q", 0))
+        self.cigarf = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(outfile)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.outf.close()
+            self.cigarf.close()
+
+    def intern(self, name):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            segment = segments.parse_segment_name(name) if self.lift_segments else None
+            # the contig of a segment is interned first.
+            lift_id = self.intern(segment[0]) if segment is not None else len(self.names)
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+            self.lift_ids.append(lift_id)
+            self.lift_offsets.append(segment[1] if segment is not None else 0)
+            self.lift_lengths.append(segment[3] if segment is not None else -1)
+        return name_id
+
+    def add(self, line):
+        parsed = line.rstrip("\n").split("\t", 12)
+        cigar_offset = self.cigar_count + len(self.cigars)
+        for length, op in paf_to_lastz.CIGAR_OP_RE.findall(paf_to_lastz.CG_TAG_RE.search(line).group(1)):
+            # minimap2 packs its cigars in the same way, so its lengths always fit.
+            self.cigars.append(int(length) << 4 | CIGAR_OP_CODES[op])
+        score = paf_to_lastz.AS_TAG_RE.search(line)
+        tp = TP_TAG_RE.search(line)
+        self.rows.append((int(parsed[1]), int(parsed[2]), int(parsed[3]), int(parsed[6]), int(parsed[7]), int(parsed[8]),
+                          int(parsed[9]), int(parsed[10]), int(score.group(1)) if score is not None else 0, cigar_offset,
+                          self.intern(parsed[0]), self.intern(parsed[5]), self.cigar_count + len(self.cigars) - cigar_offset,
+                          -1 if parsed[4] == "-" else 1, int(parsed[11]), ord(tp.group(1)) if tp is not None else 0))
+        if len(self.rows) >= CHUNK_RECORDS:
+            self.flush()
+
+    def flush(self):
+        records = np.array(self.rows, dtype=RECORD_DTYPE)
+        if self.lift_segments and len(records):
+            query = records["query"]
+            offsets = np.array(self.lift_offsets, dtype=np.int64)[query]
+            records["query_start"] += offsets
+            records["query_end"] += offsets
+            lengths = np.array(self.lift_lengths, dtype=np.int64)[query]
+            records["query_length"] = np.where(lengths >= 0, lengths, records["query_length"])
+            records["query"] = np.array(self.lift_ids, dtype=np.uint32)[query]
+        self.outf.write(records.tobytes())
+        self.cigarf.write(self.cigars.tobytes())
+        self.record_count += len(records)
+        self.cigar_count += len(self.cigars)
+        self.rows = list()
+        self.cigars = array("I")
+
+    def close(self):
+        self.flush()
+        cigars_offset = self.outf.tell()
+        self.cigarf.seek(0)
+        shutil.copyfileobj(self.cigarf, self.outf, 16 * 1024**2)
+        self.cigarf.close()
+        header_offset = self.outf.tell()
+        self.outf.write(json.dumps({"records": self.record_count, "cigar_ops": self.cigar_count,
+                                    "cigars_offset": cigars_offset, "names": self.names}).encode())
+        self.outf.seek(len(MAGIC))
+        self.outf.write(struct.pack("<Q", header_offset))
+        self.outf.close()
+
+class ColumnarMappings:
+    """
+    The mappings of a columnar file: records (a read-only memory-mapped RECORD_DTYPE
+    array), cigars (a memory-mapped uint32 array) and names (list of contig names).
+    """
+    def __init__(self, path):
+        with open(path, "rb") as inf:
+            if inf.read(len(MAGIC)) != MAGIC:
+                raise ValueError(path + " isn't a columnar mappings file.")
+            header_offset = struct.unpack("<Q", inf.read(8))[0]
+            inf.seek(header_offset)
+            header = json.loads(inf.read().decode())
+        self.names = header["names"]
+        # np.memmap can't map empty arrays.
+        if header["records"]:
+            self.records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=DATA_OFFSET, shape=(header["records"],))
+        else:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+        if header["cigar_ops"]:
+            self.cigars = np.memmap(path, dtype=np.uint32, mode="r", offset=header["cigars_offset"], shape=(header["cigar_ops"],))
+        else:
+            self.cigars = np.zeros(0, dtype=np.uint32)
+
+    def __len__(self):
+        return len(self.records)
+
+def primary_mask(records):
+    """
+    Returns the boolean mask of the primary (tp:A:P and tp:A:I) records.
+    """
+    return np.isin(records["type"], PRIMARY_TYPES)
+
+def lastz_query_coordinates(records):
+    """
+    Returns the query start and end columns as lastz cigar writes them: reversed for "-"
+    strand mappings (see paf_to_lastz.paf_line_to_lastz).
+    """
+    reverse = records["strand"] < 0
+    return (np.where(reverse, records["query_end"], records["query_start"]),
+            np.where(reverse, records["query_start"], records["query_end"]))
+
+def lastz_lines(mappings, rows=None):
+    """
+    Yields the lastz cigar lines of the records at the indexes rows (all of them by
+    default) of mappings (a ColumnarMappings), in order, as paf_to_lastz.paf_line_to_lastz
+    would write them. The columns are read a chunk of rows at a time.
+    """
+    if rows is None:
+        rows = np.arange(len(mappings))
+    op_names = np.array(list(CIGAR_OPS))
+    for chunk_start in range(0, len(rows), CHUNK_RECORDS):
+        records = mappings.records[rows[chunk_start:chunk_start + CHUNK_RECORDS]]
+        query_starts, query_ends = lastz_query_coordinates(records)
+        columns = zip(records["query"].tolist(), query_starts.tolist(), query_ends.tolist(), records["strand"].tolist(),
+                      records["target"].tolist(), records["target_start"].tolist(), records["target_end"].tolist(),
+                      records["score"].tolist(), records["cigar_offset"].tolist(), records["cigar_length"].tolist())
+        for query, query_start, query_end, strand, target, target_start, target_end, score, cigar_offset, cigar_length in columns:
+            cigar = mappings.cigars[cigar_offset:cigar_offset + cigar_length]
+            ops = [None] * (2 * len(cigar))
+            ops[::2] = op_names[cigar & 15].tolist()
+            ops[1::2] = (cigar >> 4).astype(str).tolist()
+            yield " ".join(["cigar:", mappings.names[query], str(query_start), str(query_end), "+" if strand > 0 else "-",
+                            mappings.names[target], str(target_start), str(target_end), "+", str(score)] + ops) + "\n"
+
+def write_lastz(columnar_file, primaryf, secondaryf):
+    """
+    Writes the mappings of columnar_file as lastz cigar lines to the open file primaryf
+    (primary mappings) or secondaryf (the others). Returns the number of primary and
+    secondary mappings written.
+    """
+    mappings = ColumnarMappings(columnar_file)
+    primary = primary_mask(mappings.records)
+    primaryf.writelines(lastz_lines(mappings, np.flatnonzero(primary)))
+    secondaryf.writelines(lastz_lines(mappings, np.flatnonzero(~primary)))
+    return {"primary": int(primary.sum()), "secondary": int(len(primary) - primary.sum())}
+
+def split_columnar_to_lastz(columnar_file, primary_file, secondary_file, compress=False, threads=1):
+    """
+    As paf_to_lastz.split_paf_to_lastz, from a columnar file: writes its primary and secondary mappings
+    to primary_file and secondary_file, gzip compressed if compress. Returns the counts of
+    write_lastz.
+    """
+    with compression.open_output(primary_file, compress, threads=threads) as primaryf, \
+            compression.open_output(secondary_file, compress, threads=threads) as secondaryf:
+        return write_lastz(columnar_file, primaryf, secondaryf)
@@ -0,0 +1,112 @@
+import gzip
+import io
+import os
+import shutil
+import subprocess
+import threading
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+def is_gzipped(path):
+    """
+    Is path gzip compressed? bgzip files are gzip files too.
+    """
+    with open(path, "rb") as inf:
+        return inf.read(2) == GZIP_MAGIC
+
+def open_input(path, mode="r"):
+    """
+    Opens path for reading ("r" or "rb"), transparently decompressing gzip and bgzip
+    files.
+    """
+    if is_gzipped(path):
+        return gzip.open(path, mode + "t" if mode == "r" else mode)
+    return open(path, mode)
+
+def open_output(path, compress=False, mode="w", threads=1):
+    """
+    Opens path for writing ("w" or "wb"). If compress, the output is gzip compressed
+    while it is written, see CompressedOutput.
+    """
+    if compress:
+        return CompressedOutput(path, mode, threads)
+    return open(path, mode)
+
+class CompressedOutput:
+    """
+    A writable file whose contents are gzip compressed away from the writing thread: by
+    pigz with threads threads if it is installed, otherwise by zlib (which releases the
+    GIL while compressing) in a background thread.
+    """
+    def __init__(self, path, mode="w", threads=1):
+        self.process = None
+        self.thread = None
+        self.error = None
+
+        pigz = shutil.which("pigz")
+        if pigz:
+            self.outf = open(path, "wb")
+            self.process = subprocess.Popen([pigz, "-c", "-p", str(max(1, threads))], stdin=subprocess.PIPE, stdout=self.outf)
+            raw = self.process.stdin
+        else:
+            read_fd, write_fd = os.pipe()
+            self.thread = threading.Thread(target=self.compress_pipe, args=(read_fd, path), daemon=True)
+            self.thread.start()
+            raw = open(write_fd, "wb", buffering=1 << 20)
+
+        self.file = raw if "b" in mode else io.TextIOWrapper(raw)
+
+    def compress_pipe(self, read_fd, path):
+        try:
+            with open(read_fd, "rb") as inf, gzip.open(path, "wb", compresslevel=6) as outf:
+                shutil.copyfileobj(inf, outf, 1 << 20)
+        except Exception as e:
+            self.error = e
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def writelines(self, lines):
+        return self.file.writelines(lines)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        if self.process is not None:
+            returncode = self.process.wait()
+            self.outf.close()
+            if returncode:
+                raise RuntimeError("pigz failed with exit code " + str(returncode))
+        else:
+            self.thread.join()
+            if self.error is not None:
+                raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def concatenate_files(infiles, outfile):
+    """
+    Concatenates the bytes of infiles into outfile, without parsing them. Gzip files stay
+    valid when concatenated. Copies are done in the kernel with sendfile where possible.
+    """
+    with open(outfile, "wb") as outf:
+        for infile in infiles:
+            with open(infile, "rb") as inf:
+                size = os.fstat(inf.fileno()).st_size
+                offset = 0
+                try:
+                    while offset < size:
+                        sent = os.sendfile(outf.fileno(), inf.fileno(), offset, size - offset)
+                        if sent == 0:
+                            break
+                        offset += sent
+                except (AttributeError, OSError):
+                    # no sendfile for these files; fall back to large buffered copies.
+                    inf.seek(offset)
+                    outf.seek(0, os.SEEK_END)
+                    shutil.copyfileobj(inf, outf, 16 * 1024**2)
@@ -0,0 +1,185 @@
+from array import array
+
+import numpy as np
+
+from src import compression
+from src import fasta_index
+from src import instrumentation
+from src import resources
+
+# Pangenome depth tracks (--depth_track): for each base of the reference, the number of
+# assemblies with a primary mapping covering it.
+#
+# The target intervals of each assembly's primary mappings to the reference are collected
+# while its paf is converted to lastz cigars (see AssemblyCoverage), so the paf isn't read
+# again. Tracks are run-length encoded: for each reference contig, the starts of the runs of
+# equal depth and their depths, the first run starting at 0. They are built and summed as
+# difference arrays of events: +1 at the start of each interval and -1 at its end for an
+# assembly's coverage, or the change of depth at the start of each run for a sum of tracks.
+# The events are sorted, those at the same position are added, and their cumulative sum
+# gives the depth from each position on. Tracks of assemblies are summed in a tree of jobs
+# of at most MERGE_FANIN tracks each.
+#
+# Track files are compressed .npz files of the contig names and lengths, and the
+# concatenated run starts and depths of all contigs with the offset of each contig's runs.
+
+# tracks summed by each job of the tree of depth_merge jobs.
+MERGE_FANIN = 8
+NPZ_SUFFIX = ".depth.npz"
+BEDGRAPH_SUFFIX = ".bedGraph"
+
+class AssemblyCoverage:
+    """
+    Collects the target intervals of the primary mappings (tp:A:P and tp:A:I) of one
+    assembly's paf lines as they stream through observe.
+    """
+    def __init__(self):
+        # key: target contig, value: [contig length, interval starts, interval ends].
+        self.intervals = dict()
+
+    def observe(self, paf_lines):
+        """
+        Yields the lines of paf_lines, recording the intervals of the primary mappings.
+        """
+        for line in paf_lines:
+            if "tp:A:P" in line or "tp:A:I" in line:
+                parsed = line.split("\t", 9)
+                contig = self.intervals.get(parsed[5])
+                if contig is None:
+                    contig = self.intervals[parsed[5]] = [int(parsed[6]), array("q"), array("q")]
+                contig[1].append(int(parsed[7]))
+                contig[2].append(int(parsed[8]))
+            yield line
+
+    def get_track(self):
+        """
+        Returns the assembly's track: depth 1 where a primary mapping covers the reference,
+        0 elsewhere. A track is a dictionary with key: contig, value: (length, run starts,
+        run depths).
+        """
+        track = dict()
+        for contig, (length, starts, ends) in self.intervals.items():
+            positions = np.concatenate((np.frombuffer(starts, dtype=np.int64), np.frombuffer(ends, dtype=np.int64)))
+            deltas = np.concatenate((np.ones(len(starts), dtype=np.int64), np.full(len(ends), -1, dtype=np.int64)))
+            track[contig] = (length,) + get_runs(length, positions, deltas, max_depth=1)
+        return track
+
+def get_runs(length, positions, deltas, max_depth=None):
+    """
+    Returns the (run starts, run depths) of a contig of length bases from the difference
+    array events: the depth changes by deltas[i] at positions[i]. Depths are capped at
+    max_depth, if given. Events past the end of the contig are ignored.
+    """
+    if length <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint32)
+    positions = np.clip(positions, 0, length)
+    # the events at each distinct position are added up, and a position 0 event anchors the first run.
+    positions, inverse = np.unique(np.concatenate(([0], positions)), return_inverse=True)
+    depths = np.cumsum(np.bincount(inverse.ravel(), weights=np.concatenate(([0], deltas)), minlength=len(positions))).astype(np.int64)
+    if max_depth is not None:
+        depths = np.minimum(depths, max_depth)
+    keep = positions < length
+    positions, depths = positions[keep], depths[keep]
+    # only the starts of runs of a new depth are kept.
+    changed = np.concatenate(([True], depths[1:] != depths[:-1]))
+    return positions[changed].astype(np.int64), depths[changed].astype(np.uint32)
+
+def sum_tracks(tracks):
+    """
+    Returns the sum of tracks, in the order their contigs are first seen.
+    """
+    contigs = dict()
+    for track in tracks:
+        for contig, (length, starts, depths) in track.items():
+            contigs.setdefault(contig, [length, list(), list()])
+            contigs[contig][1].append(starts)
+            # the change of depth at the start of each run.
+            contigs[contig][2].append(np.diff(depths.astype(np.int64), prepend=0))
+    return {contig: (length,) + get_runs(length, np.concatenate(starts), np.concatenate(deltas))
+            for contig, (length, starts, deltas) in contigs.items()}
+
+def order_track(track, contig_lengths):
+    """
+    Returns track with its contigs in the order of contig_lengths (key: contig, value:
+    length, e.g. of the reference's fasta index), adding contigs without any coverage.
+    """
+    ordered = {contig: track.get(contig, (length,) + get_runs(length, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)))
+               for contig, length in contig_lengths.items()}
+    ordered.update((contig, contig_track) for contig, contig_track in track.items() if contig not in ordered)
+    return ordered
+
+def write_track(track, path):
+    contigs = list(track)
+    run_counts = [len(track[contig][1]) for contig in contigs]
+    with open(path, "wb") as outf:
+        np.savez_compressed(outf, names=np.array(contigs, dtype=str), lengths=np.array([track[contig][0] for contig in contigs], dtype=np.int64),
+                            offsets=np.cumsum([0] + run_counts).astype(np.int64),
+                            starts=np.concatenate([track[contig][1] for contig in contigs] + [np.zeros(0, dtype=np.int64)]),
+                            depths=np.concatenate([track[contig][2] for contig in contigs] + [np.zeros(0, dtype=np.uint32)]))
+
+def read_track(path):
+    with np.load(path) as npz:
+        offsets = npz["offsets"]
+        starts, depths = npz["starts"], npz["depths"]
+        return {str(contig): (int(length), starts[offsets[i]:offsets[i + 1]], depths[offsets[i]:offsets[i + 1]])
+                for i, (contig, length) in enumerate(zip(npz["names"], npz["lengths"]))}
+
+def write_bedgraph(track, outf):
+    """
+    Writes the runs of track to the open file outf as bedGraph lines (contig, start, end,
+    depth), uncovered runs included.
+    """
+    for contig, (length, starts, depths) in track.items():
+        ends = np.append(starts[1:], length)
+        outf.writelines(contig + "\t" + str(start) + "\t" + str(end) + "\t" + str(depth) + "\n"
+                        for start, end, depth in zip(starts.tolist(), ends.tolist(), depths.tolist()))
+
+## jobs:
+
+@instrumentation.instrumented("depth_merge")
+def merge_depth_tracks(job, track_files, options):
+    """
+    Sums the tracks in track_files (global files). More than MERGE_FANIN tracks are summed
+    by a tree of jobs: groups of them by child jobs, then their sums by a follow-on.
+    Returns the global file of the sum.
+    """
+    if len(track_files) > MERGE_FANIN:
+        group_size = -(-len(track_files) // MERGE_FANIN)
+        groups = [track_files[i:i + group_size] for i in range(0, len(track_files), group_size)]
+        sums = [job.addChildJobFn(merge_depth_tracks, group, options, **resources.requirements(resources.depth_requirements, options, *group)).rv()
+                for group in groups]
+        return job.addFollowOnJobFn(merge_depth_tracks, sums, options, **resources.requirements(resources.depth_requirements, options, *sums)).rv()
+
+    track = sum_tracks(read_track(job.fileStore.readGlobalFile(track_file)) for track_file in track_files)
+    instrumentation.count_records(job, tracks=len(track_files), runs=sum(len(starts) for length, starts, depths in track.values()))
+    out_file = job.fileStore.getLocalTempFile()
+    write_track(track, out_file)
+    return job.fileStore.writeGlobalFile(out_file)
+
+@instrumentation.instrumented("depth_output")
+def write_depth_outputs(job, track_file, reference_fai=None, compress=False):
+    """
+    Writes the summed track (global file) with the reference's contigs in the order of
+    its fasta index (global file) as the exported .npz track and bedGraph. Returns a
+    dictionary with key: suffix of the output, value: global file.
+    """
+    contig_lengths = None
+    if reference_fai is not None:
+        contig_lengths = fasta_index.get_contig_lengths(fasta_index.read_index(job.fileStore.readGlobalFile(reference_fai)))
+    out_files = {suffix: job.fileStore.getLocalTempFile() for suffix in get_output_suffixes(compress)}
+    write_outputs(read_track(job.fileStore.readGlobalFile(track_file)), *out_files.values(), contig_lengths, compress)
+    return {suffix: job.fileStore.writeGlobalFile(out_file) for suffix, out_file in out_files.items()}
+
+def get_output_suffixes(compress=False):
+    return [NPZ_SUFFIX, BEDGRAPH_SUFFIX + (".gz" if compress else "")]
+
+def write_outputs(track, npz_file, bedgraph_file, contig_lengths=None, compress=False):
+    """
+    Writes track to npz_file and bedgraph_file (gzip compressed if compress), with the
+    contigs in the order of contig_lengths, if given (see order_track).
+    """
+    if contig_lengths is not None:
+        track = order_track(track, contig_lengths)
+    write_track(track, npz_file)
+    with compression.open_output(bedgraph_file, compress) as outf:
+        write_bedgraph(track, outf)
@@ -0,0 +1,133 @@
+import collections
+import mmap
+
+from src import compression
+
+# A samtools faidx style (.fai) index of a fasta: the name, length and byte offset of the
+# sequence of every contig, plus its line layout, so that the bases from start to end of a
+# contig can be found by arithmetic instead of reading the fasta up to them.
+#
+# An index is built once per assembly while its contig ids are deduplicated (see
+# fasta_preprocessing), and stored in the job store next to the assembly, so that later
+# stages get contig lengths without parsing the fasta, and read only the subsequences they
+# need (see IndexedFasta).
+
+# one line of a .fai file. linebases and linewidth are the bases and bytes (including the
+# line ending) of each full line of the contig; they are 0 if the contig's lines don't all
+# have the same length, which samtools doesn't allow but this index does.
+FaiEntry = collections.namedtuple("FaiEntry", ["name", "length", "offset", "linebases", "linewidth"])
+
+class FastaIndexer:
+    """
+    Builds the index of a fasta from its lines (as bytes), one at a time, so that it can be
+    built while the fasta is being read or written for something else. Offsets are in the
+    uncompressed fasta.
+    """
+    def __init__(self):
+        self.entries = list()
+        self.offset = 0
+        self.contig = None
+
+    def add_line(self, line):
+        if line.startswith(b">"):
+            self.finish_contig()
+            parsed = line[1:].split(None, 1)
+            # [name, length, offset, linebases, linewidth, does the previous line end the contig's regular lines?]
+            self.contig = [parsed[0].decode() if parsed else "", 0, self.offset + len(line), None, None, False]
+        elif self.contig is not None:
+            contig = self.contig
+            bases = len(line.rstrip(b"\r\n"))
+            if contig[3] is None:
+                if bases:
+                    # the sequence starts at its first non-empty line, after any blank lines.
+                    contig[2] = self.offset
+                    contig[3], contig[4] = bases, len(line)
+            elif contig[5] or bases > contig[3]:
+                # a line after a short line; only the last line of a contig can be short.
+                contig[3] = contig[4] = 0
+            if contig[3]:
+                contig[5] = bases < contig[3] or len(line) - bases != contig[4] - contig[3]
+            contig[1] += bases
+        self.offset += len(line)
+
+    def finish_contig(self):
+        if self.contig is not None:
+            name, length, offset, linebases, linewidth = self.contig[:5]
+            self.entries.append(FaiEntry(name, length, offset, linebases or 0, linewidth or 0))
+            self.contig = None
+
+    def get_index(self):
+        self.finish_contig()
+        return self.entries
+
+def build_index(fasta):
+    """
+    Returns the index of fasta (a list of FaiEntry, in the order of the fasta). fasta may
+    be gzip compressed.
+    """
+    indexer = FastaIndexer()
+    with compression.open_input(fasta, "rb") as inf:
+        for line in inf:
+            indexer.add_line(line)
+    return indexer.get_index()
+
+def write_index(index, fai_file):
+    with open(fai_file, "w") as outf:
+        for entry in index:
+            outf.write("\t".join(str(field) for field in entry) + "\n")
+
+def read_index(fai_file):
+    index = list()
+    with open(fai_file) as inf:
+        for line in inf:
+            parsed = line.rstrip("\n").split("\t")
+            index.append(FaiEntry(parsed[0], int(parsed[1]), int(parsed[2]), int(parsed[3]), int(parsed[4])))
+    return index
+
+def get_contig_lengths(index):
+    """
+    Returns a dictionary with key: contig id, value: contig length.
+    """
+    return {entry.name: entry.length for entry in index}
+
+class IndexedFasta:
+    """
+    Random access to the subsequences of an uncompressed fasta through its index, reading
+    only the pages of the memory-mapped fasta that hold them.
+    """
+    def __init__(self, fasta, index):
+        if compression.is_gzipped(fasta):
+            raise ValueError("Can't randomly access the gzip compressed fasta " + fasta)
+        self.index = index
+        self.entries = {entry.name: entry for entry in index}
+        self.file = open(fasta, "rb")
+        # empty files can't be memory-mapped.
+        self.fasta = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if index else b""
+
+    def fetch(self, name, start=0, end=None):
+        """
+        Returns the bases [start, end) of contig name, as a str.
+        """
+        entry = self.entries[name]
+        end = entry.length if end is None else min(end, entry.length)
+        if start >= end:
+            return ""
+        if not entry.linebases:
+            # irregular lines; read the whole contig.
+            contig_end = self.fasta.find(b"\n>", entry.offset)
+            contig_end = len(self.fasta) if contig_end == -1 else contig_end
+            return b"".join(self.fasta[entry.offset:contig_end].split()).decode()[start:end]
+        first = entry.offset + (start // entry.linebases) * entry.linewidth + start % entry.linebases
+        last = entry.offset + ((end - 1) // entry.linebases) * entry.linewidth + (end - 1) % entry.linebases
+        return self.fasta[first:last + 1].replace(b"\n", b"").replace(b"\r", b"").decode()
+
+    def close(self):
+        if isinstance(self.fasta, mmap.mmap):
+            self.fasta.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,60 +1,143 @@
-from Bio import SeqIO
+from concurrent.futures import ProcessPoolExecutor
+import os
 
-def rename_duplicate_contig_ids(assembly_files, reference, new_assembly_files):
+from src import compression
+from src import fasta_index
+
+def rename_duplicate_contig_ids(assembly_files, reference, new_assembly_files, processes=None, fasta_indexes=None, rename_state=None):
     """
-    Sometimes, when combining assemblies from multiple sources, multiple contigs get the 
+    Sometimes, when combining assemblies from multiple sources, multiple contigs get the
     same name. This function slightly modifies all but one of the contigs with the same
     name to ensure that there are no duplicates. Renamed contigs are in a format that
     should be easy to reverse.
 
-    Given a list of assembly files (in job.fileStore.writeGlobalFile id output),
-    outputs the list of edited assembly files, with the only 
-    difference being that all the contigs have been given unique names. Unique names 
-    follow this formula:
+    Given a dictionary of assembly files (key: asm_id, value: fasta path), outputs the
+    dictionary of edited assembly files, with the only difference being that all the
+    contigs have been given unique names. Unique names follow this formula:
     x = original contig id
     y = unique_integer
     new id = x_renamed_y
+
+    This is done in two passes. The first reads every line of the assemblies (in
+    parallel, with up to processes processes) to build their full indexes (see
+    src/fasta_index.py), whose contig ids decide the renames. The second streams the
+    assemblies with renamed contigs to new_assembly_files[asm], copying all other lines
+    through unchanged, and indexes the rewritten files in the same pass. Assemblies without
+    renamed contigs aren't rewritten; their original file is returned instead.
+
+    If a dictionary is given as fasta_indexes, the index of each returned assembly file is
+    added to it. With --all_unique_ids, this function isn't called, but the assemblies are
+    still indexed with the same first pass (see get_indexes).
+
+    rename_state (see get_contig_renames) carries the contig ids already in use over from
+    a previous run, so that assemblies can be added without renaming anything again.
     """
-    
-    contig_ids = set()
-    unique_id = int()
+    indexes = get_indexes(assembly_files, processes)
+    renames = get_contig_renames(indexes, reference, rename_state)
+
+    deduplicated_files = dict()
+    rewritten_asms = list()
+    rewrites = list()
+    for asm, assembly_file in assembly_files.items():
+        if renames.get(asm):
+            deduplicated_files[asm] = new_assembly_files[asm]
+            rewritten_asms.append(asm)
+            rewrites.append((assembly_file, new_assembly_files[asm], renames[asm]))
+        else:
+            deduplicated_files[asm] = assembly_file
 
-    #first, record the sequence ids in reference. (It is assumed that the reference 
-    # doesn't contain duplicate ids internally)
-    reference_contigs = SeqIO.parse(assembly_files[reference], "fasta")
-    for seq in reference_contigs:
-        contig_ids.add(seq.id)
+    if rewrites:
+        with ProcessPoolExecutor(get_process_count(processes, len(rewrites))) as executor:
+            # list() re-raises any error from the rewrites.
+            indexes.update(zip(rewritten_asms, list(executor.map(rewrite_contig_ids, *zip(*rewrites)))))
 
-    for asm in assembly_files:
+    if fasta_indexes is not None:
+        fasta_indexes.update(indexes)
+    return deduplicated_files
+
+def get_indexes(assembly_files, processes=None):
+    """
+    Returns a dictionary with key: asm_id, value: the index of the assembly file (see
+    fasta_index.build_index), indexing the assemblies in parallel.
+    """
+    asms = list(assembly_files)
+    with ProcessPoolExecutor(get_process_count(processes, len(asms))) as executor:
+        return dict(zip(asms, executor.map(fasta_index.build_index, [assembly_files[asm] for asm in asms])))
+
+def get_contig_renames(indexes, reference, rename_state=None):
+    """
+    Decides which contigs rename_duplicate_contig_ids renames, from the indexes of the
+    assemblies. Returns a dictionary with key: asm_id, value: dictionary with key: index
+    of the contig in the assembly file, value: new contig id. The reference is never
+    renamed (it is assumed that the reference doesn't contain duplicate ids internally).
+    The other assemblies are processed in the order of indexes, so the renames are
+    deterministic.
+
+    If rename_state is given, it is a dictionary with key "contig_ids": the set of contig
+    ids already in use and key "unique_id": the next unique integer of a new id, e.g.
+    {"contig_ids": set(), "unique_id": 0}. Both are updated in place, so that the state
+    can be saved, and assemblies deduplicated later continue from it. The reference
+    needn't be in indexes then, if its contig ids are in rename_state. The returned
+    renames are also set as rename_state["renames"].
+    """
+    asms = list(indexes)
+    asm_contig_ids = {asm: [entry.name for entry in index] for asm, index in indexes.items()}
+
+    if rename_state is None:
+        rename_state = {"contig_ids": set(), "unique_id": int()}
+    #first, record the sequence ids in reference.
+    contig_ids = rename_state["contig_ids"]
+    contig_ids.update(asm_contig_ids.get(reference, list()))
+    unique_id = rename_state["unique_id"]
+
+    renames = dict()
+    for asm in asms:
         if asm == reference:
             # we've already preprocessed the reference. Skip it.
             continue
-        
-        asm_contigs = SeqIO.parse(assembly_files[asm], "fasta")
-        output_contigs = list()
-        
-        for contig in asm_contigs:
-            
-            if contig.id in contig_ids:
-                old_id = contig.id
-                
-                while contig.id in contig_ids:
+
+        renames[asm] = dict()
+        for i, contig_id in enumerate(asm_contig_ids[asm]):
+            if contig_id in contig_ids:
+                new_id = contig_id
+                while new_id in contig_ids:
                     # then there is a duplicate contig_id. edit this one.
                     # keep changing the contig_id until we get a completely unique id.
-                    contig.id = old_id + "_renamed_" + str(unique_id)
-                    contig.description = old_id + "_renamed_" + str(unique_id)
+                    new_id = contig_id + "_renamed_" + str(unique_id)
                     unique_id += 1
-                    
-                #record the new contig id as an observed id.
-                contig_ids.add(contig.id)
-                
-            else:
-                # this isn't a duplicate contig_id. record it.
-                contig_ids.add(contig.id)
+                renames[asm][i] = new_id
+                contig_id = new_id
 
-            output_contigs.append(contig)
+            # record the contig id as an observed id.
+            contig_ids.add(contig_id)
 
-        # write the altered asm.    
-        SeqIO.write(output_contigs, new_assembly_files[asm], "fasta")
+    rename_state["unique_id"] = unique_id
+    rename_state["renames"] = renames
+    return renames
+
+def rewrite_contig_ids(assembly_file, new_assembly_file, renames):
+    """
+    Copies assembly_file to new_assembly_file, replacing the header of the ith contig with
+    renames[i] where given. All other lines are copied as raw bytes. new_assembly_file may
+    be assembly_file; the file is then replaced once the copy is complete. Gzipped 
+    assemblies stay gzipped.
+
+    Returns the index of new_assembly_file (see src/fasta_index.py).
+    """
+    tmp = new_assembly_file + ".tmp"
+    contig_index = -1
+    compress = compression.is_gzipped(assembly_file)
+    indexer = fasta_index.FastaIndexer()
+    with compression.open_input(assembly_file, "rb") as inf, compression.open_output(tmp, compress, "wb") as outf:
+        for line in inf:
+            if line.startswith(b">"):
+                contig_index += 1
+                if contig_index in renames:
+                    line = b">" + renames[contig_index].encode() + b"\n"
+            outf.write(line)
+            indexer.add_line(line)
+    os.replace(tmp, new_assembly_file)
+    return indexer.get_index()
 
-    return new_assembly_files
+def get_process_count(processes, tasks):
+    return max(1, min(processes or os.cpu_count() or 1, tasks))
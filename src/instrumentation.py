@@ -0,0 +1,237 @@
+from toil.common import Toil
+
+import collections
+import contextlib
+import functools
+import json
+import logging
+import re
+import resource
+import subprocess
+import sys
+import time
+
+# Per-stage performance metrics of the workflow's jobs, and the run report built from them.
+#
+# Every instrumented job measures itself and sends its metrics to the leader as a
+# log_to_leader message. Those messages are kept in the job store's stats files (the run
+# needs toil's --stats), where collect_metrics finds them once the workflow is done. This
+# works on any batch system, without a file system shared between the workers and the
+# leader.
+
+# prefix of the log_to_leader messages that carry a job's metrics.
+METRICS_PREFIX = "STAGE_METRICS "
+# only the end of a subprocess's stderr is kept in the metrics; that's where errors and minimap2's summary are.
+MAX_STDERR_LENGTH = 4096
+# minimap2 ends its stderr with e.g. "[M::main] Real time: 1.234 sec; CPU: 2.345 sec; Peak RSS: 0.123 GB"
+MINIMAP2_SUMMARY_RE = re.compile(r"Real time: ([\d.]+) sec; CPU: ([\d.]+) sec; Peak RSS: ([\d.]+) GB")
+# columns of the TSV report, one row per job.
+TSV_FIELDS = ["stage", "name", "start_time", "end_time", "wall_seconds", "cpu_seconds", "peak_rss_bytes",
+              "read_bytes", "write_bytes", "requested_cores", "requested_memory", "records", "subprocesses"]
+
+def get_usage():
+    """
+    Returns the resources used so far by this process and its finished subprocesses.
+    Bytes read and written are the block I/O counts of getrusage, so reads served from the
+    page cache aren't counted.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on linux, and in bytes on mac.
+    rss_unit = 1 if sys.platform == "darwin" else 1024
+    return {"cpu_seconds": usage.ru_utime + usage.ru_stime + child_usage.ru_utime + child_usage.ru_stime,
+            "peak_rss_bytes": max(usage.ru_maxrss, child_usage.ru_maxrss) * rss_unit,
+            "read_bytes": (usage.ru_inblock + child_usage.ru_inblock) * 512,
+            "write_bytes": (usage.ru_oublock + child_usage.ru_oublock) * 512}
+
+@contextlib.contextmanager
+def measure(stage, name):
+    """
+    Measures the code run inside the with block. Yields the metrics dictionary, which is
+    filled in when the block exits. Peak RSS is the high-water mark of the whole process
+    (and its largest subprocess), which can include earlier jobs run by the same worker.
+    """
+    metrics = {"stage": stage, "name": name, "records": dict(), "subprocesses": list()}
+    start_usage = get_usage()
+    start_time = time.time()
+    yield metrics
+    end_usage = get_usage()
+    metrics["start_time"] = start_time
+    metrics["end_time"] = time.time()
+    metrics["wall_seconds"] = metrics["end_time"] - start_time
+    metrics["peak_rss_bytes"] = end_usage["peak_rss_bytes"]
+    for key in ("cpu_seconds", "read_bytes", "write_bytes"):
+        metrics[key] = end_usage[key] - start_usage[key]
+
+def instrumented(stage):
+    """
+    Decorator for job functions. Measures each run of the job function and sends the
+    metrics to the leader. The job function can add record counts to its metrics with
+    count_records, and should run its subprocesses with run_command.
+    """
+    def decorator(job_fn):
+        @functools.wraps(job_fn)
+        def instrumented_job_fn(job, *args, **kwargs):
+            with measure(stage, job_fn.__name__) as metrics:
+                metrics["requested_cores"] = job.cores
+                metrics["requested_memory"] = job.memory
+                job.stage_metrics = metrics
+                result = job_fn(job, *args, **kwargs)
+            job.log(METRICS_PREFIX + json.dumps(metrics), level=logging.DEBUG)
+            return result
+        return instrumented_job_fn
+    return decorator
+
+def count_records(job, **counts):
+    """
+    Adds to the record counts (e.g. count_records(job, mappings=10)) in the metrics of an
+    instrumented job. Does nothing for jobs that aren't instrumented.
+    """
+    metrics = getattr(job, "stage_metrics", None)
+    if metrics is not None:
+        for key, value in counts.items():
+            metrics["records"][key] = metrics["records"].get(key, 0) + value
+
+def count_lines(path):
+    """
+    Returns the number of lines in an uncompressed file, e.g. the number of mappings in a paf.
+    """
+    lines = int()
+    with open(path, "rb") as inf:
+        for chunk in iter(functools.partial(inf.read, 1024**2), b""):
+            lines += chunk.count(b"\n")
+    return lines
+
+def run_command(job, command):
+    """
+    Runs command, capturing its stderr into the metrics of job instead of the worker log.
+    Returns the command's return code. Raises a RuntimeError, with the end of its stderr,
+    if the command fails.
+    """
+    start_time = time.time()
+    process = subprocess.run(command, stderr=subprocess.PIPE)
+
+    metrics = getattr(job, "stage_metrics", None)
+    if metrics is not None:
+        add_subprocess_metrics(metrics, command, process.returncode, time.time() - start_time, process.stderr)
+    if process.returncode:
+        raise RuntimeError(" ".join(command) + " failed with exit status " + str(process.returncode) + ":\n"
+                           + process.stderr.decode(errors="replace")[-MAX_STDERR_LENGTH:])
+    return process.returncode
+
+def add_subprocess_metrics(metrics, command, returncode, wall_seconds, stderr):
+    """
+    Adds a finished subprocess, with the end of its stderr (bytes) and minimap2's summary
+    of the run if there is one, to metrics.
+    """
+    stderr = stderr.decode(errors="replace")
+    subprocess_metrics = {"command": " ".join(command),
+                          "returncode": returncode,
+                          "wall_seconds": wall_seconds,
+                          "stderr": stderr[-MAX_STDERR_LENGTH:]}
+    subprocess_metrics.update(parse_minimap2_summary(stderr))
+    metrics["subprocesses"].append(subprocess_metrics)
+
+def parse_minimap2_summary(stderr):
+    """
+    Returns minimap2's own measurement of its run time, CPU time and peak RSS from its
+    stderr, or an empty dictionary if stderr doesn't end with minimap2's summary.
+    """
+    summary = MINIMAP2_SUMMARY_RE.search(stderr)
+    if summary is None:
+        return dict()
+    return {"real_seconds": float(summary.group(1)),
+            "cpu_seconds": float(summary.group(2)),
+            "peak_rss_bytes": int(float(summary.group(3)) * 1024**3)}
+
+## leader side:
+
+def collect_metrics(job_store_locator):
+    """
+    Returns the metrics of all instrumented jobs that ran in the workflow in the job store.
+    The workflow must have been run with --stats, so that the stats files are kept.
+    """
+    records = list()
+
+    def read_stats_file(stats_file):
+        stats = stats_file.read()
+        if not isinstance(stats, str):
+            stats = stats.decode()
+        stats = json.loads(stats) if stats else dict()
+        for message in stats.get("workers", dict()).get("logs_to_leader", list()):
+            if message["text"].startswith(METRICS_PREFIX):
+                records.append(json.loads(message["text"][len(METRICS_PREFIX):]))
+
+    Toil.resumeJobStore(job_store_locator).read_logs(read_stats_file, read_all=True)
+    return sorted(records, key=lambda metrics: metrics["start_time"])
+
+def summarize_stages(records):
+    """
+    Returns a dictionary with key: stage, value: the metrics of all the stage's jobs
+    added up (peak RSS is the maximum).
+    """
+    stages = dict()
+    for metrics in records:
+        stage = stages.setdefault(metrics["stage"], {"jobs": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_bytes": 0,
+                                                     "read_bytes": 0, "write_bytes": 0, "records": collections.Counter()})
+        stage["jobs"] += 1
+        for key in ("wall_seconds", "cpu_seconds", "read_bytes", "write_bytes"):
+            stage[key] += metrics[key]
+        stage["peak_rss_bytes"] = max(stage["peak_rss_bytes"], metrics["peak_rss_bytes"])
+        stage["records"].update(metrics["records"])
+    for stage in stages.values():
+        stage["records"] = dict(stage["records"])
+    return stages
+
+def write_report(records, report_file):
+    """
+    Writes the metrics of every job to report_file: as TSV (one row per job) if
+    report_file ends with .tsv, otherwise as JSON, along with a summary per stage and the
+    critical path.
+    """
+    if report_file.endswith(".tsv"):
+        with open(report_file, "w") as outf:
+            outf.write("\t".join(TSV_FIELDS) + "\n")
+            for metrics in records:
+                row = dict(metrics)
+                row["records"] = ",".join(key + "=" + str(value) for key, value in sorted(metrics["records"].items()))
+                row["subprocesses"] = ",".join(subprocess_metrics["command"].split()[0] + "=" + str(subprocess_metrics["returncode"])
+                                               for subprocess_metrics in metrics["subprocesses"])
+                outf.write("\t".join(str(row.get(field, "")) for field in TSV_FIELDS) + "\n")
+    else:
+        with open(report_file, "w") as outf:
+            json.dump({"stages": summarize_stages(records),
+                       "critical_path": [metrics["name"] for metrics in get_critical_path(records)],
+                       "jobs": records}, outf, indent=2)
+
+def get_critical_path(records):
+    """
+    Returns the chain of jobs that determined the run time, reconstructed from their start
+    and end times: starting from the job that finished last, each job's predecessor is the
+    job that finished last before it started.
+    """
+    path = list()
+    remaining = sorted(records, key=lambda metrics: metrics["end_time"])
+    while remaining:
+        path.append(remaining[-1])
+        remaining = [metrics for metrics in remaining if metrics["end_time"] <= path[-1]["start_time"]]
+    return path[::-1]
+
+def write_critical_path_summary(records, summary_file):
+    """
+    Writes the critical path in the collapsed stack format read by flame graph tools
+    (e.g. flamegraph.pl or speedscope): one "critical_path;stage;job milliseconds" line
+    per job on the path. Time between jobs on the path (scheduling and other toil
+    overhead) is written as "critical_path;toil_overhead".
+    """
+    frames = collections.Counter()
+    previous_end = None
+    for metrics in get_critical_path(records):
+        if previous_end is not None:
+            frames["critical_path;toil_overhead"] += max(0.0, metrics["start_time"] - previous_end)
+        frames["critical_path;" + metrics["stage"] + ";" + metrics["name"]] += metrics["wall_seconds"]
+        previous_end = metrics["end_time"]
+
+    with open(summary_file, "w") as outf:
+        for frame, seconds in frames.items():
+            outf.write(frame + " " + str(int(round(seconds * 1000))) + "\n")
@@ -0,0 +1,267 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from src import aligners
+from src import cigar_validation
+from src import collinear_merge
+from src import compression
+from src import depth
+from src import fasta_index
+from src import fasta_preprocessing
+from src import instrumentation
+from src import masking
+from src import paf_to_lastz
+from src import poor_mappings
+from src import secondary_filter
+from src import sketches
+from src import sorted_output
+
+# Runs the mapping workflow on the local machine with a process pool instead of toil
+# (--local_fast). For small and medium inputs on a single machine this avoids the job
+# store, file store copies and pickled promises altogether. minimap2's paf is piped
+# straight into the conversion to lastz cigars, and is only written to disk when it's
+# needed to find the poorly mapped segments.
+#
+# The stages and their outputs are the same as those of the toil workflow, so --primary
+# and --secondary are identical to the ones written by the toil workflow.
+
+def run_local(asms, options, index_args, map_args, fasta_indexes=None):
+    """
+    Maps the local fasta files in asms (key: asm_name, value: path, already deduplicated)
+    as map_all_to_ref (with --all_to_ref_only) or map_all_to_ref_and_get_poor_mappings
+    would, and writes the lastz cigars to --primary and --secondary. Intermediate files are
+    written to a temporary directory in toil's --workDir, which is deleted at the end.
+    fasta_indexes (key: asm_name, value: index, see src/fasta_index.py) are used to extract
+    the poorly mapped segments, if given.
+
+    Returns the metrics of every task (see instrumentation.measure), for the run report.
+    """
+    others = [asm for asm in asms if asm != options.refID]
+    work_dir = tempfile.mkdtemp(prefix="local_fast_", dir=options.workDir)
+    metrics = list()
+    try:
+        with ProcessPoolExecutor(fasta_preprocessing.get_process_count(None, max(1, len(others) ** 2))) as executor:
+            def run_tasks(task, *args):
+                # each task returns (result, metrics); list() re-raises any error from the tasks.
+                results = list(executor.map(task, *args))
+                metrics.extend(result[1] for result in results)
+                return [result[0] for result in results]
+
+            if options.mask_repeats:
+                # the masked assemblies are indexed and mapped instead (see src/masking.py).
+                ref_index = (fasta_indexes or dict()).get(options.refID)
+                shards = masking.get_count_shards(ref_index) if ref_index else [None]
+                width = masking.get_sketch_width(sum(entry.length for entry in ref_index) if ref_index else os.path.getsize(asms[options.refID]))
+                count_files = run_tasks(count_kmers, [asms[options.refID]] * len(shards), shards,
+                                        [os.path.join(work_dir, "kmers." + str(i) + ".npy") for i in range(len(shards))],
+                                        [width] * len(shards), [options.mask_kmer_length] * len(shards))
+                sketch_file = os.path.join(work_dir, "kmers.npy")
+                with instrumentation.measure("kmer_count_merge", "merge_kmer_counts") as merge_metrics:
+                    sketch = masking.read_sketch(count_files[0])
+                    for count_file in count_files[1:]:
+                        masking.add_sketches(sketch, masking.read_sketch(count_file))
+                    masking.write_sketch(sketch, sketch_file)
+                    del sketch
+                metrics.append(merge_metrics)
+                masked = run_tasks(mask_assembly, list(asms.values()), [os.path.join(work_dir, asm + ".masked.fa") for asm in asms],
+                                   [sketch_file] * len(asms), [options.mask_kmer_length] * len(asms), [options.mask_min_count] * len(asms),
+                                   [options.mask_dust_threshold] * len(asms))
+                asms = dict(zip(asms, masked))
+
+            # index the reference, and the other assemblies for the re-mapping of poorly mapped segments.
+            indexed = [options.refID] + ([] if options.all_to_ref_only else others)
+            indexes = run_tasks(index_fasta, [asms[asm] for asm in indexed], [os.path.join(work_dir, asm + ".mmi") for asm in indexed],
+                                [get_threads(len(indexed), options)] * len(indexed), [index_args] * len(indexed), [options.aligner] * len(indexed))
+            indexes = dict(zip(indexed, indexes))
+
+            if not options.all_to_ref_only and options.remap_top_k:
+                # sketch the other assemblies, to choose which ones the poorly mapped segments are re-mapped to.
+                sketch_files = run_tasks(sketch_fasta, [asms[asm] for asm in others], [os.path.join(work_dir, asm + ".sketch") for asm in others],
+                                         [options.sketch_kmer_length] * len(others), [options.sketch_scale] * len(others))
+                sketch_files = dict(zip(others, sketch_files))
+
+            # map all assemblies to the reference, converting them to lastz cigars as they are mapped.
+            paf_files = [None if options.all_to_ref_only else os.path.join(work_dir, asm + ".paf") for asm in others]
+            depth_files = [os.path.join(work_dir, asm + depth.NPZ_SUFFIX) if options.depth_track else None for asm in others]
+            lastz_mappings = run_tasks(map_and_convert, [asms[asm] for asm in others], [indexes[options.refID]] * len(others),
+                                       [os.path.join(work_dir, asm) for asm in others], [get_threads(len(others), options)] * len(others),
+                                       [map_args] * len(others), [options.compress_outputs] * len(others), paf_files,
+                                       [False] * len(others), [secondary_filter.from_options(options) for asm in others], depth_files,
+                                       [options.aligner] * len(others), [collinear_merge.from_options(options, map_args) for asm in others])
+            lastz_mappings = dict(zip(others, lastz_mappings))
+
+            if not options.all_to_ref_only:
+                # map the poorly mapped segments of each assembly to the other non-reference assemblies.
+                segment_files = run_tasks(extract_poor_segments, [asms[asm] for asm in others], paf_files,
+                                          [os.path.join(work_dir, asm + ".segments.fa") for asm in others],
+                                          [options.poor_mapping_min_length] * len(others), [options.poor_mapping_min_identity] * len(others),
+                                          [(fasta_indexes or dict()).get(asm) for asm in others])
+                segment_files = dict(zip(others, segment_files))
+
+                if options.remap_top_k:
+                    with instrumentation.measure("remap_partners", "map_poor_segments") as partner_metrics:
+                        partners = sketches.choose_remap_partners(segment_files, sketch_files, options.remap_top_k, options.remap_min_containment,
+                                                                  options.sketch_kmer_length, options.sketch_scale)
+                        partner_metrics["records"]["remappings"] = sum(len(asm_partners) for asm_partners in partners.values())
+                        partner_metrics["records"]["skipped_remappings"] = len(others) * (len(others) - 1) - partner_metrics["records"]["remappings"]
+                    metrics.append(partner_metrics)
+                else:
+                    partners = {asm: [other for other in others if other != asm] for asm in others}
+                pairs = [(asm, other) for asm in others for other in partners[asm]]
+                segment_lastz_mappings = run_tasks(map_and_convert, [segment_files[asm] for asm, other in pairs], [indexes[other] for asm, other in pairs],
+                                                   [os.path.join(work_dir, asm + "_to_" + other) for asm, other in pairs],
+                                                   [get_threads(len(pairs), options)] * len(pairs), [map_args] * len(pairs),
+                                                   [options.compress_outputs] * len(pairs), [None] * len(pairs), [True] * len(pairs),
+                                                   [secondary_filter.from_options(options) for pair in pairs], [None] * len(pairs),
+                                                   [options.aligner] * len(pairs), [collinear_merge.from_options(options, map_args) for pair in pairs])
+                for (asm, other), lastz_files in zip(pairs, segment_lastz_mappings):
+                    lastz_mappings[asm + "_to_" + other] = lastz_files
+
+        # in the same order as concatenate_lastz_mappings in the toil workflow.
+        outfiles = [options.primary, options.secondary]
+        if options.sorted_output:
+            outfiles = [os.path.join(work_dir, "all.primary.cigar"), os.path.join(work_dir, "all.secondary.cigar")]
+        with instrumentation.measure("concatenation", "concatenate_lastz_mappings") as concatenation_metrics:
+            for i, outfile in enumerate(outfiles):
+                compression.concatenate_files([lastz_files[i] for lastz_files in lastz_mappings.values()], outfile)
+            concatenation_metrics["records"]["files"] = len(lastz_mappings)
+        metrics.append(concatenation_metrics)
+
+        if options.validate_outputs:
+            with instrumentation.measure("validation", "validate_outputs") as validation_metrics:
+                # a process per core, but no more than there are batches.
+                processes = fasta_preprocessing.get_process_count(None, 1 + sum(os.path.getsize(outfile) for outfile in outfiles) // cigar_validation.BATCH_BYTES)
+                summary = cigar_validation.validate_lastz_files(dict(zip(["primary", "secondary"], outfiles)),
+                                                                cigar_validation.get_contig_lengths(fasta_indexes.values()) if fasta_indexes else None, processes)
+                validation_metrics["records"]["lines"] = summary["lines"]
+                validation_metrics["records"]["problem_lines"] = summary["problem_lines"]
+            metrics.append(validation_metrics)
+            if summary["problem_lines"]:
+                raise RuntimeError(cigar_validation.format_summary(summary))
+            print(cigar_validation.format_summary(summary))
+
+        if options.depth_track:
+            with instrumentation.measure("depth_output", "write_depth_outputs") as depth_metrics:
+                track = depth.sum_tracks(depth.read_track(depth_file) for depth_file in depth_files)
+                ref_index = (fasta_indexes or dict()).get(options.refID)
+                depth.write_outputs(track, *[options.depth_track + suffix for suffix in depth.get_output_suffixes(options.compress_outputs)],
+                                    fasta_index.get_contig_lengths(ref_index) if ref_index else None, options.compress_outputs)
+                depth_metrics["records"]["tracks"] = len(depth_files)
+            metrics.append(depth_metrics)
+
+        if options.sorted_output:
+            for lastz_file, out_path in zip(outfiles, [options.primary, options.secondary]):
+                with instrumentation.measure("sort", "sort_lastz_mappings") as sort_metrics:
+                    sort_metrics["records"]["files"] = len(sorted_output.write_sorted_output(lastz_file, out_path, options.sorted_output, options.sort_buffer_size,
+                                                                                             options.index_block_size, options.compress_outputs, work_dir))
+                metrics.append(sort_metrics)
+    finally:
+        shutil.rmtree(work_dir)
+
+    return metrics
+
+def get_threads(tasks, options):
+    """
+    minimap2 threads for each of tasks tasks run at the same time, so that they share the
+    machine's cores. Up to --max_job_cores, like the cores of a toil job.
+    """
+    return max(1, min(options.max_job_cores, (os.cpu_count() or 1) // max(1, tasks)))
+
+## tasks; each returns (result, metrics):
+
+def index_fasta(fasta, index, threads, index_args, aligner="minimap2"):
+    with instrumentation.measure("index", "index_fasta") as metrics:
+        if aligner == "mappy":
+            aligners.build_index(fasta, index, aligners.get_preset(index_args), threads)
+        else:
+            run_minimap2(["minimap2"] + index_args + ["-t", str(threads), "-d", index, fasta], metrics)
+    return index, metrics
+
+def sketch_fasta(fasta, sketch_file, k, scale):
+    with instrumentation.measure("sketch", "sketch_assembly") as metrics:
+        sketch = sketches.sketch_fasta(fasta, k, scale)
+        sketches.write_sketch(sketch, sketch_file)
+        metrics["records"]["hashes"] = len(sketch)
+    return sketch_file, metrics
+
+def count_kmers(fasta, contigs, sketch_file, width, k):
+    with instrumentation.measure("kmer_count", "count_reference_kmers") as metrics:
+        masking.write_sketch(masking.count_kmers(fasta, width, k, contigs), sketch_file)
+        metrics["records"]["contigs"] = len(contigs) if contigs is not None else 0
+    return sketch_file, metrics
+
+def mask_assembly(fasta, outfile, sketch_file, k, min_count, dust_threshold):
+    with instrumentation.measure("masking", "mask_assembly") as metrics:
+        metrics["records"].update(masking.mask_fasta(fasta, outfile, masking.read_sketch(sketch_file), k, min_count, dust_threshold))
+    return outfile, metrics
+
+def map_and_convert(query, index, out_prefix, threads, map_args, compress=False, paf_file=None, lift_segments=False, secondary_filter=None,
+                    depth_file=None, aligner="minimap2", merger=None):
+    """
+    Maps query to index, piping minimap2's paf straight into the conversion to lastz
+    cigars (see paf_to_lastz.write_lastz_lines), or with aligner mappy, streaming mappy's
+    mappings into it (see src/aligners.py). If paf_file is given, the paf is also
+    written there, unfiltered. If depth_file is given, the coverage track of the primary
+    mappings (see src/depth.py) is written there. If merger (see src/collinear_merge.py)
+    is given, collinear mappings are merged before they are converted. Returns the
+    [primary, secondary] lastz cigar files.
+    """
+    coverage = depth.AssemblyCoverage() if depth_file else None
+    lastz_files = [out_prefix + ".primary.cigar", out_prefix + ".secondary.cigar"]
+    with instrumentation.measure("mapping", "map_a_to_b") as metrics:
+        with compression.open_output(lastz_files[0], compress) as primaryf, \
+                compression.open_output(lastz_files[1], compress) as secondaryf, \
+                open(paf_file or os.devnull, "w") as paff:
+            def convert(paf_lines):
+                lift = lift_segments
+                if paf_file:
+                    paf_lines = tee_lines(paf_lines, paff)
+                if merger is not None:
+                    # as in upload_mappings, segments are lifted before they're merged.
+                    paf_lines = merger.merge(None, lift, os.path.dirname(out_prefix), paf_lines)
+                    lift = False
+                if coverage is not None:
+                    paf_lines = coverage.observe(paf_lines)
+                metrics["records"].update(paf_to_lastz.write_lastz_lines(paf_lines, primaryf, secondaryf, lift, secondary_filter))
+                if merger is not None:
+                    metrics["records"]["merged_mappings"] = merger.merged
+            if aligner == "mappy":
+                preset = aligners.get_preset(map_args)
+                convert(aligners.map_fasta(aligners.load_index(index, preset), query, threads, aligners.PRESET_SCORING.get(preset)))
+            else:
+                run_minimap2(["minimap2"] + map_args + ["-t", str(threads), index, query], metrics, convert)
+        if coverage is not None:
+            depth.write_track(coverage.get_track(), depth_file)
+    return lastz_files, metrics
+
+def extract_poor_segments(assembly_file, paf_file, outfile, min_length, min_identity, index=None):
+    with instrumentation.measure("poor_mapping_extraction", "extract_poor_mappings") as metrics:
+        metrics["records"]["segments"] = poor_mappings.write_poor_segments(assembly_file, paf_file, outfile, min_length, min_identity, index)
+    return outfile, metrics
+
+def tee_lines(lines, outf):
+    for line in lines:
+        outf.write(line)
+        yield line
+
+def run_minimap2(command, metrics, read_stdout=None):
+    """
+    Runs minimap2, recording it in metrics. If read_stdout is given, it's called with the
+    lines of minimap2's stdout as they are written. Raises a RuntimeError if minimap2 fails.
+    """
+    start_time = time.time()
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE if read_stdout else None, stderr=stderr, universal_newlines=True)
+        if read_stdout:
+            with process.stdout:
+                read_stdout(process.stdout)
+        process.wait()
+        stderr.seek(0)
+        instrumentation.add_subprocess_metrics(metrics, command, process.returncode, time.time() - start_time, stderr.read())
+
+    if process.returncode:
+        raise RuntimeError(" ".join(command) + " failed with exit status " + str(process.returncode) + ":\n" + metrics["subprocesses"][-1]["stderr"])
@@ -0,0 +1,282 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+
+from src import aligners
+from src import columnar
+from src import fasta_index
+from src import fasta_preprocessing
+from src import mapping_cache
+
+# The run manifest of --manifest_dir, for adding assemblies to a pangenome without redoing
+# the work for the assemblies that are already in it (--update).
+#
+# At the end of each run, every per-assembly output (minimap2 index, sketch, mappings to
+# the reference, their lastz cigars and coverage track, poorly mapped segments, masked copy
+# and, for the reference, its k-mer counts) and every per-pair output
+# (mappings of poorly mapped segments and their lastz cigars) is exported to --manifest_dir,
+# and manifest.json records:
+#     - the options that change the outputs, and the minimap2 version (see get_settings).
+#       If they change, nothing is reused.
+#     - for each assembly, the checksum of its fasta, the deduplicated fasta it was mapped
+#       as, the contig renames it was given and its fasta index.
+#     - the location of each output in --manifest_dir.
+# With --update, the outputs of assemblies whose checksum is unchanged (and of pairs of
+# unchanged assemblies) are imported instead of recomputed, and their contig renames are
+# kept. --primary and --secondary are then concatenated from all the outputs, in the
+# order of the seqFile, so they are the same as those of a full run as long as assemblies
+# are only added at the end of the seqFile.
+
+MANIFEST_FILE = "manifest.json"
+VERSION = 1
+
+# options that change the outputs.
+SETTINGS_OPTIONS = ["refID", "all_unique_ids", "compress_outputs", "intermediate_format", "poor_mapping_min_length", "poor_mapping_min_identity",
+                    "secondary_top_n", "secondary_region_length", "secondary_max_containment", "secondary_min_length",
+                    "secondary_min_identity", "secondary_min_mapq", "sketch_kmer_length", "sketch_scale",
+                    "shard_size", "split_contig_length", "split_contig_overlap", "mask_repeats", "mask_kmer_length", "mask_min_count",
+                    "mask_dust_threshold", "merge_collinear_gap"]
+
+# key: kind of output, value: suffixes of its files in --manifest_dir. Outputs of the lastz kinds are
+# [primary, secondary] lists of files (or single columnar files, with --intermediate_format columnar), and those of
+# indexes are (index, digest) tuples as returned by index_fasta.
+OUTPUT_KINDS = {"indexes": [".mmi"],
+                "sketches": [".sketch"],
+                "ref_mappings": [".paf"],
+                "lastz_mappings": [".primary.cigar", ".secondary.cigar"],
+                "segments": [".fa"],
+                "segment_mappings": [".paf"],
+                "segment_lastz_mappings": [".primary.cigar", ".secondary.cigar"],
+                "depth_tracks": [".depth.npz"],
+                "masked_assemblies": [".fa"],
+                "kmer_counts": [".npy"]}
+# kinds of outputs keyed by pairs of assemblies, rather than by assembly.
+PAIR_KINDS = ["segment_mappings", "segment_lastz_mappings"]
+
+def new_outputs():
+    """
+    Returns an empty dictionary of outputs: key: kind of output, value: dictionary with
+    key: assembly (or pair of assemblies, see get_pairs), value: global file(s).
+    """
+    return {kind: dict() for kind in OUTPUT_KINDS}
+
+def get_settings(options, index_args, map_args):
+    settings = {option: getattr(options, option) for option in SETTINGS_OPTIONS}
+    # with --aligner mappy, mappy's version.
+    settings["minimap2_version"] = aligners.get_version(options.aligner)
+    settings["minimap2_index_args"] = list(index_args)
+    settings["minimap2_map_args"] = list(map_args)
+    return settings
+
+def new_manifest(options, index_args, map_args, previous_manifest=None):
+    """
+    Returns the manifest of this run, to be filled in by record_assemblies and
+    export_outputs.
+    """
+    return {"version": VERSION,
+            "run": previous_manifest["run"] + 1 if previous_manifest else 0,
+            "settings": get_settings(options, index_args, map_args),
+            "unique_id": 0,
+            "assemblies": dict(),
+            "files": new_outputs()}
+
+def load(manifest_dir):
+    """
+    Returns the manifest in manifest_dir, or None if there is none.
+    """
+    try:
+        with open(os.path.join(manifest_dir, MANIFEST_FILE)) as inf:
+            return json.load(inf)
+    except FileNotFoundError:
+        return None
+
+def write(manifest, manifest_dir):
+    """
+    Writes manifest to manifest_dir, replacing the previous manifest only once it is
+    complete.
+    """
+    tmp = os.path.join(manifest_dir, MANIFEST_FILE + ".tmp")
+    with open(tmp, "w") as outf:
+        json.dump(manifest, outf, indent=1)
+    os.replace(tmp, os.path.join(manifest_dir, MANIFEST_FILE))
+
+def load_for_update(options, index_args, map_args):
+    """
+    Returns the manifest in --manifest_dir for --update, or None if there's none or if it
+    was written with different settings, in which case everything is recomputed.
+    """
+    manifest = load(options.manifest_dir)
+    if manifest is None:
+        print("WARNING: there's no manifest in " + options.manifest_dir + " to --update; running on all assemblies.")
+        return None
+    if manifest.get("version") != VERSION or manifest["settings"] != get_settings(options, index_args, map_args):
+        print("WARNING: the manifest in " + options.manifest_dir + " was written with other settings; running on all assemblies.")
+        return None
+    return manifest
+
+def get_source_records(assembly_files, previous_records=None, processes=None):
+    """
+    Returns a dictionary with key: asm_id, value: dictionary of the path, size, mtime and
+    sha256 digest of the assembly file. Files are only hashed (in parallel) if their size
+    or mtime differ from those in previous_records (dictionary of records as returned by
+    this function, or the assembly records of a manifest).
+    """
+    records = dict()
+    to_hash = list()
+    for asm, assembly_file in assembly_files.items():
+        stat = os.stat(assembly_file)
+        records[asm] = {"source": assembly_file, "size": stat.st_size, "mtime": stat.st_mtime, "digest": None}
+        previous = (previous_records or dict()).get(asm)
+        if previous and all(previous[field] == records[asm][field] for field in ("source", "size", "mtime")):
+            records[asm]["digest"] = previous["digest"]
+        else:
+            to_hash.append(asm)
+
+    if to_hash:
+        with ProcessPoolExecutor(fasta_preprocessing.get_process_count(processes, len(to_hash))) as executor:
+            for asm, digest in zip(to_hash, executor.map(mapping_cache.file_digest, [assembly_files[asm] for asm in to_hash])):
+                records[asm]["digest"] = digest
+    return records
+
+def get_unchanged_asms(previous_manifest, source_records, reference):
+    """
+    Returns a dictionary with key: asm_id, value: its record in previous_manifest, for the
+    assemblies in source_records (see get_source_records) that are unchanged since the
+    previous run, and whose deduplicated fasta is still there. If the reference changed,
+    none are.
+    """
+    if not previous_manifest:
+        return dict()
+    unchanged = dict()
+    for asm, record in source_records.items():
+        previous = previous_manifest["assemblies"].get(asm)
+        if previous and previous["digest"] == record["digest"] and os.path.isfile(previous["fasta"]):
+            unchanged[asm] = previous
+    if reference not in unchanged:
+        return dict()
+    return unchanged
+
+def get_rename_state(previous_manifest, unchanged, manifest_dir):
+    """
+    Returns the rename_state (see fasta_preprocessing.get_contig_renames) that the unchanged
+    assemblies (see get_unchanged_asms) left, and their fasta indexes.
+    """
+    rename_state = {"contig_ids": set(), "unique_id": previous_manifest["unique_id"] if unchanged else 0}
+    fasta_indexes = dict()
+    for asm, record in unchanged.items():
+        fasta_indexes[asm] = fasta_index.read_index(os.path.join(manifest_dir, record["fai"]))
+        rename_state["contig_ids"].update(entry.name for entry in fasta_indexes[asm])
+    return rename_state, fasta_indexes
+
+def record_assemblies(manifest, asms, fasta_indexes, source_records, unchanged, rename_state, manifest_dir):
+    """
+    Records the deduplicated fasta, checksum, contig renames and fasta index of each of
+    asms (key: asm_id, value: deduplicated fasta) in manifest. The records of unchanged
+    assemblies are kept. Source files may have been overwritten while deduplicating
+    (--overwrite_assemblies), so the checksums are of the source files as they are now.
+    """
+    source_records = get_source_records({asm: record["source"] for asm, record in source_records.items()}, source_records)
+    manifest["unique_id"] = rename_state["unique_id"]
+    os.makedirs(os.path.join(manifest_dir, "fai"), exist_ok=True)
+    for asm, fasta in asms.items():
+        if asm in unchanged:
+            record = dict(unchanged[asm])
+            record.update(source_records[asm])
+        else:
+            record = dict(source_records[asm])
+            record["fasta"] = os.path.abspath(fasta)
+            record["fasta_digest"] = record["digest"] if os.path.abspath(fasta) == os.path.abspath(record["source"]) else mapping_cache.file_digest(fasta)
+            record["renames"] = {str(i): new_id for i, new_id in rename_state.get("renames", dict()).get(asm, dict()).items()}
+            record["fai"] = get_file_name("fai", asm, ".fai", manifest["run"])
+            fasta_index.write_index(fasta_indexes[asm], os.path.join(manifest_dir, record["fai"]))
+        manifest["assemblies"][asm] = record
+
+def get_file_name(kind, name, suffix, run):
+    """
+    Files are named by the run that made them, so that the files of the previous run are
+    only replaced once the new manifest has been written.
+    """
+    return os.path.join(kind, name + "." + str(run) + suffix)
+
+def get_pairs(assemblies, reference):
+    """
+    Returns a dictionary with key: the key of a pair of non-reference assemblies in the
+    outputs of map_poor_segments, value: [query assembly, target assembly].
+    """
+    others = [asm for asm in assemblies if asm != reference]
+    return {asm + "_to_" + other: [asm, other] for asm in others for other in others if other != asm}
+
+def import_outputs(import_files, previous_manifest, manifest, options):
+    """
+    Imports the outputs in previous_manifest that can be reused in this run: those of the
+    assemblies that are unchanged in manifest (see record_assemblies), and of pairs of
+    unchanged assemblies. import_files(paths) imports local files into the job store and
+    returns their global files. Returns them as outputs (see new_outputs).
+    """
+    previous = new_outputs()
+    if not previous_manifest:
+        return previous
+    unchanged = get_unchanged_asms(previous_manifest, manifest["assemblies"], options.refID)
+    pairs = get_pairs(manifest["assemblies"], options.refID)
+
+    reused = list()
+    for kind, files in previous_manifest["files"].items():
+        for name, paths in files.items():
+            if all(asm in unchanged for asm in (pairs.get(name, list()) if kind in PAIR_KINDS else [name])):
+                reused.append((kind, name, len(paths)))
+    # all imported at once, so that they can be imported concurrently.
+    imported = iter(import_files([os.path.join(options.manifest_dir, path) for kind, name, count in reused
+                                  for path in previous_manifest["files"][kind][name]]))
+
+    for kind, name, count in reused:
+        file_ids = [next(imported) for i in range(count)]
+        if kind == "indexes":
+            previous[kind][name] = (file_ids[0], manifest["assemblies"][name]["fasta_digest"] if options.mapping_cache_dir else None)
+        elif len(file_ids) > 1:
+            previous[kind][name] = file_ids
+        else:
+            previous[kind][name] = file_ids[0]
+    return previous
+
+def export_outputs(workflow, outputs, previous, previous_manifest, manifest, manifest_dir):
+    """
+    Exports the outputs of this run (see new_outputs) that weren't imported from
+    previous_manifest (previous, see import_outputs) to manifest_dir, records the locations
+    of all of them in manifest and writes it. Then, deletes the files of the previous run
+    that are no longer in the manifest.
+    """
+    for kind, suffixes in OUTPUT_KINDS.items():
+        for name, file_ids in outputs.get(kind, dict()).items():
+            if name in previous[kind]:
+                manifest["files"][kind][name] = previous_manifest["files"][kind][name]
+                continue
+            file_suffixes = suffixes
+            if kind == "indexes":
+                file_ids = file_ids[:1]
+            elif len(suffixes) == 1:
+                file_ids = [file_ids]
+            elif not isinstance(file_ids, list):
+                file_ids = [file_ids]
+                file_suffixes = [columnar.SUFFIX]
+            paths = list()
+            for file_id, suffix in zip(file_ids, file_suffixes):
+                paths.append(get_file_name(kind, name, suffix, manifest["run"]))
+                os.makedirs(os.path.join(manifest_dir, kind), exist_ok=True)
+                workflow.exportFile(file_id, "file://" + os.path.join(manifest_dir, paths[-1]))
+            manifest["files"][kind][name] = paths
+
+    write(manifest, manifest_dir)
+    remove_unused_files(manifest, manifest_dir)
+
+def remove_unused_files(manifest, manifest_dir):
+    used = set(record["fai"] for record in manifest["assemblies"].values())
+    for files in manifest["files"].values():
+        for paths in files.values():
+            used.update(paths)
+    for kind in list(OUTPUT_KINDS) + ["fai"]:
+        kind_dir = os.path.join(manifest_dir, kind)
+        if not os.path.isdir(kind_dir):
+            continue
+        for entry in os.scandir(kind_dir):
+            if os.path.join(kind, entry.name) not in used:
+                os.remove(entry.path)
@@ -0,0 +1,117 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+
+STATS_FILE = "cache_stats.json"
+
+def file_digest(path):
+    """
+    Returns the sha256 hex digest of the contents of path.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as inf:
+        for block in iter(lambda: inf.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_minimap2_version():
+    return subprocess.run(["minimap2", "--version"], stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout.strip()
+
+def get_cache_key(input_digests, minimap2_args, version=None):
+    """
+    Returns the cache key for the output of running minimap2 with minimap2_args on inputs
+    with the given digests. The version of minimap2 (by default, the installed one's) is
+    part of the key.
+    """
+    key = hashlib.sha256()
+    for part in list(input_digests) + [version or get_minimap2_version()] + list(minimap2_args):
+        key.update(part.encode())
+        key.update(b"\0")
+    return key.hexdigest()
+
+def lookup(cache_dir, key, outfile):
+    """
+    If key is in the cache, copies the cached file to outfile and returns True. Hits mark
+    the cached file as recently used, for the LRU eviction in store. Returns False on a miss.
+    """
+    cached = os.path.join(cache_dir, key)
+    try:
+        os.utime(cached)
+        shutil.copyfile(cached, outfile)
+        hit = True
+    except OSError:
+        # not in the cache, or evicted by another job while we were reading it.
+        hit = False
+    record_lookup(cache_dir, hit)
+    return hit
+
+def store(cache_dir, key, infile, max_size):
+    """
+    Copies infile into the cache under key. Then, evicts the least recently used files
+    until the cache is no larger than max_size bytes.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = os.path.join(cache_dir, "." + key + "." + str(os.getpid()) + ".tmp")
+    shutil.copyfile(infile, tmp)
+    os.replace(tmp, os.path.join(cache_dir, key))
+    evict(cache_dir, max_size)
+
+def evict(cache_dir, max_size):
+    """
+    Deletes the least recently used cached files until the total size of the cache is no
+    larger than max_size bytes. Returns the number of files evicted.
+    """
+    entries = list()
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and not entry.name.startswith(".") and entry.name != STATS_FILE:
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for mtime, size, path in entries)
+    evicted = int()
+    for mtime, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # another job evicted it first.
+            pass
+        total_size -= size
+        evicted += 1
+    return evicted
+
+def record_lookup(cache_dir, hit):
+    """
+    Increments the persistent hit or miss counter of the cache.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, STATS_FILE), "a+") as statsf:
+        fcntl.flock(statsf, fcntl.LOCK_EX)
+        stats = read_stats_file(statsf)
+        stats["hits" if hit else "misses"] += 1
+        statsf.seek(0)
+        statsf.truncate()
+        json.dump(stats, statsf)
+
+def get_stats(cache_dir):
+    """
+    Returns the persistent hit and miss counters of the cache, as a dictionary.
+    """
+    try:
+        with open(os.path.join(cache_dir, STATS_FILE)) as statsf:
+            fcntl.flock(statsf, fcntl.LOCK_SH)
+            return read_stats_file(statsf)
+    except FileNotFoundError:
+        return {"hits": 0, "misses": 0}
+
+def read_stats_file(statsf):
+    statsf.seek(0)
+    contents = statsf.read()
+    stats = {"hits": 0, "misses": 0}
+    if contents:
+        stats.update(json.loads(contents))
+    return stats
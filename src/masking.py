@@ -0,0 +1,302 @@
+import math
+
+import numpy as np
+
+from src import compression
+from src import fasta_index
+from src import instrumentation
+from src import resources
+from src import sketches
+
+# Repeat and low-complexity masking of the mapping inputs (--mask_repeats).
+#
+# On repeat-rich assemblies, minimap2 spends most of its time chaining through high-copy
+# repeats, which also make most of the secondary mappings. Before anything is indexed or
+# mapped, the canonical k-mers of the reference are counted, and each assembly (the
+# reference included) is hard-masked: the bases of its k-mers seen at least
+# --mask_min_count times in the reference, and of its low-complexity blocks, are replaced
+# with N. minimap2 takes no minimizers from N (it ignores soft-masking), so it never seeds
+# in the masked sequence. Masking keeps the layout of each fasta byte for byte, so the
+# coordinates of the mappings, and the fasta indexes, are those of the unmasked assemblies.
+#
+# k-mers are counted in a count-min sketch: SKETCH_DEPTH rows of 8-bit counters that
+# saturate at MAX_COUNT, each k-mer adding to one counter per row, picked by 32 bits of its
+# hash. The count of a k-mer is estimated by the smallest of its counters, which can only
+# overestimate it. Shards of the reference's contigs are counted in parallel, and their
+# sketches added up.
+#
+# Low-complexity blocks are found with the DUST score: for each block of DUST_WINDOW
+# bases (on two grids, offset by half a block), the number of pairs of identical
+# overlapping triplets over the number of triplets. Blocks scoring above
+# --mask_dust_threshold are masked, like the windows of sdust.
+
+SKETCH_DEPTH = 2
+# about this many k-mers of the reference per counter of each row.
+SKETCH_LOAD = 16
+MIN_SKETCH_WIDTH = 2**16
+MAX_COUNT = 255
+# the reference's contigs are counted in shards of about this many bases.
+COUNT_SHARD_BASES = 500 * 1000**2
+DUST_WINDOW = 64
+# sequence is masked in chunks of this many bases, to bound the memory of the k-mer arrays.
+CHUNK_LENGTH = sketches.CHUNK_LENGTH
+MASK_BASE = ord("N")
+
+def get_sketch_width(kmers):
+    """
+    The width of the rows of the count-min sketch for counting kmers k-mers: a power of
+    2, so that counters can be picked by the bits of the hashes.
+    """
+    return max(MIN_SKETCH_WIDTH, 2**math.ceil(math.log2(max(1, kmers / SKETCH_LOAD))))
+
+def get_count_shards(index, shard_bases=COUNT_SHARD_BASES):
+    """
+    Returns lists of the names of the contigs in index (see src/fasta_index.py), of about
+    shard_bases bases each, to be counted in parallel.
+    """
+    shards = [[]]
+    shard_length = 0
+    for entry in index:
+        if shard_length >= shard_bases:
+            shards.append([])
+            shard_length = 0
+        shards[-1].append(entry.name)
+        shard_length += entry.length
+    return shards
+
+def get_counters(hashes, width):
+    """
+    The counter of each of hashes in each row of a sketch of width counters per row.
+    """
+    return [((hashes >> np.uint64(32 * row)) & np.uint64(width - 1)).astype(np.int64) for row in range(SKETCH_DEPTH)]
+
+def add_kmers(sketch, hashes):
+    """
+    Counts hashes (of k-mers) in sketch.
+    """
+    for row, counters in enumerate(get_counters(hashes, sketch.shape[1])):
+        counters, counts = np.unique(counters, return_counts=True)
+        sketch[row, counters] = np.minimum(sketch[row, counters] + counts, MAX_COUNT)
+
+def get_counts(sketch, hashes):
+    """
+    The estimated counts of hashes in sketch.
+    """
+    return np.min([sketch[row, counters] for row, counters in enumerate(get_counters(hashes, sketch.shape[1]))], axis=0)
+
+def add_sketches(sketch, other):
+    """
+    Adds the counts of other to sketch, in place.
+    """
+    np.copyto(sketch, np.minimum(sketch.astype(np.uint16) + other, MAX_COUNT).astype(np.uint8))
+
+def count_kmers(fasta, width, k, contigs=None):
+    """
+    Returns the count-min sketch of the canonical k-mers of fasta (possibly gzip
+    compressed), or only of its contigs in contigs, if given.
+    """
+    if not 0 < k <= 32:
+        raise ValueError("k-mers must be between 1 and 32 bases long to be counted, not " + str(k))
+    contigs = set(contigs) if contigs is not None else None
+    sketch = np.zeros((SKETCH_DEPTH, width), dtype=np.uint8)
+    chunk = bytearray()
+    counted = True
+    def add_chunk(chunk):
+        hashes, valid = sketches.hash_sequence(chunk, k)
+        add_kmers(sketch, hashes[valid])
+
+    with compression.open_input(fasta, "rb") as inf:
+        for line in inf:
+            if line.startswith(b">"):
+                if counted:
+                    add_chunk(chunk)
+                chunk = bytearray()
+                counted = contigs is None or line[1:].split()[0].decode() in contigs
+                continue
+            if counted:
+                chunk += line.rstrip(b"\r\n")
+                if len(chunk) >= CHUNK_LENGTH:
+                    add_chunk(chunk)
+                    # keep the last k - 1 bases, so that k-mers spanning the chunks are counted too.
+                    chunk = chunk[len(chunk) - k + 1:]
+    if counted:
+        add_chunk(chunk)
+    return sketch
+
+def get_dust_mask(codes, threshold):
+    """
+    Returns whether each base of codes (see sketches.BASE_CODES) is in a low-complexity
+    block (see the comment at the top of this module).
+    """
+    mask = np.zeros(len(codes), dtype=bool)
+    if len(codes) < 3 or not threshold:
+        return mask
+    # triplets containing anything but ACGT aren't counted.
+    valid = (codes[:-2] < 4) & (codes[1:-1] < 4) & (codes[2:] < 4)
+    triplets = (codes[:-2].astype(np.int64) << 4) | (codes[1:-1].astype(np.int64) << 2) | codes[2:].astype(np.int64)
+    positions = np.arange(len(triplets))
+    for offset in (0, DUST_WINDOW // 2):
+        blocks = (positions + offset) // DUST_WINDOW
+        block_count = blocks[-1] + 1
+        counts = np.bincount(blocks[valid] * 64 + triplets[valid], minlength=block_count * 64).reshape(block_count, 64)
+        triplet_counts = counts.sum(axis=1)
+        scores = (counts * (counts - 1) // 2).sum(axis=1) / np.maximum(1, triplet_counts - 1)
+        masked_blocks = scores > threshold
+        # the block's triplets, and the 2 bases after the last one.
+        masked = masked_blocks[blocks]
+        mask[:-2] |= masked
+        mask[2:] |= masked
+        mask[1:-1] |= masked
+    return mask
+
+def get_mask(sequence, sketch, k, min_count, dust_threshold):
+    """
+    Returns (whether each base of sequence (bytes) is in a k-mer seen at least min_count
+    times in sketch, whether it is in a low-complexity block).
+    """
+    repeats = np.zeros(len(sequence), dtype=bool)
+    low_complexity = np.zeros(len(sequence), dtype=bool)
+    for start in range(0, len(sequence), CHUNK_LENGTH):
+        # k - 1 bases past the chunk, for the k-mers starting at its end.
+        chunk = sequence[start:start + CHUNK_LENGTH + k - 1]
+        hashes, valid = sketches.hash_sequence(chunk, k)
+        frequent = valid.copy()
+        frequent[valid] = get_counts(sketch, hashes[valid]) >= min_count
+        # each frequent k-mer masks its k bases: +1 where it starts, -1 where it ends.
+        kmer_starts = np.flatnonzero(frequent)
+        events = np.bincount(kmer_starts, minlength=len(chunk) + 1) - np.bincount(kmer_starts + k, minlength=len(chunk) + 1)
+        repeats[start:start + len(chunk)] |= np.cumsum(events[:len(chunk)]) > 0
+        codes = sketches.BASE_CODES[np.frombuffer(bytes(sequence[start:start + CHUNK_LENGTH]), dtype=np.uint8)]
+        low_complexity[start:start + len(codes)] |= get_dust_mask(codes, dust_threshold)
+    return repeats, low_complexity
+
+def mask_fasta(fasta, outfile, sketch, k, min_count, dust_threshold):
+    """
+    Writes fasta (possibly gzip compressed) to outfile, uncompressed, with the bases
+    masked by get_mask replaced by N, keeping every line (and so the fasta index) as is.
+    Returns the number of bases, and of bases masked as repeats, as low-complexity, and
+    in all.
+    """
+    counts = {"bases": 0, "repeat_bases": 0, "low_complexity_bases": 0, "masked_bases": 0}
+    lines = list()
+    def write_contig(outf):
+        sequence = b"".join(line.rstrip(b"\r\n") for line in lines)
+        repeats, low_complexity = get_mask(sequence, sketch, k, min_count, dust_threshold)
+        mask = repeats | low_complexity
+        counts["bases"] += len(sequence)
+        counts["repeat_bases"] += int(repeats.sum())
+        counts["low_complexity_bases"] += int(low_complexity.sum())
+        counts["masked_bases"] += int(mask.sum())
+        masked = np.frombuffer(sequence, dtype=np.uint8).copy()
+        masked[mask] = MASK_BASE
+        masked = masked.tobytes()
+        position = 0
+        for line in lines:
+            length = len(line.rstrip(b"\r\n"))
+            outf.write(masked[position:position + length] + line[length:])
+            position += length
+        lines.clear()
+
+    with compression.open_input(fasta, "rb") as inf, open(outfile, "wb") as outf:
+        for line in inf:
+            if line.startswith(b">"):
+                write_contig(outf)
+                outf.write(line)
+            else:
+                lines.append(line)
+        write_contig(outf)
+    return counts
+
+def write_sketch(sketch, sketch_file):
+    with open(sketch_file, "wb") as outf:
+        np.save(outf, sketch)
+
+def read_sketch(sketch_file):
+    with open(sketch_file, "rb") as inf:
+        return np.load(inf)
+
+## jobs:
+
+def mask_assemblies(job, assembly_files, reference_fai, options, previous=None):
+    """
+    Counts the k-mers of the reference (global file assembly_files[--refID]) in shards of
+    its contigs (from its fasta index reference_fai, a global file, if given), adds up
+    their counts, then masks every assembly (see src/masking.py).
+
+    With --update, previous (see manifest.import_outputs) holds the summed counts of the
+    unchanged reference (previous["kmer_counts"]) and the masked unchanged assemblies
+    (previous["masked_assemblies"]), which are reused, so only the new assemblies are
+    masked. Returns the outputs of the masking for the run manifest: a dictionary with
+    key "masked_assemblies", value: dictionary with key: assembly, value: global file of
+    the masked assembly, and key "kmer_counts", value: dictionary with key: --refID, value:
+    global file of the summed counts.
+    """
+    previous = previous or dict()
+    reference = assembly_files[options.refID]
+    if options.refID in previous.get("kmer_counts", dict()):
+        sketch_file = previous["kmer_counts"][options.refID]
+        sketch_bytes = resources.get_size(sketch_file)
+        mask_parent = job
+    else:
+        if reference_fai is not None:
+            index = fasta_index.read_index(job.fileStore.readGlobalFile(reference_fai))
+            shards = get_count_shards(index)
+            width = get_sketch_width(sum(entry.length for entry in index))
+        else:
+            shards = [None]
+            width = get_sketch_width(resources.get_size(reference))
+        sketch_bytes = SKETCH_DEPTH * width
+
+        count_files = [job.addChildJobFn(count_reference_kmers, reference, contigs, width, options,
+                                         **resources.kmer_count_requirements(options, sketch_bytes, reference)).rv()
+                       for contigs in shards]
+        mask_parent = job.addFollowOnJobFn(merge_kmer_counts, count_files, **resources.kmer_count_requirements(options, sketch_bytes * (len(count_files) + 1)))
+        sketch_file = mask_parent.rv()
+
+    masked_assemblies = dict()
+    for assembly, assembly_file in assembly_files.items():
+        if assembly in previous.get("masked_assemblies", dict()):
+            masked_assemblies[assembly] = previous["masked_assemblies"][assembly]
+        else:
+            masked_assemblies[assembly] = mask_parent.addChildJobFn(mask_assembly, assembly_file, sketch_file, options,
+                                                                    **resources.masking_requirements(options, sketch_bytes, assembly_file)).rv()
+    return {"masked_assemblies": masked_assemblies, "kmer_counts": {options.refID: sketch_file}}
+
+@instrumentation.instrumented("kmer_count")
+def count_reference_kmers(job, reference, contigs, width, options):
+    """
+    Counts the k-mers of contigs (all of them if None) of the reference (global file).
+    Returns the global file of their sketch.
+    """
+    sketch = count_kmers(job.fileStore.readGlobalFile(reference), width, options.mask_kmer_length, contigs)
+    instrumentation.count_records(job, contigs=len(contigs) if contigs is not None else 0)
+    sketch_file = job.fileStore.getLocalTempFile()
+    write_sketch(sketch, sketch_file)
+    return job.fileStore.writeGlobalFile(sketch_file)
+
+@instrumentation.instrumented("kmer_count_merge")
+def merge_kmer_counts(job, count_files):
+    """
+    Adds up the sketches in count_files (global files), one at a time. Returns the global
+    file of the sum.
+    """
+    sketch = read_sketch(job.fileStore.readGlobalFile(count_files[0]))
+    for count_file in count_files[1:]:
+        add_sketches(sketch, read_sketch(job.fileStore.readGlobalFile(count_file)))
+    instrumentation.count_records(job, frequent_counters=int((sketch >= MAX_COUNT).sum()))
+    sketch_file = job.fileStore.getLocalTempFile()
+    write_sketch(sketch, sketch_file)
+    return job.fileStore.writeGlobalFile(sketch_file)
+
+@instrumentation.instrumented("masking")
+def mask_assembly(job, fasta, sketch_file, options):
+    """
+    Masks the assembly fasta (global file) with the k-mer counts of the reference in
+    sketch_file (global file). The counts of masked bases go to the run report. Returns
+    the global file of the masked assembly.
+    """
+    outfile = job.fileStore.getLocalTempFile()
+    counts = mask_fasta(job.fileStore.readGlobalFile(fasta), outfile, read_sketch(job.fileStore.readGlobalFile(sketch_file)),
+                        options.mask_kmer_length, options.mask_min_count, options.mask_dust_threshold)
+    instrumentation.count_records(job, **counts)
+    return job.fileStore.writeGlobalFile(outfile)
@@ -1,71 +1,126 @@
 from toil.common import Toil
 from toil.job import Job
 
-import subprocess
+import contextlib
+import re
 
-def paf_to_lastz(job, paf_file):
+from src import compression
+from src import segments
+from src import instrumentation
+
+# same patterns paftools.js view uses to pull the cigar and alignment score from a paf line.
+CIGAR_OP_RE = re.compile(r"(\d+)([MIDNSHP=X])")
+CG_TAG_RE = re.compile(r"\tcg:Z:(\S+)")
+AS_TAG_RE = re.compile(r"\tAS:i:(\d+)")
+
+def paf_to_lastz(job, paf_file, compress=False, lift_segments=False, secondary_filter=None, coverage=None, paf_lines=None):
     """
-    Makes lastz output using paftools.js. Also splits the input paf_file into two files
-    in the output, one for the primary and the other for secondary.
+    Makes lastz cigar output from the local paf_file, in the job that made the paf, so that
+    it isn't downloaded again by a separate conversion job. Also splits the input paf_file
+    into two files in the output, one for the primary and the other for secondary.
+    paf_file may be gzip compressed; if compress, so are the outputs. If lift_segments,
+    mappings of segments are lifted back to their contig coordinates (see
+    segments.lift_paf_line) first. If secondary_filter is given, only the secondary
+    mappings it keeps are written (see src/secondary_filter.py). If coverage (a
+    depth.AssemblyCoverage) is given, it records the primary mappings in the same pass.
+    If paf_lines is given, the mappings are read from it instead of paf_file, e.g. as
+    they are mapped (see src/aligners.py).
+
+    Returns the [primary, secondary] global files.
     """
-    primary = list()
-    secondary = list()
-    other = list()
-    
-    print("in paf_to_Lastz - looking for the cg tag.")
-    with open(job.fileStore.readGlobalFile(paf_file)) as inf:
-        for line in inf:
-            print(line)
-            if "tp:A:P" in line or "tp:A:I" in line:
-                #then the line is a primary output file.
-                primary.append(line)
-            # elif "tp:A:S" in line:
-            else:
-                #then the line is a secondary output file.
-                secondary.append(line)
+    out_files = [job.fileStore.getLocalTempFile() for i in range(2)]
 
-    # write output to files; convert to lastz:
-    lines = [primary, secondary]
-    sort_files = [job.fileStore.getLocalTempFile() for i in range(len(lines))]
-    paftool_files = [job.fileStore.getLocalTempFile() for i in range(len(lines))]
-    out_files = [job.fileStore.writeGlobalFile(job.fileStore.getLocalTempFile()) for i in range(len(lines))]
+    counts = split_paf_to_lastz(paf_file, out_files[0], out_files[1], compress, int(job.cores), lift_segments, secondary_filter, coverage, paf_lines)
+    instrumentation.count_records(job, **counts)
+    if counts["skipped"]:
+        print("WARNING: skipped", counts["skipped"], "paf lines without the 'cg' tag while converting to lastz cigar.")
+
+    return [job.fileStore.writeGlobalFile(out_file) for out_file in out_files]
+
+def split_paf_to_lastz(paf_file, primary_file, secondary_file, compress=False, threads=1, lift_segments=False, secondary_filter=None, coverage=None,
+                       paf_lines=None):
+    """
+    Streams through paf_file a single time, writing each mapping as a lastz cigar line to
+    primary_file (tp:A:P and tp:A:I mappings) or to secondary_file (everything else).
+    Memory use doesn't depend on the size of paf_file. paf_file may be gzip compressed;
+    if compress, the outputs are gzip compressed with up to threads threads. If
+    lift_segments, mappings of segments are lifted back to their contig coordinates. If
+    secondary_filter is given, only the secondary mappings it keeps are written. If
+    coverage is given, the lines pass through coverage.observe on the way. If paf_lines (an
+    iterable of paf lines) is given, it's read instead of paf_file.
 
-    stderr_debug = job.fileStore.getLocalTempFile()
-    with open(stderr_debug, "w") as debugf:
-        for i in range(len(lines)):
-            with open(sort_files[i], "w") as sortf:
-                sortf.writelines(lines[i])
-            with open(paftool_files[i], "w") as outf:
-                subprocess.run(["paftools.js", "view", "-f", "lastz-cigar", sort_files[i]], stdout=outf, stderr=debugf)
-            fix_negative_strand_mappings(paftool_files[i], job.fileStore.readGlobalFile(out_files[i]))
+    Output is identical to running "paftools.js view -f lastz-cigar" on each half and
+    then fixing the negative strand coordinates (see paf_line_to_lastz).
 
-    with open(stderr_debug) as debugf:
-        for line in debugf:
-            print("stderr_debug\t", line)
+    Returns a dictionary of the number of primary and secondary mappings written, and of
+    the paf lines that were skipped because they lack a cg tag; with secondary_filter, also
+    of the secondary mappings that were filtered out.
+    """
+    with (contextlib.nullcontext(paf_lines) if paf_lines is not None else compression.open_input(paf_file)) as inf, \
+            compression.open_output(primary_file, compress, threads=threads) as primaryf, \
+            compression.open_output(secondary_file, compress, threads=threads) as secondaryf:
+        return write_lastz_lines(coverage.observe(inf) if coverage is not None else inf, primaryf, secondaryf, lift_segments, secondary_filter)
 
-            
-    return out_files
+def write_lastz_lines(paf_lines, primaryf, secondaryf, lift_segments=False, secondary_filter=None):
+    """
+    Writes each of paf_lines as a lastz cigar line to the open file primaryf or
+    secondaryf, as in split_paf_to_lastz. paf_lines can be any iterable of lines, e.g. the
+    stdout of minimap2. Returns the counts of split_paf_to_lastz.
+    """
+    counts = {"primary": 0, "secondary": 0, "skipped": 0}
+    for line in paf_lines:
+        if lift_segments:
+            line = segments.lift_paf_line(line)
+        lastz_line = paf_line_to_lastz(line)
+        primary = "tp:A:P" in line or "tp:A:I" in line
+        if lastz_line is None:
+            counts["skipped"] += 1
+            continue
+        if secondary_filter is not None:
+            # secondary mappings are written once all the mappings of their query have been seen.
+            kept = secondary_filter.add(line, primary, lastz_line)
+            secondaryf.writelines(kept)
+            counts["secondary"] += len(kept)
+        if primary:
+            #then the line is a primary mapping.
+            primaryf.write(lastz_line)
+            counts["primary"] += 1
+        elif secondary_filter is None:
+            #then the line is a secondary mapping.
+            secondaryf.write(lastz_line)
+            counts["secondary"] += 1
+    if secondary_filter is not None:
+        kept = secondary_filter.finish()
+        secondaryf.writelines(kept)
+        counts["secondary"] += len(kept)
+        counts["filtered"] = secondary_filter.filtered
+    return counts
 
-def fix_negative_strand_mappings(infile, outfile):
+def paf_line_to_lastz(line):
     """
-    paftools.js outputs lastz files with a problem. On "-" strand mappings, the start, stop
-    coordinates of the mapping are shown with [smaller coord], [larger coord], when in fact
-    the larger coord should be first. This fixes that.
-    Note: requires that outfile != infile.
+    Converts a single paf line to a lastz cigar line (including the trailing newline).
+    Returns None if the line doesn't have a cg tag, which is required for the conversion.
+
+    The fields are the ones paftools.js view -f lastz-cigar writes:
+        cigar: query_id query_start query_end query_strand target_id target_start target_end + score [op len]...
+    paftools.js writes the start, stop coordinates of "-" strand mappings as
+    [smaller coord], [larger coord], when in fact the larger coord should be first. That's
+    fixed here directly, so no second pass over the output is needed.
     """
-    with open(infile) as inf:
-        with open(outfile, "w") as outf:
-            for line in inf:
-                parsed = line.split()
-                if parsed[4] == "-" or parsed[8] == "-":
-                    if parsed[4] == "-":
-                        first = parsed[3]
-                        parsed[3] = parsed[2]
-                        parsed[2] = first
-                    if parsed[8] == "-":
-                        first = parsed[6]
-                        parsed[6] = parsed[5]
-                        parsed[5] = first
-                    outf.write(" ".join(parsed) + "\n")
-                else:
-                    outf.write(line)
+    cg = CG_TAG_RE.search(line)
+    if cg is None:
+        return None
+    score = AS_TAG_RE.search(line)
+    score = score.group(1) if score is not None else "0"
+
+    parsed = line.rstrip("\n").split("\t", 9)
+    if parsed[4] == "-":
+        query_start, query_end = parsed[3], parsed[2]
+    else:
+        query_start, query_end = parsed[2], parsed[3]
+
+    out = ["cigar:", parsed[0], query_start, query_end, parsed[4], parsed[5], parsed[7], parsed[8], "+", score]
+    for length, op in CIGAR_OP_RE.findall(cg.group(1)):
+        out.append(op)
+        out.append(length)
+    return " ".join(out) + "\n"
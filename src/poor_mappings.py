@@ -0,0 +1,130 @@
+from Bio import SeqIO
+
+from src import segments
+from src import paf_to_lastz
+from src import compression
+from src import fasta_index
+from src import instrumentation
+
+@instrumentation.instrumented("poor_mapping_extraction")
+def extract_poor_mappings(job, assembly_file, fasta_index_file, mapping_file, min_length, min_identity):
+    """
+    Writes a fasta of all the segments of the assembly that aren't covered by a mapping in
+    mapping_file. See get_poor_segments for how min_length and min_identity are used.
+
+    Args:
+        assembly_file (global file): fasta of the assembly.
+        fasta_index_file (global file): .fai index of the assembly (see src/fasta_index.py).
+        mapping_file (global file): paf of the assembly mapped to the reference.
+
+    Returns:
+        global file: fasta of the poorly mapped segments, named as in segments.segment_name.
+    """
+    poor_segments = job.fileStore.getLocalTempFile()
+    segment_count = write_poor_segments(job.fileStore.readGlobalFile(assembly_file), job.fileStore.readGlobalFile(mapping_file),
+                                        poor_segments, min_length, min_identity, fasta_index.read_index(job.fileStore.readGlobalFile(fasta_index_file)))
+
+    instrumentation.count_records(job, segments=segment_count)
+    return job.fileStore.writeGlobalFile(poor_segments)
+
+def write_poor_segments(assembly_file, mapping_file, outfile, min_length, min_identity, index=None):
+    """
+    Writes the fasta of extract_poor_mappings to outfile, from local files. Returns the
+    number of segments written. With the index of an uncompressed assembly_file, only the
+    poorly mapped segments are read from it; otherwise the whole assembly is parsed.
+    """
+    coverage = get_query_coverage(mapping_file, min_identity)
+
+    segment_count = int()
+    with open(outfile, "w") as outf:
+        if index is not None and not compression.is_gzipped(assembly_file):
+            with fasta_index.IndexedFasta(assembly_file, index) as fasta:
+                for entry in index:
+                    for start, end in get_poor_segments(coverage.get(entry.name, list()), entry.length, min_length):
+                        outf.write(">" + segments.segment_name(entry.name, start, end, entry.length) + "\n")
+                        outf.write(fasta.fetch(entry.name, start, end) + "\n")
+                        segment_count += 1
+        else:
+            with compression.open_input(assembly_file) as inf:
+                for contig in SeqIO.parse(inf, "fasta"):
+                    for start, end in get_poor_segments(coverage.get(contig.id, list()), len(contig), min_length):
+                        outf.write(">" + segments.segment_name(contig.id, start, end, len(contig)) + "\n")
+                        outf.write(str(contig.seq[start:end]) + "\n")
+                        segment_count += 1
+    return segment_count
+
+def get_query_coverage(paf_file, min_identity):
+    """
+    Returns a dictionary with key: query contig id, value: sorted list of non-overlapping
+    [start, end) intervals of the query contig covered by a mapping in paf_file.
+
+    Only the aligned (M/=/X) blocks of a mapping's cigar count as covering the query, so
+    large insertions inside an otherwise good mapping are still reported as uncovered.
+    Mappings with identity (matching bases/aligned bases) below min_identity don't count
+    as covering the query at all; the bases of indels don't lower the identity, since
+    insertions are already left uncovered. Mappings without a cg tag cover their whole
+    query range, and their identity is matching bases/alignment block length.
+    """
+    intervals = dict()
+    with compression.open_input(paf_file) as inf:
+        for line in inf:
+            parsed = line.split("\t", 12)
+            query_start, query_end = int(parsed[2]), int(parsed[3])
+            cg = paf_to_lastz.CG_TAG_RE.search(line)
+            if cg is None:
+                blocks = [(query_start, query_end)]
+                aligned = int(parsed[10])
+            else:
+                blocks = get_aligned_query_blocks(cg.group(1), query_start, query_end, parsed[4])
+                aligned = sum(end - start for start, end in blocks)
+
+            if int(parsed[9]) < min_identity * aligned:
+                continue
+            intervals.setdefault(parsed[0], list()).extend(blocks)
+
+    return {contig_id: merge_intervals(contig_intervals) for contig_id, contig_intervals in intervals.items()}
+
+def get_aligned_query_blocks(cigar, query_start, query_end, strand):
+    """
+    Returns the [start, end) intervals of the query that are aligned (M/=/X ops) in the
+    cigar of a paf line. On "-" strand mappings, the cigar walks the query from query_end
+    backwards.
+    """
+    blocks = list()
+    pos = 0
+    for length, op in paf_to_lastz.CIGAR_OP_RE.findall(cigar):
+        length = int(length)
+        if op in "M=X":
+            if strand == "-":
+                blocks.append((query_end - pos - length, query_end - pos))
+            else:
+                blocks.append((query_start + pos, query_start + pos + length))
+        if op in "MI=X":
+            pos += length
+    return blocks
+
+def merge_intervals(intervals):
+    """
+    Merges overlapping or adjacent [start, end) intervals. Returns a sorted list.
+    """
+    merged = list()
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+def get_poor_segments(covered, contig_length, min_length):
+    """
+    Given the sorted, merged covered intervals of a contig, returns the uncovered [start, end)
+    intervals of the contig that are at least min_length long.
+    """
+    poor_segments = list()
+    prev_end = 0
+    for start, end in covered + [[contig_length, contig_length]]:
+        if start > prev_end and start - prev_end >= min_length:
+            poor_segments.append((prev_end, start))
+        prev_end = max(prev_end, end)
+    return poor_segments
@@ -0,0 +1,169 @@
+from toil.job import Promise, PromisedRequirement
+
+import functools
+import math
+
+from src import cigar_validation
+from src import sketches
+
+# fixed disk allowance for every job, on top of its input-dependent disk requirement.
+DISK_OVERHEAD = 1024**3
+
+def requirements(requirement_fn, options, *files, **kwargs):
+    """
+    Returns the cores, memory and disk requirements of a job as keyword arguments for
+    job.addChildJobFn, as calculated by requirement_fn(options, *files, **kwargs) from the
+    sizes of the job's input files. If any of the files are promised by a job that hasn't
+    run yet, the calculation is deferred until they are available (see toil's
+    PromisedRequirement).
+    """
+    if kwargs:
+        requirement_fn = functools.partial(requirement_fn, **kwargs)
+    if any(isinstance(file, Promise) for file in files):
+        return {name: PromisedRequirement(functools.partial(get_requirement, requirement_fn, name), options, *files)
+                for name in ("cores", "memory", "disk")}
+    return requirement_fn(options, *files)
+
+def get_requirement(requirement_fn, name, options, *files):
+    return requirement_fn(options, *files)[name]
+
+def get_size(file):
+    """
+    Returns the size in bytes of a global file, or the total size of the global files in
+    a tuple, list or dictionary (like the output of index_fasta, or the [primary, secondary]
+    lastz cigar files of a mapping). Returns 0 if the size isn't known.
+    """
+    if isinstance(file, dict):
+        file = list(file.values())
+    if isinstance(file, (tuple, list)):
+        return sum(get_size(item) for item in file)
+    return getattr(file, "size", 0) or 0
+
+def get_cores(query_size, options):
+    """
+    One core per --mapping_bases_per_core bytes of query, up to --max_job_cores.
+    """
+    return max(1, min(options.max_job_cores, math.ceil(query_size / options.mapping_bases_per_core)))
+
+def get_merge_memory(options):
+    """
+    With --merge_collinear_gap, the conversion of mappings sorts them with --sort_buffer_size
+    bytes of lines in memory (as python strings, about twice that).
+    """
+    return 2 * options.sort_buffer_size if options.merge_collinear_gap else 0
+
+def index_requirements(options, fasta):
+    size = get_size(fasta)
+    return {"cores": get_cores(size, options),
+            "memory": int(size * options.index_memory_factor) + options.job_memory_overhead,
+            "disk": int(size * options.disk_factor) + DISK_OVERHEAD}
+
+def mapping_requirements(options, query, index):
+    """
+    minimap2 keeps the whole index in memory, so memory scales with the size of the
+    index. Cores scale with the size of the query, since minimap2 maps query contigs in
+    parallel.
+    """
+    query_size = get_size(query)
+    index_size = get_size(index)
+    return {"cores": get_cores(query_size, options),
+            "memory": int(index_size * options.mapping_memory_factor) + get_merge_memory(options) + options.job_memory_overhead,
+            "disk": int((query_size + index_size) * options.disk_factor) + DISK_OVERHEAD}
+
+def fasta_requirements(options, fasta, *mapping_files, sequence_length=None):
+    """
+    For jobs that read a fasta one contig at a time (sharding, extracting poorly mapped
+    segments). The largest contig can be most of the fasta: sequence_length, the total
+    length of its contigs (from its fasta index) if given, or else the size of the file,
+    which is several times too small for a gzipped fasta.
+    """
+    fasta_size = max(get_size(fasta), sequence_length or 0)
+    size = fasta_size + sum(get_size(mapping_file) for mapping_file in mapping_files)
+    return {"cores": 1,
+            "memory": fasta_size + options.job_memory_overhead,
+            "disk": int(size * options.disk_factor) + DISK_OVERHEAD}
+
+def paf_requirements(options, *mapping_files):
+    """
+    For jobs that stream through paf files (consolidation, conversion to lastz cigar,
+    merging shards).
+    """
+    size = sum(get_size(mapping_file) for mapping_file in mapping_files)
+    return {"cores": min(2, options.max_job_cores) if options.compress_outputs else 1,
+            "memory": options.job_memory_overhead,
+            "disk": int(size * options.disk_factor) + DISK_OVERHEAD}
+
+def shard_merge_requirements(options, *mapping_files):
+    """
+    Merging shards keeps the mappings of windowed contigs in memory.
+    """
+    shard_merge = paf_requirements(options, *mapping_files)
+    shard_merge["memory"] += sum(get_size(mapping_file) for mapping_file in mapping_files) + get_merge_memory(options)
+    return shard_merge
+
+def sketch_requirements(options, *files):
+    """
+    Sketching streams through fastas; the sketches themselves keep about one in
+    --sketch_scale k-mers, 8 bytes each, and are loaded one at a time.
+    """
+    size = sum(get_size(file) for file in files)
+    return {"cores": 1,
+            "memory": 16 * size // options.sketch_scale + options.job_memory_overhead,
+            "disk": int(size * options.disk_factor) + DISK_OVERHEAD}
+
+def sort_requirements(options, lastz_file):
+    """
+    The external sort holds --sort_buffer_size bytes of lines in memory (as python
+    strings, about twice that), and writes the runs and the sorted output to disk.
+    """
+    size = get_size(lastz_file)
+    return {"cores": 1,
+            "memory": 2 * options.sort_buffer_size + options.job_memory_overhead,
+            "disk": int(size * options.disk_factor) + DISK_OVERHEAD}
+
+def validation_requirements(options, lastz_files):
+    """
+    Validation runs a worker process per core, each holding a batch of lines and its
+    parsed arrays; a core per 64 MiB of lastz cigars, up to --max_job_cores.
+    """
+    size = get_size(lastz_files)
+    cores = max(1, min(options.max_job_cores, math.ceil(size / (64 * 1024**2))))
+    return {"cores": cores,
+            "memory": cores * 64 * cigar_validation.BATCH_BYTES + options.job_memory_overhead,
+            "disk": int(size * options.disk_factor) + DISK_OVERHEAD}
+
+def depth_requirements(options, *track_files):
+    """
+    Summing depth tracks holds them all in memory, decompressed, as several arrays of
+    8-byte run starts and depths.
+    """
+    size = sum(get_size(track_file) for track_file in track_files)
+    return {"cores": 1,
+            "memory": 32 * size + options.job_memory_overhead,
+            "disk": int(size * options.disk_factor) + DISK_OVERHEAD}
+
+def kmer_count_requirements(options, sketch_bytes, fasta=None):
+    """
+    Counting k-mers (see src/masking.py) holds the count-min sketch of sketch_bytes bytes
+    and the k-mer arrays of a chunk of sequence, about 64 bytes per base. Adding up the
+    sketches holds two, and needs the disk for all of them (sketch_bytes in all).
+    """
+    return {"cores": 1,
+            "memory": 2 * sketch_bytes + 64 * sketches.CHUNK_LENGTH + options.job_memory_overhead,
+            "disk": int(get_size(fasta) * options.disk_factor) + sketch_bytes + DISK_OVERHEAD}
+
+def masking_requirements(options, sketch_bytes, fasta):
+    """
+    Masking holds the sketch, and the largest contig (which can be most of the fasta)
+    with its masks and its masked copy.
+    """
+    size = get_size(fasta)
+    return {"cores": 1,
+            "memory": sketch_bytes + 4 * size + 64 * sketches.CHUNK_LENGTH + options.job_memory_overhead,
+            "disk": int(2 * size * options.disk_factor) + sketch_bytes + DISK_OVERHEAD}
+
+def empty_job_requirements(options):
+    """
+    For jobs that do nothing but order their successors.
+    """
+    return {"cores": 1, "memory": options.job_memory_overhead, "disk": DISK_OVERHEAD}
@@ -0,0 +1,165 @@
+import bisect
+import heapq
+
+from src import paf_to_lastz
+
+# Filtering of the secondary mappings written to the secondary lastz cigar file. Repeats
+# can give a query thousands of secondary mappings, most of them copies of the same
+# homology, which cactus then spends hours ingesting. The filter streams through the paf
+# (minimap2 writes all the mappings of a query together) and, for each query:
+#     - drops secondary mappings below --secondary_min_length, --secondary_min_identity
+#       or --secondary_min_mapq,
+#     - keeps only the --secondary_top_n best scoring secondary mappings starting in each
+#       --secondary_region_length window of the query, with a bounded heap per window,
+#     - drops secondary mappings that are almost fully contained (--secondary_max_containment)
+#       in a better mapping of the same query, in both query and target coordinates, found
+#       with an index of the better mappings' target intervals.
+# Primary mappings are never filtered. Only the mappings of one query are held in memory.
+
+def from_options(options):
+    """
+    Returns a new SecondaryFilter for the filtering options, or None if all filters are
+    off. Each converted paf needs its own filter.
+    """
+    if not (options.secondary_top_n or options.secondary_max_containment or options.secondary_min_length
+            or options.secondary_min_identity or options.secondary_min_mapq):
+        return None
+    return SecondaryFilter(options.secondary_top_n, options.secondary_region_length, options.secondary_max_containment,
+                           options.secondary_min_length, options.secondary_min_identity, options.secondary_min_mapq)
+
+class PafMapping:
+    """
+    The fields of a paf line the filter needs. score is the AS tag, or the number of
+    matching bases if the line has none.
+    """
+    __slots__ = ["query_start", "query_end", "strand", "target", "target_start", "target_end",
+                 "matches", "block_length", "mapq", "score", "order", "output"]
+
+    def __init__(self, line, order, output):
+        parsed = line.split("\t", 12)
+        self.query_start, self.query_end = int(parsed[2]), int(parsed[3])
+        self.strand = parsed[4]
+        self.target = parsed[5]
+        self.target_start, self.target_end = int(parsed[7]), int(parsed[8])
+        self.matches, self.block_length, self.mapq = int(parsed[9]), int(parsed[10]), int(parsed[11])
+        score = paf_to_lastz.AS_TAG_RE.search(line)
+        self.score = int(score.group(1)) if score is not None else self.matches
+        self.order = order
+        self.output = output
+
+class TargetIntervalIndex:
+    """
+    The target intervals of mappings on one target and strand, sorted by start. Since no
+    interval is longer than max_length, the intervals overlapping [start, end) are those
+    starting in (start - max_length, end), found by bisection.
+    """
+    def __init__(self):
+        self.starts = list()
+        self.mappings = list()
+        self.max_length = 0
+
+    def add(self, mapping):
+        i = bisect.bisect_right(self.starts, mapping.target_start)
+        self.starts.insert(i, mapping.target_start)
+        self.mappings.insert(i, mapping)
+        self.max_length = max(self.max_length, mapping.target_end - mapping.target_start)
+
+    def overlapping(self, start, end):
+        first = bisect.bisect_right(self.starts, start - self.max_length)
+        last = bisect.bisect_left(self.starts, end)
+        for mapping in self.mappings[first:last]:
+            if mapping.target_end > start:
+                yield mapping
+
+def get_overlap(start, end, other_start, other_end):
+    return max(0, min(end, other_end) - max(start, other_start))
+
+class SecondaryFilter:
+    """
+    Streaming filter of the secondary mappings of a paf (see above). Pass every line of the
+    paf, in order, to add; the outputs of the secondary mappings it keeps are returned by
+    add once all the mappings of their query have been seen, and by finish at the end.
+    """
+    def __init__(self, top_n=0, region_length=10000, max_containment=0, min_length=0, min_identity=0, min_mapq=0):
+        self.top_n = top_n
+        self.region_length = region_length
+        self.max_containment = max_containment
+        self.min_length = min_length
+        self.min_identity = min_identity
+        self.min_mapq = min_mapq
+
+        self.query = None
+        self.primaries = list()
+        # key: query region, value: min-heap of (score, -order, mapping) of at most top_n secondaries.
+        self.regions = dict()
+        self.order = 0
+        self.filtered = 0
+
+    def add(self, line, primary, output):
+        """
+        Adds the paf line of a primary or secondary mapping, with the output to write for
+        it if it's kept. Returns the list of outputs of kept secondary mappings of previous
+        queries, in the order they were added.
+        """
+        query = line.split("\t", 1)[0]
+        kept = list()
+        if query != self.query:
+            kept = self.finish()
+            self.query = query
+
+        mapping = PafMapping(line, self.order, output)
+        self.order += 1
+        if primary:
+            self.primaries.append(mapping)
+        elif self.passes_thresholds(mapping):
+            heap = self.regions.setdefault(mapping.query_start // self.region_length if self.top_n else 0, list())
+            entry = (mapping.score, -mapping.order, mapping)
+            if not self.top_n or len(heap) < self.top_n:
+                heapq.heappush(heap, entry)
+            else:
+                heapq.heappushpop(heap, entry)
+                self.filtered += 1
+        else:
+            self.filtered += 1
+        return kept
+
+    def passes_thresholds(self, mapping):
+        return (mapping.block_length >= self.min_length and mapping.mapq >= self.min_mapq
+                and mapping.matches >= self.min_identity * mapping.block_length)
+
+    def finish(self):
+        """
+        Returns the outputs of the kept secondary mappings of the current query, in the
+        order they were added, and starts over.
+        """
+        secondaries = [entry[2] for heap in self.regions.values() for entry in heap]
+        if self.max_containment:
+            secondaries = self.remove_contained(secondaries)
+        self.primaries = list()
+        self.regions = dict()
+        return [mapping.output for mapping in sorted(secondaries, key=lambda mapping: mapping.order)]
+
+    def remove_contained(self, secondaries):
+        """
+        Returns the secondaries that aren't almost fully contained in a primary mapping
+        or in a better scoring secondary mapping of the query.
+        """
+        indexes = dict()
+        for primary in self.primaries:
+            indexes.setdefault((primary.target, primary.strand), TargetIntervalIndex()).add(primary)
+
+        kept = list()
+        for mapping in sorted(secondaries, key=lambda mapping: (-mapping.score, mapping.order)):
+            index = indexes.setdefault((mapping.target, mapping.strand), TargetIntervalIndex())
+            if any(self.is_contained(mapping, other) for other in index.overlapping(mapping.target_start, mapping.target_end)):
+                self.filtered += 1
+                continue
+            index.add(mapping)
+            kept.append(mapping)
+        return kept
+
+    def is_contained(self, mapping, other):
+        target_overlap = get_overlap(mapping.target_start, mapping.target_end, other.target_start, other.target_end)
+        query_overlap = get_overlap(mapping.query_start, mapping.query_end, other.query_start, other.query_end)
+        return (target_overlap >= self.max_containment * (mapping.target_end - mapping.target_start)
+                and query_overlap >= self.max_containment * (mapping.query_end - mapping.query_start))
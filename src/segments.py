@@ -0,0 +1,45 @@
+SEGMENT_AFFIX = "_segment_"
+
+def segment_name(contig_id, start, end, contig_length):
+    """
+    Subsequences (segments) of contigs are sometimes mapped in place of the whole contig.
+    The segment id records where the segment came from, so that mappings of the segment
+    can be lifted back to the coordinates of the original contig (see lift_paf_line).
+    Segment ids follow this formula:
+    x = original contig id
+    s, e = start, end of the segment in the contig (0-based, end exclusive)
+    l = length of the original contig
+    segment id = x_segment_s_e_l
+    """
+    return contig_id + SEGMENT_AFFIX + "_".join((str(start), str(end), str(contig_length)))
+
+def parse_segment_name(name):
+    """
+    Inverse of segment_name. Returns (contig_id, start, end, contig_length), or None if
+    name isn't a segment id.
+    """
+    contig_id, affix, coords = name.rpartition(SEGMENT_AFFIX)
+    if not affix:
+        return None
+    coords = coords.split("_")
+    if len(coords) != 3 or not all(coord.isdigit() for coord in coords):
+        return None
+    return (contig_id, int(coords[0]), int(coords[1]), int(coords[2]))
+
+def lift_paf_line(line):
+    """
+    If the query of the paf line is a segment, returns the line with the query name,
+    length and coordinates lifted back to the original contig. Otherwise, returns the
+    line unchanged. Paf query coordinates are always on the + strand of the query, so "-"
+    strand mappings are lifted the same way.
+    """
+    parsed = line.split("\t")
+    segment = parse_segment_name(parsed[0])
+    if segment is None:
+        return line
+    contig_id, start, end, contig_length = segment
+    parsed[0] = contig_id
+    parsed[1] = str(contig_length)
+    parsed[2] = str(int(parsed[2]) + start)
+    parsed[3] = str(int(parsed[3]) + start)
+    return "\t".join(parsed)
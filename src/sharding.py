@@ -0,0 +1,202 @@
+from Bio import SeqIO
+
+from src import segments
+from src import compression
+from src import paf_to_lastz
+
+# cigar ops that consume query bases, target bases, or both.
+QUERY_OPS = "MI=X"
+TARGET_OPS = "MDN=X"
+ALIGNED_OPS = "M=X"
+
+def shard_fasta(fasta, shard_files, shard_size, window_length, window_overlap):
+    """
+    Splits fasta into chunks of about shard_size bases each, so that the chunks can be
+    mapped in parallel. If window_length is non-zero, contigs longer than window_length are
+    additionally split into windows of window_length that overlap by window_overlap bases.
+    Windows are named as in segments.segment_name, so mappings of them can be lifted back.
+
+    Args:
+        fasta (str): fasta file to split.
+        shard_files (function): called with no arguments, returns the path of a new, empty shard file.
+        shard_size (int): minimum number of bases in each shard (except the last).
+
+    Returns:
+        tuple: (list of the paths of the shards, in order, dictionary with key: window id,
+        value: (start, end) of the core of the window in its contig (see get_window_cores)).
+    """
+    shards = list()
+    window_cores = dict()
+    outf = None
+    shard_bases = int()
+    try:
+        with compression.open_input(fasta) as inf:
+            for contig in SeqIO.parse(inf, "fasta"):
+                windows = get_windows(contig.id, len(contig), window_length, window_overlap)
+                if len(windows) > 1:
+                    window_cores.update(get_window_cores(windows, len(contig)))
+                for record_id, start, end in windows:
+                    if outf is None:
+                        shards.append(shard_files())
+                        outf = open(shards[-1], "w")
+                    outf.write(">" + record_id + "\n" + str(contig.seq[start:end]) + "\n")
+                    shard_bases += end - start
+                    if shard_bases >= shard_size:
+                        outf.close()
+                        outf = None
+                        shard_bases = 0
+    finally:
+        if outf is not None:
+            outf.close()
+    return shards, window_cores
+
+def get_windows(contig_id, contig_length, window_length, window_overlap):
+    """
+    Returns a list of (record id, start, end) tuples covering the contig. A contig no longer
+    than window_length (or any contig, if window_length is 0) is a single record keeping its
+    own id. Otherwise, windows step by window_length - window_overlap, and the last window
+    ends at the end of the contig.
+    """
+    if not window_length or contig_length <= window_length:
+        return [(contig_id, 0, contig_length)]
+
+    step = max(window_length - window_overlap, 1)
+    windows = list()
+    start = 0
+    while True:
+        end = min(start + window_length, contig_length)
+        windows.append((segments.segment_name(contig_id, start, end, contig_length), start, end))
+        if end == contig_length:
+            return windows
+        start += step
+
+def get_window_cores(windows, contig_length):
+    """
+    Returns a dictionary with key: record id, value: (start, end) of the core of each of
+    the windows of a contig (as returned by get_windows). The cores split the contig at
+    the middle of the overlaps of neighbouring windows, so every base of the contig is in
+    the core of exactly one window.
+    """
+    boundaries = [0] + [(next_start + end) // 2 for (record_id, start, end), (next_id, next_start, next_end) in zip(windows, windows[1:])] + [contig_length]
+    return {record_id: (boundaries[i], boundaries[i + 1]) for i, (record_id, start, end) in enumerate(windows)}
+
+def merge_shard_mappings(shard_mapping_files, outfile, window_cores=None):
+    """
+    Concatenates the paf mappings of all the shards of a fasta into outfile. Mappings of
+    the windows in window_cores (as returned by shard_fasta) are lifted back to their
+    contig coordinates (see segments.lift_paf_line). Because neighbouring windows overlap,
+    a mapping crossing the overlap is found, cut short, by both windows; so each window
+    only keeps the part of its mappings in its core, which is aligned by no other window
+    (see clip_paf_line). Then mappings that are contained (in both query and target
+    coordinates) in another mapping between the same contigs on the same strand are
+    discarded, unless they are primary and the other isn't.
+
+    Returns the number of discarded mappings.
+    """
+    window_cores = window_cores or dict()
+    windowed = dict()
+    discarded = int()
+    with open(outfile, "w") as outf:
+        for mapping_file in shard_mapping_files:
+            with open(mapping_file) as inf:
+                for line in inf:
+                    core = window_cores.get(line.split("\t", 1)[0])
+                    if core is None:
+                        # unwindowed contigs can't have duplicate mappings.
+                        outf.write(line)
+                        continue
+                    line = clip_paf_line(segments.lift_paf_line(line), *core)
+                    if line is None:
+                        discarded += 1
+                        continue
+                    parsed = line.split("\t", 9)
+                    key = (parsed[0], parsed[5], parsed[4])
+                    windowed.setdefault(key, list()).append((int(parsed[2]), int(parsed[3]), int(parsed[7]), int(parsed[8]),
+                                                             "tp:A:P" in line or "tp:A:I" in line, line))
+
+        for key in sorted(windowed):
+            kept = remove_contained_mappings(windowed[key])
+            discarded += len(windowed[key]) - len(kept)
+            outf.writelines(mapping[5] for mapping in kept)
+    return discarded
+
+def clip_paf_line(line, core_start, core_end):
+    """
+    Returns the paf line clipped to the part of its mapping whose query bases are in
+    [core_start, core_end), trimmed to start and end with aligned bases, or None if no
+    aligned bases are left. Matches, NM and AS are scaled to the aligned bases kept, since
+    the cigar doesn't tell matches from mismatches; other tags are left as they are. A line
+    without a cg tag can't be clipped, so it's kept whole if the middle of its query
+    interval is in the core, and dropped otherwise.
+    """
+    parsed = line.rstrip("\n").split("\t")
+    query_start, query_end = int(parsed[2]), int(parsed[3])
+    if core_start <= query_start and query_end <= core_end:
+        return line
+    cigar_field = next((i for i, field in enumerate(parsed) if field.startswith("cg:Z:")), None)
+    if cigar_field is None:
+        return line if core_start <= (query_start + query_end) // 2 < core_end else None
+
+    # the cigar walks the query forwards on the + strand and backwards on the - strand.
+    if parsed[4] == "+":
+        low, high = core_start - query_start, core_end - query_start
+    else:
+        low, high = query_end - core_end, query_end - core_start
+    # [length, op, query offset, target offset] of the kept ops, offsets from the start of the cigar.
+    ops = list()
+    query_offset = target_offset = 0
+    for length, op in paf_to_lastz.CIGAR_OP_RE.findall(parsed[cigar_field][5:]):
+        length = int(length)
+        if op in QUERY_OPS:
+            start, end = max(query_offset, low), min(query_offset + length, high)
+            if start < end:
+                ops.append([end - start, op, start, target_offset + (start - query_offset if op in TARGET_OPS else 0)])
+            query_offset += length
+        elif low < query_offset < high:
+            ops.append([length, op, query_offset, target_offset])
+        if op in TARGET_OPS:
+            target_offset += length
+    while ops and ops[0][1] not in ALIGNED_OPS:
+        ops.pop(0)
+    while ops and ops[-1][1] not in ALIGNED_OPS:
+        ops.pop()
+    if not ops:
+        return None
+
+    last_length, last_op, last_query, last_target = ops[-1]
+    query_low, query_high = ops[0][2], last_query + last_length
+    target_low, target_high = ops[0][3], last_target + last_length
+    if parsed[4] == "+":
+        parsed[2], parsed[3] = str(query_start + query_low), str(query_start + query_high)
+    else:
+        parsed[2], parsed[3] = str(query_end - query_high), str(query_end - query_low)
+    target_start = int(parsed[7])
+    parsed[7], parsed[8] = str(target_start + target_low), str(target_start + target_high)
+    block_length = sum(op[0] for op in ops)
+    fraction = block_length / int(parsed[10])
+    parsed[9] = str(round(int(parsed[9]) * fraction))
+    parsed[10] = str(block_length)
+    for i, field in enumerate(parsed):
+        if field.startswith("NM:i:") or field.startswith("AS:i:"):
+            parsed[i] = field[:5] + str(round(int(field[5:]) * fraction))
+    parsed[cigar_field] = "cg:Z:" + "".join(str(length) + op for length, op, query, target in ops)
+    return "\t".join(parsed) + "\n"
+
+def remove_contained_mappings(mappings):
+    """
+    Given (query_start, query_end, target_start, target_end, primary, ...) tuples between
+    the same query and target on the same strand, returns them sorted by query coordinates
+    without the ones contained in another (larger, or identical and earlier) mapping. A
+    primary mapping is only discarded if it's contained in another primary mapping; of
+    identical mappings, primary ones come first.
+    """
+    kept = list()
+    active = list()
+    for mapping in sorted(mappings, key=lambda mapping: (mapping[0], -mapping[1], mapping[2], -mapping[3], not mapping[4])):
+        # mappings ending before this one starts can't contain it, or any later one.
+        active = [other for other in active if other[1] >= mapping[0]]
+        if any(other[1] >= mapping[1] and other[2] <= mapping[2] and other[3] >= mapping[3] and (other[4] or not mapping[4]) for other in active):
+            continue
+        kept.append(mapping)
+        active.append(mapping)
+    return kept
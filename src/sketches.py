@@ -0,0 +1,149 @@
+import numpy as np
+
+from src import compression
+from src import instrumentation
+
+# FracMinHash sketches of fastas, for estimating which assemblies share sequence before
+# aligning them. A sketch is the sorted set of hashes of the fasta's canonical k-mers that
+# fall below 2**64 / scale, so about one in scale distinct k-mers is kept. Unlike a
+# fixed-size MinHash, sketches of very differently sized inputs (e.g. the poorly mapped
+# segments of one assembly and another whole assembly) can be compared directly: the
+# fraction of the query's hashes that are also in the target's sketch estimates the
+# fraction of the query's k-mers that are contained in the target.
+
+# 2-bit codes of the bases; everything else (N, IUPAC codes) is 4 and breaks k-mers.
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, bases in enumerate(["Aa", "Cc", "Gg", "Tt"]):
+    for base in bases:
+        BASE_CODES[ord(base)] = code
+# sequence is sketched in chunks of this many bases, to bound the memory of the k-mer arrays.
+CHUNK_LENGTH = 4 * 1024**2
+
+@instrumentation.instrumented("sketch")
+def sketch_assembly(job, fasta, k, scale):
+    """
+    Sketches the fasta (global file) of an assembly, for choosing the assemblies the poorly
+    mapped segments of other assemblies are re-mapped to. Returns the global sketch file.
+    """
+    sketch = sketch_fasta(job.fileStore.readGlobalFile(fasta), k, scale)
+    instrumentation.count_records(job, hashes=len(sketch))
+    sketch_file = job.fileStore.getLocalTempFile()
+    write_sketch(sketch, sketch_file)
+    return job.fileStore.writeGlobalFile(sketch_file)
+
+def sketch_fasta(fasta, k=21, scale=1000):
+    """
+    Returns the sketch (a sorted numpy array of unique uint64 hashes) of all the contigs
+    in fasta, which may be gzip compressed.
+    """
+    if not 0 < k <= 32:
+        raise ValueError("k-mers must be between 1 and 32 bases long to be sketched, not " + str(k))
+    hashes = [np.zeros(0, dtype=np.uint64)]
+    chunk = bytearray()
+    with compression.open_input(fasta, "rb") as inf:
+        for line in inf:
+            if line.startswith(b">"):
+                hashes.append(sketch_sequence(chunk, k, scale))
+                chunk = bytearray()
+                continue
+            chunk += line.rstrip(b"\r\n")
+            if len(chunk) >= CHUNK_LENGTH:
+                hashes.append(sketch_sequence(chunk, k, scale))
+                # keep the last k - 1 bases, so that k-mers spanning the chunks are sketched too.
+                chunk = chunk[len(chunk) - k + 1:]
+    hashes.append(sketch_sequence(chunk, k, scale))
+    return np.unique(np.concatenate(hashes))
+
+def sketch_sequence(sequence, k, scale):
+    """
+    Returns the hashes of the canonical k-mers of sequence (bytes) below 2**64 / scale.
+    """
+    hashes, valid = hash_sequence(sequence, k)
+    hashes = hashes[valid]
+    return hashes[hashes <= np.uint64(2**64 // scale - 1)]
+
+def hash_sequence(sequence, k):
+    """
+    Returns (the hashes of the canonical k-mers starting at each position of sequence
+    (bytes), whether each k-mer is valid, i.e. made only of ACGT).
+    """
+    codes = BASE_CODES[np.frombuffer(bytes(sequence), dtype=np.uint8)]
+    kmer_count = len(codes) - k + 1
+    if kmer_count <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+
+    forward = np.zeros(kmer_count, dtype=np.uint64)
+    reverse = np.zeros(kmer_count, dtype=np.uint64)
+    for i in range(k):
+        base = codes[i:i + kmer_count].astype(np.uint64) & np.uint64(3)
+        forward = (forward << np.uint64(2)) | base
+        reverse |= (np.uint64(3) - base) << np.uint64(2 * i)
+
+    # k-mers containing anything but ACGT are invalid.
+    invalid = np.concatenate([[0], np.cumsum(codes == 4)])
+    valid = invalid[k:] == invalid[:kmer_count]
+
+    return hash_kmers(np.minimum(forward, reverse)), valid
+
+def hash_kmers(kmers):
+    """
+    The 64 bit finalizer of MurmurHash3, which spreads k-mers uniformly over the uint64
+    range.
+    """
+    with np.errstate(over="ignore"):
+        kmers = kmers ^ (kmers >> np.uint64(33))
+        kmers = kmers * np.uint64(0xff51afd7ed558ccd)
+        kmers = kmers ^ (kmers >> np.uint64(33))
+        kmers = kmers * np.uint64(0xc4ceb9fe1a85ec53)
+        return kmers ^ (kmers >> np.uint64(33))
+
+def write_sketch(sketch, sketch_file):
+    with open(sketch_file, "wb") as outf:
+        np.save(outf, sketch)
+
+def read_sketch(sketch_file):
+    with open(sketch_file, "rb") as inf:
+        return np.load(inf)
+
+def containment(query, target):
+    """
+    Estimated fraction of the k-mers of the query that are also in the target, from their
+    sketches. None if the query's sketch is empty (too little sequence to estimate it).
+    """
+    if len(query) == 0:
+        return None
+    return len(np.intersect1d(query, target, assume_unique=True)) / len(query)
+
+def choose_partners(containments, top_k, min_containment):
+    """
+    Given a dictionary with key: partner, value: containment of the query in the partner
+    (see containment), returns the list of the top_k partners with the highest
+    containment, leaving out any below min_containment. If the containment can't be
+    estimated, all partners are returned, since none can be ruled out. Partners are
+    returned in the order of containments.
+    """
+    if any(value is None for value in containments.values()):
+        return list(containments)
+    candidates = [partner for partner, value in containments.items() if value >= min_containment]
+    chosen = set(sorted(candidates, key=lambda partner: containments[partner], reverse=True)[:top_k])
+    return [partner for partner in containments if partner in chosen]
+
+def choose_remap_partners(segment_files, sketch_files, top_k, min_containment, k=21, scale=1000):
+    """
+    Chooses the assemblies that the poorly mapped segments of each assembly are re-mapped
+    to (see choose_partners). segment_files is a dictionary with key: assembly, value:
+    local fasta of its poorly mapped segments, and sketch_files one with key: assembly,
+    value: local sketch file of the whole assembly. Each assembly's sketch is read once,
+    so only one is in memory at a time.
+
+    Returns a dictionary with key: assembly, value: list of its partners, in the order of
+    sketch_files.
+    """
+    segment_sketches = {assembly: sketch_fasta(segment_file, k, scale) for assembly, segment_file in segment_files.items()}
+    containments = {assembly: dict() for assembly in segment_files}
+    for other_assembly, sketch_file in sketch_files.items():
+        other_sketch = read_sketch(sketch_file)
+        for assembly, segment_sketch in segment_sketches.items():
+            if assembly != other_assembly:
+                containments[assembly][other_assembly] = containment(segment_sketch, other_sketch)
+    return {assembly: choose_partners(containments[assembly], top_k, min_containment) for assembly in segment_files}
@@ -0,0 +1,210 @@
+import gzip
+import heapq
+import os
+import tempfile
+
+from src import compression
+
+# Lastz cigar outputs sorted by target contig and start coordinate (--sorted_output), so
+# that consumers can seek straight to the alignments of a region, or process contigs in
+# parallel, instead of scanning the whole file.
+#
+# The lines are sorted with an external merge sort: runs of at most --sort_buffer_size
+# bytes are sorted in memory and written to temporary files, then merged. The sorted lines
+# are written either:
+#     - "split": to one file per target contig in a directory, listed in CONTIGS_FILE.
+#     - "indexed": to a single file, with an index (INDEX_SUFFIX) of the byte offset and
+#       length of each block of lines of a contig starting in the same --index_block_size
+#       window of the contig. If compressed, each block is its own gzip member, so that it
+#       can be decompressed on its own from its offset (as in bgzip).
+
+CONTIGS_FILE = "contigs.tsv"
+INDEX_SUFFIX = ".idx"
+# runs merged at once; more runs are merged in several passes, to bound the open files.
+MAX_MERGE_RUNS = 256
+
+def get_sort_key(line):
+    """
+    Lastz cigar lines are "cigar: query_id query_start query_end query_strand target_id
+    target_start target_end ...". They're sorted by target_id, then target_start.
+    """
+    parsed = line.split(" ", 7)
+    return parsed[5], int(parsed[6])
+
+def get_target_end(line):
+    return int(line.split(" ", 8)[7])
+
+def write_runs(lines, run_dir, buffer_size, key=get_sort_key):
+    """
+    Splits lines into runs of at most buffer_size bytes (or a single line), sorts each run
+    by key and writes it to a file in run_dir. Returns the run files, in order.
+    """
+    run_files = list()
+    def write_run(lines):
+        lines.sort(key=key)
+        run_files.append(os.path.join(run_dir, "run_" + str(len(run_files))))
+        with open(run_files[-1], "w") as outf:
+            outf.writelines(lines)
+
+    run = list()
+    size = 0
+    for line in lines:
+        run.append(line)
+        size += len(line)
+        if size >= buffer_size:
+            write_run(run)
+            run = list()
+            size = 0
+    if run or not run_files:
+        write_run(run)
+    return run_files
+
+def merge_runs(run_files, run_dir, key=get_sort_key):
+    """
+    Merges the run_files sorted by key, MAX_MERGE_RUNS at a time, until one is left; returns it.
+    Lines with equal keys stay in the order of the runs, so the sort is stable.
+    """
+    while len(run_files) > 1:
+        merged_files = list()
+        for i in range(0, len(run_files), MAX_MERGE_RUNS):
+            merged_files.append(os.path.join(run_dir, "merged_" + str(len(merged_files)) + "_" + os.path.basename(run_files[i])))
+            infs = [open(run_file) for run_file in run_files[i:i + MAX_MERGE_RUNS]]
+            try:
+                with open(merged_files[-1], "w") as outf:
+                    outf.writelines(heapq.merge(*infs, key=key))
+            finally:
+                for inf in infs:
+                    inf.close()
+            for run_file in run_files[i:i + MAX_MERGE_RUNS]:
+                os.remove(run_file)
+        run_files = merged_files
+    return run_files[0]
+
+def sort_lastz_file(infile, outfile, buffer_size, tmp_dir=None):
+    """
+    Writes the lines of the lastz cigar file infile (possibly gzip compressed) to outfile,
+    uncompressed and sorted by target contig and start, holding about buffer_size bytes
+    of lines in memory at a time.
+    """
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir, compression.open_input(infile) as inf:
+        os.replace(merge_runs(write_runs(inf, run_dir, buffer_size), run_dir), outfile)
+
+def get_contig_blocks(sorted_file, block_size):
+    """
+    Yields (contig, block_start, lines) for each block of lines of sorted_file with the same
+    contig and target_start // block_size, in order.
+    """
+    block = None
+    lines = list()
+    with open(sorted_file) as inf:
+        for line in inf:
+            contig, start = get_sort_key(line)
+            line_block = (contig, start - start % block_size)
+            if line_block != block and lines:
+                yield block + (lines,)
+                lines = list()
+            block = line_block
+            lines.append(line)
+    if lines:
+        yield block + (lines,)
+
+def write_split(sorted_file, out_dir, compress=False):
+    """
+    Writes the lines of sorted_file to one file per contig in out_dir, and lists them in
+    CONTIGS_FILE (contig, file name, number of lines). Returns the file names, CONTIGS_FILE
+    last.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    contig_files = list()
+    outf = None
+    contig = None
+    try:
+        with open(sorted_file) as inf:
+            for line in inf:
+                line_contig = get_sort_key(line)[0]
+                if line_contig != contig:
+                    if outf is not None:
+                        outf.close()
+                    contig = line_contig
+                    # contig ids can't have whitespace, but they can have path separators.
+                    name = str(len(contig_files)) + "_" + contig.replace(os.sep, "_") + ".cigar" + (".gz" if compress else "")
+                    contig_files.append([contig, name, 0])
+                    outf = compression.open_output(os.path.join(out_dir, name), compress)
+                outf.write(line)
+                contig_files[-1][2] += 1
+    finally:
+        if outf is not None:
+            outf.close()
+
+    with open(os.path.join(out_dir, CONTIGS_FILE), "w") as outf:
+        for contig_file in contig_files:
+            outf.write("\t".join(str(field) for field in contig_file) + "\n")
+    return [contig_file[1] for contig_file in contig_files] + [CONTIGS_FILE]
+
+def write_indexed(sorted_file, outfile, block_size, compress=False):
+    """
+    Copies sorted_file to outfile block by block (see get_contig_blocks), compressing each
+    block as a separate gzip member if compress, and writes the index of the blocks to
+    outfile + INDEX_SUFFIX: one line of contig, block_start, offset and length in bytes of
+    the block in outfile, and the largest target_end of its lines. Returns the index file.
+    """
+    index_file = outfile + INDEX_SUFFIX
+    offset = 0
+    with open(outfile, "wb") as outf, open(index_file, "w") as indexf:
+        for contig, block_start, lines in get_contig_blocks(sorted_file, block_size):
+            block = "".join(lines).encode()
+            if compress:
+                block = gzip.compress(block)
+            outf.write(block)
+            max_end = max(get_target_end(line) for line in lines)
+            indexf.write("\t".join([contig, str(block_start), str(offset), str(len(block)), str(max_end)]) + "\n")
+            offset += len(block)
+    return index_file
+
+def write_sorted_output(lastz_file, out_path, mode, buffer_size, block_size, compress=False, tmp_dir=None):
+    """
+    Sorts the lastz cigar file lastz_file, then writes it to out_path in the --sorted_output
+    mode: "split" (out_path is a directory, see write_split) or "indexed" (see
+    write_indexed). Returns the files written, relative to out_path's directory in
+    "split" mode.
+    """
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as sort_dir:
+        sorted_file = os.path.join(sort_dir, "sorted.cigar")
+        sort_lastz_file(lastz_file, sorted_file, buffer_size, sort_dir)
+        if mode == "split":
+            return write_split(sorted_file, out_path, compress)
+        elif mode == "indexed":
+            return [out_path, write_indexed(sorted_file, out_path, block_size, compress)]
+        raise ValueError("Unknown --sorted_output mode " + str(mode))
+
+## for consumers of indexed outputs:
+
+def read_index(index_file):
+    """
+    Returns a dictionary with key: contig, value: list of (block_start, offset, length,
+    max_end) of its blocks, in order.
+    """
+    index = dict()
+    with open(index_file) as inf:
+        for line in inf:
+            contig, block_start, offset, length, max_end = line.rstrip("\n").split("\t")
+            index.setdefault(contig, list()).append((int(block_start), int(offset), int(length), int(max_end)))
+    return index
+
+def fetch(indexed_file, index, contig, start=0, end=None):
+    """
+    Yields the lines of indexed_file (see write_indexed) of alignments to contig that
+    overlap [start, end), reading only the blocks that may hold them.
+    """
+    with open(indexed_file, "rb") as inf:
+        for block_start, offset, length, max_end in index.get(contig, list()):
+            if (end is not None and block_start >= end) or max_end <= start:
+                continue
+            inf.seek(offset)
+            block = inf.read(length)
+            if block[:2] == compression.GZIP_MAGIC:
+                block = gzip.decompress(block)
+            for line in block.decode().splitlines(keepends=True):
+                line_start = get_sort_key(line)[1]
+                if (end is None or line_start < end) and get_target_end(line) > start:
+                    yield line
@@ -1,32 +1,26 @@
 import pytest
 
 import sys
+import os
 # insert at 1, 0 is the script path (or '' in REPL)
-sys.path.insert(1, '..')
-import minimap2_cactus_aligner_toil as cactus_aligner
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import fasta_preprocessing
 
-from toil.common import Toil
-from toil.job import Job
-from argparse import ArgumentParser
-import os
-import shutil
+import tempfile
 from Bio import SeqIO
 import collections as col
 
 
-def get_options():
-    parser = ArgumentParser()
-    Job.Runner.addToilOptions(parser)
-
-    # options.test_fasta = "my_test_fasta.fa"
-    # options.test_sam = "my_test_sam.fa"
-    # options.mapq_cutoff = 20
-    # options.sequence_context = 5 # currently normally 10000
-    options = parser.parse_args()
-    
-    return options
-
 def make_assembly_files_for_test_rename_duplicate_contig_ids(test_dir):
+    test_ref = test_dir + "ref.fa"
+    with open(test_ref, "w") as f:
+        f.write(
+""">1 reference contig
+AATTAACC
+>5
+AATTCCGG"""
+                )
+
     test_fa1 = test_dir + "fa1.fa"
     with open(test_fa1, "w") as f:
         f.write(
@@ -51,117 +45,78 @@ AATTCCGA
 AATTGCGA"""
                 )
 
-    return [os.path.abspath(test_fa1), os.path.abspath(test_fa2)]
-
-def test_rename_duplicate_contig_ids():
-    """
-    Note: test_tmp is a directory reserved by this function. If you have that directory in
-    the test directory, it will be deleted.
-    """
-    
-    options = get_options()
+    test_fa3 = test_dir + "fa3.fa"
+    with open(test_fa3, "w") as f:
+        f.write(
+""">6
+AATTAACC
+>7
+AATTCCGA"""
+                )
 
-    # make the directories for testing:
-    if os.path.isdir("./test_tmp/"):
-        shutil.rmtree("./test_tmp/")
-    os.mkdir("./test_tmp/")
-    os.mkdir("./test_tmp/test_rename_duplicate_contig_ids/")
-    file_dir = "./test_tmp/test_rename_duplicate_contig_ids/overwrite_fastas/"
-    os.mkdir(file_dir)
+    return {"ref": os.path.abspath(test_ref), "fa1": os.path.abspath(test_fa1), "fa2": os.path.abspath(test_fa2), "fa3": os.path.abspath(test_fa3)}
 
-    # make the files for testing
-    assembly_files = make_assembly_files_for_test_rename_duplicate_contig_ids(file_dir)
-        
-    with Toil(options) as workflow:
-        # import the files into the workflow
-        assembly_ids = list()
-        for assembly_file in assembly_files:
-            assembly_ids.append(workflow.importFile('file://' + assembly_file))
-
-        # run the function being tested
-        new_assembly_ids = workflow.start(Job.wrapJobFn(cactus_aligner.rename_duplicate_contig_ids, assembly_ids))
-
-        # export the files from the workflow
-        for i in range(len(new_assembly_ids)):
-            # print("++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++",assembly_files[i])
-            # print("++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++", new_assembly_ids[i])
-            workflow.exportFile(new_assembly_ids[i], 'file://' + assembly_files[i])
-            # output_file = assembly_files[i]
-            # workflow.exportFile(new_assembly_ids[i], "file://" + output_file)
-    
-    # print("new_assembly_files", new_assembly_files)
+def check_contig_ids_unique(assembly_files):
     id_counts = col.Counter()
-    for assembly in assembly_files:
-        # print(os.path.abspath(assembly))
+    for assembly in assembly_files.values():
         assembly_contigs = SeqIO.parse(assembly, "fasta")
         for contig in assembly_contigs:
-            # print("contig.id", contig.id)
             id_counts[contig.id] += 1
     
     for contig_id, count in id_counts.items():
         assert count == 1, "contig id %r exists still exists multiple (%r) times in fasta files" % (contig_id, count)
-        
-    shutil.rmtree("./test_tmp/")
-
-# def test_rename_duplicate_contig_ids_no_overwrite():
-#     """
-#TODO: make this function work again (needs integration with larger workflow)
-#     Note: test_tmp is a directory reserved by this function. If you have that directory in
-#     the test directory, it will be deleted.
-#     """
-    
-#     options = get_options()
-
-#     # make the directories for testing:
-#     if os.path.isdir("./test_tmp/"):
-#         shutil.rmtree("./test_tmp/")
-#     os.mkdir("./test_tmp/")
-#     os.mkdir("./test_tmp/test_rename_duplicate_contig_ids/")
-#     input_file_dir = "./test_tmp/test_rename_duplicate_contig_ids/input_fastas/"
-#     os.mkdir(input_file_dir)
-#     output_file_dir = "./test_tmp/test_rename_duplicate_contig_ids/output_fastas/"
-#     os.mkdir(output_file_dir)
-
-#     # make the files for testing
-#     assembly_files = make_assembly_files_for_test_rename_duplicate_contig_ids(input_file_dir)
-        
-#     # new_assembly_files will be the function output.
-#     new_assembly_files = list()
-
-#     with Toil(options) as workflow:
-#         # import the files into the workflow
-#         assembly_ids = list()
-#         for assembly_file in assembly_files:
-#             assembly_ids.append(workflow.importFile('file://' + assembly_file))
-
-#         # run the function being tested
-#         new_assembly_ids = workflow.start(Job.wrapJobFn(cactus_aligner.rename_duplicate_contig_ids, assembly_ids, overwrite=False))
-
-#         # export the files from the workflow
-#         for i in range(len(new_assembly_ids)):
-#             output_file = os.path.abspath(output_file_dir + "fa_" + str(i) + ".fa")
-#             workflow.exportFile(new_assembly_ids[i], "file://" + output_file)
-#             new_assembly_files.append(output_file)
-    
-#     # print("new_assembly_files", new_assembly_files)
-#     id_counts = col.Counter()
-#     for new_assembly in new_assembly_files:
-#         # print(os.path.abspath(new_assembly))
-#         assembly_contigs = SeqIO.parse(new_assembly, "fasta")
-#         for contig in assembly_contigs:
-#             # print("contig.id", contig.id)
-#             id_counts[contig.id] += 1
-    
-#     for contig_id, count in id_counts.items():
-#         assert count == 1, "contig id %r exists still exists multiple (%r) times in fasta files" % (contig_id, count)
-        
-#     shutil.rmtree("./test_tmp/")
 
+def test_rename_duplicate_contig_ids(tmp_path):
+    file_dir = str(tmp_path) + "/"
+
+    # make the files for testing
+    assembly_files = make_assembly_files_for_test_rename_duplicate_contig_ids(file_dir)
+    with open(assembly_files["fa3"]) as inf:
+        fa3_contents = inf.read()
+
+    # run the function being tested, overwriting the assemblies.
+    new_assembly_files = fasta_preprocessing.rename_duplicate_contig_ids(assembly_files, "ref", dict(assembly_files), processes=2)
+
+    assert new_assembly_files == assembly_files
+    check_contig_ids_unique(new_assembly_files)
+
+    # renames are deterministic, in assembly order.
+    assert [contig.id for contig in SeqIO.parse(assembly_files["fa1"], "fasta")] == ["1_renamed_0", "1_renamed_1", "2", "3"]
+    assert [contig.id for contig in SeqIO.parse(assembly_files["fa2"], "fasta")] == ["1_renamed_2", "2_renamed_3", "4"]
+    # sequences are untouched.
+    assert [str(contig.seq) for contig in SeqIO.parse(assembly_files["fa1"], "fasta")] == ["AATTAACC", "AATTCCGG", "AATTCCGA", "AATTGCGA"]
+    # the reference and assemblies without duplicates aren't rewritten.
+    with open(assembly_files["ref"]) as inf:
+        assert inf.readline() == ">1 reference contig\n"
+    with open(assembly_files["fa3"]) as inf:
+        assert inf.read() == fa3_contents
+
+def test_rename_duplicate_contig_ids_no_overwrite(tmp_path):
+    input_file_dir = str(tmp_path) + "/input_fastas/"
+    os.mkdir(input_file_dir)
+    output_file_dir = str(tmp_path) + "/output_fastas/"
+    os.mkdir(output_file_dir)
+
+    # make the files for testing
+    assembly_files = make_assembly_files_for_test_rename_duplicate_contig_ids(input_file_dir)
+    output_files = {asm: output_file_dir + os.path.basename(assembly_file) for asm, assembly_file in assembly_files.items()}
+
+    # run the function being tested
+    new_assembly_files = fasta_preprocessing.rename_duplicate_contig_ids(assembly_files, "ref", output_files)
+
+    # only the assemblies with duplicate ids are copied.
+    assert new_assembly_files == {"ref": assembly_files["ref"], "fa1": output_files["fa1"], "fa2": output_files["fa2"], "fa3": assembly_files["fa3"]}
+    assert sorted(os.listdir(output_file_dir)) == ["fa1.fa", "fa2.fa"]
+    check_contig_ids_unique(new_assembly_files)
+
+    # the input assemblies aren't touched.
+    assert [contig.id for contig in SeqIO.parse(assembly_files["fa1"], "fasta")] == ["1", "1", "2", "3"]
 
 
 
 def main():
-        test_rename_duplicate_contig_ids()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            test_rename_duplicate_contig_ids(tmp_dir)
 
 if __name__ == "__main__":
     main()
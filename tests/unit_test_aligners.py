@@ -0,0 +1,82 @@
+import pytest
+
+import sys
+import os
+import random
+from argparse import Namespace
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import aligners
+from src import paf_to_lastz
+
+def write_fasta(path, contigs):
+    with open(path, "w") as outf:
+        for contig_id, seq in contigs:
+            outf.write(">" + contig_id + "\n" + seq + "\n")
+
+def mutate(seq):
+    seq = list(seq)
+    for i in range(250, len(seq), 500):
+        seq[i] = "A" if seq[i] != "A" else "C"
+    return "".join(seq)
+
+def test_get_preset():
+    assert aligners.get_preset(["-cx", "asm5"]) == "asm5"
+    assert aligners.get_preset(["-x", "asm20", "-t", "4"]) == "asm20"
+    with pytest.raises(ValueError):
+        aligners.get_preset(["-c", "--secondary=no"])
+
+def test_get_score():
+    # 45 matches, 5 mismatches, a 2 base deletion and a 1 base insertion.
+    hit = Namespace(cigar=[[20, 0], [2, 2], [30, 0], [1, 1]], mlen=45)
+    assert aligners.get_score(hit, aligners.PRESET_SCORING["asm5"]) == 45 - 5 * 19 - (39 + 2 * 3) - (39 + 3)
+    # long gaps cost less with the second gap penalties.
+    hit = Namespace(cigar=[[100, 0], [50, 2], [100, 0]], mlen=200)
+    assert aligners.get_score(hit, aligners.PRESET_SCORING["asm5"]) == 200 - (81 + 50)
+
+def test_get_paf_line():
+    hit = Namespace(q_st=0, q_en=50, strand=-1, ctg="t1", ctg_len=500, r_st=300, r_en=349, mlen=45, blen=50, mapq=0, NM=5,
+                    is_primary=False, cigar=[[10, 0], [1, 1], [39, 0]], cigar_str="10M1I39M")
+    line = aligners.get_paf_line("q2", 100, hit)
+    assert line == "q2\t100\t0\t50\t-\tt1\t500\t300\t349\t45\t50\t0\tNM:i:5\ttp:A:S\tcg:Z:10M1I39M\n"
+    # lastz cigars of "-" strand mappings go from the end of the query to its start.
+    assert paf_to_lastz.paf_line_to_lastz(line) == "cigar: q2 50 0 - t1 300 349 + 0 M 10 I 1 M 39\n"
+    assert "\tAS:i:" in aligners.get_paf_line("q2", 100, hit, aligners.PRESET_SCORING["asm5"])
+
+@pytest.mark.skipif(aligners.mappy is None, reason="mappy isn't installed")
+def test_map_fasta(tmp_path, monkeypatch):
+    rng = random.Random(0)
+    ref = [("r" + str(i), "".join(rng.choices("ACGT", k=20000))) for i in range(3)]
+    write_fasta(str(tmp_path / "ref.fa"), ref)
+    # pieces of the reference, one of them reverse complemented.
+    complement = str.maketrans("ACGT", "TGCA")
+    queries = [("q" + str(i), mutate(seq[2000:12000])) for i, (name, seq) in enumerate(ref)]
+    queries.append(("q3", queries[0][1].translate(complement)[::-1]))
+    write_fasta(str(tmp_path / "asm.fa"), queries)
+
+    index = str(tmp_path / "ref.mmi")
+    aligners.build_index(str(tmp_path / "ref.fa"), index, "asm5")
+    aligner = aligners.load_index(index, "asm5")
+    # loaded once per process.
+    assert aligners.load_index(index, "asm5") is aligner
+
+    lines = list(aligners.map_fasta(aligner, str(tmp_path / "asm.fa"), 1, aligners.PRESET_SCORING["asm5"]))
+    primary = [line.split("\t") for line in lines if "tp:A:P" in line]
+    assert [(fields[0], fields[4], fields[5], fields[7], fields[8]) for fields in primary] == \
+           [("q0", "+", "r0", "2000", "12000"), ("q1", "+", "r1", "2000", "12000"), ("q2", "+", "r2", "2000", "12000"), ("q3", "-", "r0", "2000", "12000")]
+    # 20 mismatches.
+    assert "AS:i:" + str(9980 - 20 * 19) in lines[0]
+
+    # the same lines, in the same order, with several threads and batches.
+    monkeypatch.setattr(aligners, "BATCH_BASES", 15000)
+    assert list(aligners.map_fasta(aligner, str(tmp_path / "asm.fa"), 3, aligners.PRESET_SCORING["asm5"])) == lines
+
+    paf_file = str(tmp_path / "asm.paf")
+    assert list(aligners.tee_paf(iter(lines), paf_file)) == lines
+    with open(paf_file) as inf:
+        assert inf.readlines() == lines
+
+@pytest.mark.skipif(aligners.mappy is None, reason="mappy isn't installed")
+def test_load_index_failure(tmp_path):
+    with pytest.raises(RuntimeError):
+        aligners.load_index(str(tmp_path / "missing.mmi"), "asm5")
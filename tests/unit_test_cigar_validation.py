@@ -0,0 +1,96 @@
+import pytest
+
+import sys
+import os
+import gzip
+import random
+import numpy as np
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import cigar_validation
+from src import fasta_index
+
+CONTIG_LENGTHS = {b"q1": 100, b"q2": 100, b"t1": 500}
+VALID_LINES = [
+    "cigar: q1 10 60 + t1 200 252 + 80 M 20 D 2 M 30\n",
+    "cigar: q2 50 0 - t1 300 349 + 70 M 10 I 1 M 39\n",
+    "cigar: q1 0 0 + t1 0 0 + 0\n",
+]
+
+def get_lastz_lines(count, seed=0):
+    rng = random.Random(seed)
+    lines = list()
+    for i in range(count):
+        cigar = [(rng.randrange(1, 300), rng.choice("MID")) for j in range(rng.randrange(1, 6))]
+        query_span = sum(length for length, op in cigar if op in "MI")
+        target_span = sum(length for length, op in cigar if op in "MD")
+        query_start = rng.randrange(10000)
+        target_start = rng.randrange(10000)
+        strand = rng.choice("+-")
+        query = [query_start, query_start + query_span] if strand == "+" else [query_start + query_span, query_start]
+        lines.append(" ".join(["cigar:", "q1", str(query[0]), str(query[1]), strand, "t1", str(target_start), str(target_start + target_span),
+                               "+", str(rng.randrange(1000))] + [str(field) for length, op in cigar for field in (op, length)]) + "\n")
+    return lines
+
+def test_parse_numbers():
+    buf = np.frombuffer(b"0 12 345 6x7 1234567890123456789", dtype=np.uint8)
+    starts, ends = cigar_validation.get_tokens(buf)
+    values, valid = cigar_validation.parse_numbers(buf, starts, ends)
+    assert values[:3].tolist() == [0, 12, 345]
+    assert valid.tolist() == [True, True, True, False, False]
+
+def test_valid_lines():
+    summary = cigar_validation.validate_batch("".join(VALID_LINES).encode(), CONTIG_LENGTHS)
+    assert summary["lines"] == 3
+    assert summary["problem_lines"] == 0
+    # the last line may lack its newline.
+    assert cigar_validation.validate_batch("".join(VALID_LINES).rstrip("\n").encode())["problem_lines"] == 0
+
+@pytest.mark.parametrize("line,problems", [
+    ("cigar: q2 0 50 - t1 300 349 + 70 M 10 I 1 M 39", ["strand"]),
+    ("cigar: q1 10 61 + t1 200 252 + 80 M 20 D 2 M 30", ["query_span"]),
+    ("cigar: q1 10 60 + t1 200 253 + 80 M 20 D 2 M 30", ["target_span"]),
+    ("cigar: q1 10 60 + t9 200 252 + 80 M 20 D 2 M 30", ["unknown_contig"]),
+    ("cigar: q1 60 110 + t1 200 252 + 80 M 20 D 2 M 30", ["query_bounds"]),
+    ("cigar: q1 10 60 + t1 480 532 + 80 M 20 D 2 M 30", ["target_bounds"]),
+    ("cigar: q1 10 60 + t1 200 252 + 80 M 20 D 2 M", ["malformed"]),
+    ("cigar: q1 10 60 + t1 200 252 + 80 M 20 D x M 30", ["malformed"]),
+    ("cigar: q1 10 60 + t1 200 252 + 80 M 20 Q 2 M 30", ["malformed"]),
+    ("cigar: q1 -10 60 + t1 200 252 + 80 M 20 D 2 M 30", ["malformed"]),
+    ("cigar: q1 10 60 * t1 200 252 + 80 M 20 D 2 M 30", ["malformed"]),
+    ("lastz: q1 10 60 + t1 200 252 + 80 M 20 D 2 M 30", ["malformed"]),
+    ("", ["malformed"]),
+])
+def test_problems(line, problems):
+    summary = cigar_validation.validate_batch((VALID_LINES[0] + line + "\n" + VALID_LINES[1]).encode(), CONTIG_LENGTHS)
+    assert summary["lines"] == 3
+    assert summary["problem_lines"] == 1
+    assert summary["examples"] == [(1, problems, line)]
+    assert [problem for problem, count in summary["problems"].items() if count] == problems
+
+def test_without_contig_lengths():
+    line = "cigar: q1 10 60 + t9 200 252 + 80 M 20 D 2 M 30\n"
+    assert cigar_validation.validate_batch(line.encode())["problem_lines"] == 0
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_validate_lastz_files(tmp_path, processes):
+    lines = get_lastz_lines(2000)
+    bad_lines = {150: "cigar: q1 10 61 + t1 200 252 + 80 M 20 D 2 M 30\n", 1999: "cigar: q1 10 60 + t2 200 252 + 80 M 20 D 2 M 30\n"}
+    for i, line in bad_lines.items():
+        lines[i] = line
+    lastz_files = {"primary": str(tmp_path / "primary.cigar"), "secondary": str(tmp_path / "secondary.cigar.gz")}
+    with open(lastz_files["primary"], "w") as outf:
+        outf.writelines(lines)
+    with gzip.open(lastz_files["secondary"], "wt") as outf:
+        outf.writelines(lines[:1000])
+
+    contig_lengths = cigar_validation.get_contig_lengths([[fasta_index.FaiEntry("q1", 20000, 0, 60, 61), fasta_index.FaiEntry("t1", 20000, 0, 60, 61)]])
+    # many small batches.
+    summary = cigar_validation.validate_lastz_files(lastz_files, contig_lengths, processes, batch_bytes=1000)
+    assert summary["lines"] == 3000
+    assert summary["problem_lines"] == 3
+    assert summary["problems"]["query_span"] == 2 and summary["problems"]["unknown_contig"] == 1
+    assert summary["examples"] == [("primary", 151, ["query_span"], bad_lines[150].rstrip("\n")),
+                                   ("primary", 2000, ["unknown_contig"], bad_lines[1999].rstrip("\n")),
+                                   ("secondary", 151, ["query_span"], bad_lines[150].rstrip("\n"))]
+    assert "query_span: 2" in cigar_validation.format_summary(summary)
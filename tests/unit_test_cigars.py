@@ -1,7 +1,10 @@
 import cigar
-from Bio import SeqIO
 from argparse import ArgumentParser
+import sys
 import os
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import fasta_index
 
 """
 Test cigar length is same length as mapping length, both in terms of query and target:
@@ -73,11 +76,10 @@ def get_contig_lengths(reference_file, assembly_files):
 
     
 def count_contig_lengths(assembly_file):
-    contig_lengths = dict()
-    contigs = SeqIO.index(assembly_file, "fasta")
-    for contig_name, seq in contigs.items():
-        contig_lengths[contig_name] = len(seq)
-    return contig_lengths
+    # from the .fai next to the assembly if there is one, otherwise by indexing the assembly.
+    if os.path.isfile(assembly_file + ".fai"):
+        return fasta_index.get_contig_lengths(fasta_index.read_index(assembly_file + ".fai"))
+    return fasta_index.get_contig_lengths(fasta_index.build_index(assembly_file))
 
 def check_all_contig_ids_unique(contig_lengths):
     """
@@ -0,0 +1,129 @@
+import pytest
+
+import sys
+import os
+import random
+from argparse import Namespace
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import aligners
+from src import cigar_validation
+from src import collinear_merge
+from src import paf_to_lastz
+from src import segments
+from src import sorted_output
+
+SCORING = aligners.PRESET_SCORING["asm5"]
+
+def get_paf_line(query, query_start, query_end, strand, target, target_start, target_end, cigar, kind="P", score=None, query_length=1000,
+                 target_length=5000):
+    """
+    A paf line of a mapping with cigar, in which every M is a match.
+    """
+    ops = paf_to_lastz.CIGAR_OP_RE.findall(cigar)
+    matches = sum(int(length) for length, op in ops if op == "M")
+    fields = [query, str(query_length), str(query_start), str(query_end), strand, target, str(target_length), str(target_start), str(target_end),
+              str(matches), str(sum(int(length) for length, op in ops)), "60", "NM:i:" + str(sum(int(length) for length, op in ops if op != "M"))]
+    if score is not None:
+        fields.append("AS:i:" + str(score))
+    fields += ["tp:A:" + kind, "cm:i:10", "cg:Z:" + cigar]
+    return "\t".join(fields) + "\n"
+
+def merge(lines, max_gap=50, buffer_size=1024**2, tmp_dir=None, lift_segments=False):
+    merger = collinear_merge.CollinearMerger(max_gap, buffer_size, SCORING)
+    return list(merger.merge(None, lift_segments, tmp_dir, iter(lines))), merger.merged
+
+def test_join_cigars():
+    assert collinear_merge.join_cigars("10M", 2, 3, "4M") == "10M2I3D4M"
+    assert collinear_merge.join_cigars("10M", 0, 0, "4M5I") == "14M5I"
+    # adjacent ops of the same kind are combined.
+    assert collinear_merge.join_cigars("10M2I", 3, 0, "5I4M") == "10M10I4M"
+    assert collinear_merge.join_cigars("7D", 0, 5, "3D12M") == "15D12M"
+
+def test_from_options():
+    options = Namespace(merge_collinear_gap=0, sort_buffer_size=100)
+    assert collinear_merge.from_options(options, ["-cx", "asm5"]) is None
+    options.merge_collinear_gap = 20
+    merger = collinear_merge.from_options(options, ["-cx", "asm10"])
+    assert (merger.max_gap, merger.buffer_size, merger.scoring) == (20, 100, aligners.PRESET_SCORING["asm10"])
+
+def test_merge_collinear():
+    lines = [
+        # three collinear mappings on the + strand, out of order.
+        get_paf_line("q1", 110, 200, "+", "t1", 1105, 1195, "90M", score=90),
+        get_paf_line("q1", 0, 100, "+", "t1", 1000, 1100, "100M", score=100),
+        get_paf_line("q1", 200, 300, "+", "t1", 1195, 1295, "100M", score=100),
+        # two on the - strand: they go backwards along the query.
+        get_paf_line("q2", 300, 400, "-", "t1", 1000, 1100, "100M", score=100),
+        get_paf_line("q2", 200, 297, "-", "t1", 1103, 1200, "97M", score=97),
+    ]
+    merged, count = merge(lines)
+    assert count == 3
+    assert merged == [
+        "\t".join(["q1", "1000", "0", "300", "+", "t1", "5000", "1000", "1295", "290", "305", "60", "NM:i:15",
+                   "AS:i:" + str(290 - aligners.get_gap_cost(10, SCORING) - aligners.get_gap_cost(5, SCORING)), "tp:A:P", "cg:Z:100M10I5D190M"]) + "\n",
+        "\t".join(["q2", "1000", "200", "400", "-", "t1", "5000", "1000", "1200", "197", "203", "60", "NM:i:6",
+                   "AS:i:" + str(197 - 2 * aligners.get_gap_cost(3, SCORING)), "tp:A:P", "cg:Z:100M3I3D97M"]) + "\n",
+    ]
+    assert paf_to_lastz.paf_line_to_lastz(merged[1]) == "cigar: q2 400 200 - t1 1000 1200 + " + str(197 - 2 * aligners.get_gap_cost(3, SCORING)) + \
+        " M 100 I 3 D 3 M 97\n"
+
+def test_merge_not_collinear():
+    lines = [
+        get_paf_line("q1", 0, 100, "+", "t1", 1000, 1100, "100M"),
+        # too far on the query.
+        get_paf_line("q1", 151, 200, "+", "t1", 1100, 1149, "49M"),
+        # overlapping on the target.
+        get_paf_line("q1", 200, 300, "+", "t1", 1148, 1248, "100M"),
+        # another target, strand or type.
+        get_paf_line("q1", 300, 400, "+", "t2", 1248, 1348, "100M"),
+        get_paf_line("q1", 300, 400, "-", "t1", 1248, 1348, "100M"),
+        get_paf_line("q1", 300, 400, "+", "t1", 1248, 1348, "100M", kind="S"),
+        # backwards on the query.
+        get_paf_line("q3", 300, 400, "+", "t1", 1000, 1100, "100M"),
+        get_paf_line("q3", 0, 100, "+", "t1", 1100, 1200, "100M"),
+        # without a cigar.
+        get_paf_line("q4", 0, 100, "+", "t1", 1000, 1100, "100M").replace("\tcg:Z:100M", ""),
+        get_paf_line("q4", 100, 200, "+", "t1", 1100, 1200, "100M"),
+    ]
+    merged, count = merge(lines)
+    assert count == 0
+    # unmerged lines are unchanged, but sorted.
+    assert merged == sorted(lines, key=collinear_merge.get_sort_key)
+
+def test_merge_segments_on_disk(tmp_path, monkeypatch):
+    rng = random.Random(0)
+    lines = list()
+    for i in range(200):
+        # chains of up to 5 mappings of a segment, broken by gaps of up to 60 bases.
+        query = segments.segment_name("c" + str(i % 7), 1000 * (i % 3), 1000 * (i % 3) + 1000, 5000)
+        query_start, target_start = rng.randrange(100), rng.randrange(4000)
+        for j in range(rng.randrange(1, 6)):
+            length = rng.randrange(1, 100)
+            lines.append(get_paf_line(query, query_start, query_start + length, "+", "t" + str(i % 2), target_start, target_start + length,
+                                      str(length) + "M", score=length))
+            query_start += length + rng.randrange(60)
+            target_start += length + rng.randrange(60)
+    rng.shuffle(lines)
+    tmp_dir = tmp_path / "tmp"
+    tmp_dir.mkdir()
+    # many small runs, merged in several passes.
+    monkeypatch.setattr(sorted_output, "MAX_MERGE_RUNS", 3)
+    merged, count = merge(lines, buffer_size=2000, tmp_dir=str(tmp_dir), lift_segments=True)
+    assert 0 < count < len(lines)
+    assert len(merged) == len(lines) - count
+    # the same as sorting in memory, and only the merged lines are left.
+    assert (merged, count) == merge([segments.lift_paf_line(line) for line in lines])
+    assert os.listdir(str(tmp_dir)) == []
+    assert all(not segments.parse_segment_name(line.split("\t")[0]) for line in merged)
+    # every base of every mapping is still covered.
+    assert sum(int(line.split("\t")[9]) for line in merged) == sum(int(line.split("\t")[9]) for line in lines)
+
+    # the merged mappings are valid lastz cigars.
+    lastz_files = {"primary": str(tmp_path / "primary.cigar"), "secondary": str(tmp_path / "secondary.cigar")}
+    with open(lastz_files["primary"], "w") as primaryf, open(lastz_files["secondary"], "w") as secondaryf:
+        paf_to_lastz.write_lastz_lines(merged, primaryf, secondaryf)
+    contig_lengths = {name.encode(): 5000 for name in ["c" + str(i) for i in range(7)] + ["t0", "t1"]}
+    summary = cigar_validation.validate_lastz_files(lastz_files, contig_lengths)
+    assert summary["lines"] == len(merged)
+    assert summary["problem_lines"] == 0
@@ -0,0 +1,110 @@
+import pytest
+
+import sys
+import os
+import io
+import random
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import columnar
+from src import paf_to_lastz
+from src import secondary_filter
+from src import segments
+
+PAF_LINES = [
+    "q1\t100\t10\t60\t+\tt1\t500\t200\t252\t48\t52\t60\tNM:i:4\tAS:i:80\ttp:A:P\tcm:i:5\tcg:Z:20M2D30M\n",
+    "q2\t100\t0\t50\t-\tt1\t500\t300\t349\t45\t50\t0\tNM:i:5\tAS:i:70\ttp:A:S\tcg:Z:10M1I39M\n",
+    "q3\t80\t5\t25\t+\tt2\t90\t30\t50\t20\t20\t3\ttp:A:I\tcg:Z:20M\n",
+    "q4\t80\t5\t25\t+\tt2\t90\t30\t50\t20\t20\t3\ttp:A:P\n",
+]
+
+def get_paf_lines(count, seed=0):
+    """
+    Random mappings of segments and whole contigs, with a few queries per contig.
+    """
+    rng = random.Random(seed)
+    lines = list()
+    for i in range(count):
+        query = "c" + str(i // 5)
+        query_length = 100000
+        if rng.random() < 0.5:
+            start = rng.randrange(50000)
+            query = segments.segment_name(query, start, start + 1000, query_length)
+            query_length = 1000
+        cigar = [(rng.randrange(1, 300), rng.choice("MID")) for j in range(rng.randrange(1, 6))]
+        query_start = rng.randrange(query_length // 2)
+        query_end = query_start + sum(length for length, op in cigar if op in "MI")
+        target_start = rng.randrange(100000)
+        target_end = target_start + sum(length for length, op in cigar if op in "MD")
+        lines.append("\t".join([query, str(query_length), str(query_start), str(query_end), rng.choice("+-"), rng.choice(["t1", "t2"]),
+                                "200000", str(target_start), str(target_end), str(query_end - query_start), str(target_end - target_start),
+                                str(rng.randrange(61)), "AS:i:" + str(rng.randrange(1000)), "tp:A:" + rng.choice("PSSI"),
+                                "cg:Z:" + "".join(str(length) + op for length, op in cigar)]) + "\n")
+    return lines
+
+def to_lastz(paf_lines, lift_segments=False, mapping_filter=None):
+    primaryf, secondaryf = io.StringIO(), io.StringIO()
+    counts = paf_to_lastz.write_lastz_lines(paf_lines, primaryf, secondaryf, lift_segments, mapping_filter)
+    return counts, primaryf.getvalue(), secondaryf.getvalue()
+
+def columnar_to_lastz(columnar_file):
+    primaryf, secondaryf = io.StringIO(), io.StringIO()
+    counts = columnar.write_lastz(columnar_file, primaryf, secondaryf)
+    return counts, primaryf.getvalue(), secondaryf.getvalue()
+
+def test_write_columnar(tmp_path):
+    columnar_file = str(tmp_path / "mappings.columnar")
+    assert columnar.write_columnar(PAF_LINES, columnar_file) == {"primary": 2, "secondary": 1, "skipped": 1}
+
+    mappings = columnar.ColumnarMappings(columnar_file)
+    assert len(mappings) == 3
+    assert mappings.names == ["q1", "t1", "q2", "q3", "t2"]
+    assert [mappings.names[query] for query in mappings.records["query"]] == ["q1", "q2", "q3"]
+    assert mappings.records["target_start"].tolist() == [200, 300, 30]
+    assert mappings.records["strand"].tolist() == [1, -1, 1]
+    assert mappings.records["score"].tolist() == [80, 70, 0]
+    assert columnar.primary_mask(mappings.records).tolist() == [True, False, True]
+    assert columnar.lastz_query_coordinates(mappings.records)[0].tolist() == [10, 50, 5]
+    assert mappings.cigars[mappings.records["cigar_offset"][1]:].tolist() == [10 << 4, 1 << 4 | 1, 39 << 4, 20 << 4]
+
+    assert columnar_to_lastz(columnar_file) == ({"primary": 2, "secondary": 1}, "cigar: q1 10 60 + t1 200 252 + 80 M 20 D 2 M 30\ncigar: q3 5 25 + t2 30 50 + 0 M 20\n",
+                                                "cigar: q2 50 0 - t1 300 349 + 70 M 10 I 1 M 39\n")
+
+def test_empty(tmp_path):
+    columnar_file = str(tmp_path / "mappings.columnar")
+    assert columnar.write_columnar([], columnar_file) == {"primary": 0, "secondary": 0, "skipped": 0}
+    assert columnar_to_lastz(columnar_file) == ({"primary": 0, "secondary": 0}, "", "")
+
+def test_not_columnar(tmp_path):
+    paf_file = str(tmp_path / "mappings.paf")
+    with open(paf_file, "w") as outf:
+        outf.writelines(PAF_LINES)
+    with pytest.raises(ValueError):
+        columnar.ColumnarMappings(paf_file)
+
+@pytest.mark.parametrize("lift_segments", [False, True])
+def test_same_as_lastz(tmp_path, monkeypatch, lift_segments):
+    # several chunks, with names interned in earlier chunks.
+    monkeypatch.setattr(columnar, "CHUNK_RECORDS", 7)
+    lines = get_paf_lines(100)
+    columnar_file = str(tmp_path / "mappings.columnar")
+    counts = columnar.write_columnar(lines, columnar_file, lift_segments)
+    expected_counts, primary, secondary = to_lastz(lines, lift_segments)
+    assert counts == expected_counts
+    assert columnar_to_lastz(columnar_file)[1:] == (primary, secondary)
+
+    primary_file, secondary_file = str(tmp_path / "primary.cigar"), str(tmp_path / "secondary.cigar")
+    columnar.split_columnar_to_lastz(columnar_file, primary_file, secondary_file)
+    with open(primary_file) as inf:
+        assert inf.read() == primary
+    with open(secondary_file) as inf:
+        assert inf.read() == secondary
+
+def test_same_as_lastz_filtered(tmp_path):
+    lines = get_paf_lines(200, seed=1)
+    columnar_file = str(tmp_path / "mappings.columnar")
+    new_filter = lambda: secondary_filter.SecondaryFilter(top_n=1, region_length=500, min_mapq=10)
+    counts = columnar.write_columnar(lines, columnar_file, True, new_filter())
+    expected_counts, primary, secondary = to_lastz(lines, True, new_filter())
+    assert counts == expected_counts and counts["filtered"] > 0
+    assert columnar_to_lastz(columnar_file)[1:] == (primary, secondary)
@@ -0,0 +1,39 @@
+import pytest
+
+import sys
+import os
+import gzip
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import compression
+
+def test_compressed_round_trip(tmp_path):
+    lines = ["line " + str(i) + "\n" for i in range(10000)]
+    compressed = str(tmp_path / "out.txt.gz")
+    with compression.open_output(compressed, compress=True) as outf:
+        outf.writelines(lines)
+
+    assert compression.is_gzipped(compressed)
+    with gzip.open(compressed, "rt") as inf:
+        assert inf.readlines() == lines
+    with compression.open_input(compressed) as inf:
+        assert inf.readlines() == lines
+
+def test_uncompressed_passthrough(tmp_path):
+    plain = str(tmp_path / "out.txt")
+    with compression.open_output(plain, mode="wb") as outf:
+        outf.write(b">a\nACGT\n")
+
+    assert not compression.is_gzipped(plain)
+    with compression.open_input(plain, "rb") as inf:
+        assert inf.read() == b">a\nACGT\n"
+
+def test_bgzip_style_multi_member(tmp_path):
+    # bgzip files are several concatenated gzip members.
+    multi_member = str(tmp_path / "in.fa.gz")
+    with open(multi_member, "wb") as outf:
+        outf.write(gzip.compress(b">a\nAC\n"))
+        outf.write(gzip.compress(b"GT\n"))
+
+    with compression.open_input(multi_member) as inf:
+        assert inf.read() == ">a\nAC\nGT\n"
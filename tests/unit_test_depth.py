@@ -0,0 +1,116 @@
+import pytest
+
+import sys
+import os
+import gzip
+import io
+import random
+import numpy as np
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import depth
+from src import paf_to_lastz
+
+PAF_LINES = [
+    "q1\t100\t10\t60\t+\tt1\t500\t200\t252\t48\t52\t60\tNM:i:4\tAS:i:80\ttp:A:P\tcm:i:5\tcg:Z:20M2D30M\n",
+    "q2\t100\t0\t50\t-\tt1\t500\t230\t279\t45\t50\t0\tNM:i:5\tAS:i:70\ttp:A:S\tcg:Z:10M1I39M\n",
+    "q3\t80\t5\t25\t+\tt2\t90\t30\t50\t20\t20\t3\ttp:A:I\tcg:Z:20M\n",
+    "q4\t80\t5\t75\t+\tt1\t500\t240\t310\t70\t70\t3\ttp:A:P\tcg:Z:70M\n",
+]
+
+def get_depths(track, contig):
+    """
+    The per-base depths of contig in track.
+    """
+    length, starts, depths = track[contig]
+    return np.repeat(depths, np.diff(np.append(starts, length)))
+
+def get_random_track(rng, contig_lengths):
+    coverage = depth.AssemblyCoverage()
+    lines = list()
+    for contig, length in contig_lengths.items():
+        for i in range(rng.randrange(5)):
+            start = rng.randrange(length)
+            end = rng.randrange(start, length + 1)
+            lines.append("\t".join(["q", "1000", "0", "10", "+", contig, str(length), str(start), str(end), "10", "10", "60", "tp:A:P"]) + "\n")
+    list(coverage.observe(lines))
+    return coverage.get_track()
+
+def test_get_runs():
+    starts, depths = depth.get_runs(100, np.array([10, 20, 30, 60, 60, 40]), np.array([1, 1, -1, -1, 1, -1]))
+    assert starts.tolist() == [0, 10, 20, 30, 40]
+    assert depths.tolist() == [0, 1, 2, 1, 0]
+    # capped, and events at the end of the contig are dropped.
+    starts, depths = depth.get_runs(50, np.array([0, 10, 40, 50]), np.array([1, 1, -1, -1]), max_depth=1)
+    assert starts.tolist() == [0]
+    assert depths.tolist() == [1]
+    assert [runs.tolist() for runs in depth.get_runs(0, np.zeros(0), np.zeros(0))] == [[], []]
+
+def test_assembly_coverage():
+    coverage = depth.AssemblyCoverage()
+    # lines pass through unchanged.
+    assert list(coverage.observe(PAF_LINES)) == PAF_LINES
+    track = coverage.get_track()
+    assert list(track) == ["t1", "t2"]
+    assert track["t1"][0] == 500
+    assert track["t1"][1].tolist() == [0, 200, 310]
+    assert track["t1"][2].tolist() == [0, 1, 0]
+    assert track["t2"][1].tolist() == [0, 30, 50]
+    assert track["t2"][2].tolist() == [0, 1, 0]
+
+def test_split_paf_to_lastz_coverage(tmp_path):
+    paf_file = str(tmp_path / "in.paf")
+    with open(paf_file, "w") as outf:
+        outf.writelines(PAF_LINES)
+    coverage = depth.AssemblyCoverage()
+    counts = paf_to_lastz.split_paf_to_lastz(paf_file, str(tmp_path / "primary.cigar"), str(tmp_path / "secondary.cigar"), coverage=coverage)
+    assert counts == {"primary": 3, "secondary": 1, "skipped": 0}
+    assert get_depths(coverage.get_track(), "t1").sum() == 110
+
+def test_sum_tracks():
+    rng = random.Random(0)
+    contig_lengths = {"c" + str(i): rng.randrange(1, 1000) for i in range(5)}
+    tracks = [get_random_track(rng, contig_lengths) for i in range(20)]
+    total = depth.sum_tracks(tracks)
+    for contig in contig_lengths:
+        expected = sum(get_depths(track, contig) for track in tracks if contig in track)
+        assert get_depths(total, contig).tolist() == expected.tolist()
+        # no empty runs, and no two runs of the same depth in a row.
+        assert np.all(np.diff(total[contig][1]) > 0)
+        assert np.all(np.diff(total[contig][2].astype(np.int64)) != 0)
+    # summing sums is the same as summing all tracks.
+    tree_total = depth.sum_tracks([depth.sum_tracks(tracks[:7]), depth.sum_tracks(tracks[7:])])
+    assert {contig: [runs.tolist() for runs in contig_track[1:]] for contig, contig_track in tree_total.items()} == \
+           {contig: [runs.tolist() for runs in contig_track[1:]] for contig, contig_track in total.items()}
+
+def test_order_track():
+    coverage = depth.AssemblyCoverage()
+    list(coverage.observe(PAF_LINES))
+    track = depth.order_track(coverage.get_track(), {"t0": 40, "t2": 90, "t1": 500})
+    assert list(track) == ["t0", "t2", "t1"]
+    assert track["t0"][1].tolist() == [0]
+    assert track["t0"][2].tolist() == [0]
+
+def test_write_outputs(tmp_path):
+    coverage = depth.AssemblyCoverage()
+    list(coverage.observe(PAF_LINES))
+    track = depth.sum_tracks([coverage.get_track(), coverage.get_track()])
+    npz_file, bedgraph_file = str(tmp_path / "depth.depth.npz"), str(tmp_path / "depth.bedGraph.gz")
+    depth.write_outputs(track, npz_file, bedgraph_file, {"t2": 90, "t1": 500, "t3": 10}, compress=True)
+
+    read = depth.read_track(npz_file)
+    assert list(read) == ["t2", "t1", "t3"]
+    for contig, (length, starts, depths) in track.items():
+        assert read[contig][0] == length
+        assert read[contig][1].tolist() == starts.tolist()
+        assert read[contig][2].tolist() == depths.tolist()
+    with gzip.open(bedgraph_file, "rt") as inf:
+        assert inf.read() == "t2\t0\t30\t0\nt2\t30\t50\t2\nt2\t50\t90\t0\nt1\t0\t200\t0\nt1\t200\t310\t2\nt1\t310\t500\t0\nt3\t0\t10\t0\n"
+
+def test_empty_track(tmp_path):
+    npz_file = str(tmp_path / "depth.depth.npz")
+    depth.write_track(dict(), npz_file)
+    assert depth.read_track(npz_file) == dict()
+    outf = io.StringIO()
+    depth.write_bedgraph(dict(), outf)
+    assert outf.getvalue() == ""
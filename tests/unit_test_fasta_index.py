@@ -0,0 +1,90 @@
+import pytest
+
+import sys
+import os
+import gzip
+import random
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import fasta_index
+from src import fasta_preprocessing
+
+def write_fasta(path, contigs, line_length, line_ending="\n"):
+    with open(path, "w", newline="") as outf:
+        for header, seq in contigs:
+            outf.write(">" + header + line_ending)
+            for i in range(0, len(seq), line_length):
+                outf.write(seq[i:i + line_length] + line_ending)
+
+def get_contigs():
+    rng = random.Random(0)
+    return [("c1 some description", "".join(rng.choices("ACGT", k=95))), ("c2", "".join(rng.choices("ACGT", k=60))),
+            ("empty", ""), ("c3", "".join(rng.choices("ACGT", k=7)))]
+
+@pytest.mark.parametrize("line_ending", ["\n", "\r\n"])
+def test_build_index_and_fetch(tmp_path, line_ending):
+    fasta = str(tmp_path / "asm.fa")
+    contigs = get_contigs()
+    write_fasta(fasta, contigs, 20, line_ending)
+
+    index = fasta_index.build_index(fasta)
+    assert [(entry.name, entry.length, entry.linebases, entry.linewidth) for entry in index] == \
+        [("c1", 95, 20, 20 + len(line_ending)), ("c2", 60, 20, 20 + len(line_ending)), ("empty", 0, 0, 0), ("c3", 7, 7, 7 + len(line_ending))]
+    assert fasta_index.get_contig_lengths(index) == {"c1": 95, "c2": 60, "empty": 0, "c3": 7}
+
+    fai_file = str(tmp_path / "asm.fa.fai")
+    fasta_index.write_index(index, fai_file)
+    assert fasta_index.read_index(fai_file) == index
+
+    with fasta_index.IndexedFasta(fasta, index) as indexed_fasta:
+        for header, seq in contigs:
+            name = header.split()[0]
+            assert indexed_fasta.fetch(name) == seq
+            for start, end in [(0, 1), (19, 21), (5, 60), (40, 200)]:
+                assert indexed_fasta.fetch(name, start, end) == seq[start:end]
+
+def test_irregular_lines_and_gzip(tmp_path):
+    fasta = str(tmp_path / "irregular.fa")
+    with open(fasta, "w") as outf:
+        outf.write(">a\nACGT\nAC\nACGTA\n>b\nAAAA\nCCCC\nGG\n")
+    index = fasta_index.build_index(fasta)
+    # only the last line of a contig may be shorter.
+    assert index[0] == fasta_index.FaiEntry("a", 11, 3, 0, 0)
+    assert index[1] == fasta_index.FaiEntry("b", 10, 20, 4, 5)
+    with fasta_index.IndexedFasta(fasta, index) as indexed_fasta:
+        assert indexed_fasta.fetch("a", 3, 8) == "TACAC"
+        assert indexed_fasta.fetch("b", 3, 9) == "ACCCCG"
+
+    gzipped_fasta = str(tmp_path / "irregular.fa.gz")
+    with open(fasta, "rb") as inf, gzip.open(gzipped_fasta, "wb") as outf:
+        outf.write(inf.read())
+    assert fasta_index.build_index(gzipped_fasta) == index
+    with pytest.raises(ValueError):
+        fasta_index.IndexedFasta(gzipped_fasta, index)
+
+def test_blank_lines_before_sequence(tmp_path):
+    fasta = str(tmp_path / "blank.fa")
+    with open(fasta, "w") as outf:
+        outf.write(">a\n\nACGT\nAC\n>b\n\n\nAAAA\nCC\n")
+    index = fasta_index.build_index(fasta)
+    # the sequence starts after the blank lines.
+    assert index[0] == fasta_index.FaiEntry("a", 6, 4, 4, 5)
+    assert index[1] == fasta_index.FaiEntry("b", 6, 17, 4, 5)
+    with fasta_index.IndexedFasta(fasta, index) as indexed_fasta:
+        assert indexed_fasta.fetch("a", 0, 6) == "ACGTAC"
+        assert indexed_fasta.fetch("b", 2, 6) == "AACC"
+
+def test_rename_duplicate_contig_ids_indexes(tmp_path):
+    assembly_files = {"ref": str(tmp_path / "ref.fa"), "asm": str(tmp_path / "asm.fa")}
+    write_fasta(assembly_files["ref"], get_contigs(), 20)
+    write_fasta(assembly_files["asm"], get_contigs()[:2] + [("new", "ACGT")], 20)
+    new_assembly_files = {"ref": assembly_files["ref"], "asm": str(tmp_path / "deduplicated.fa")}
+
+    fasta_indexes = dict()
+    deduplicated = fasta_preprocessing.rename_duplicate_contig_ids(assembly_files, "ref", new_assembly_files, fasta_indexes=fasta_indexes)
+
+    # the indexes of rewritten assemblies are of the rewritten file.
+    assert deduplicated == new_assembly_files
+    for asm, assembly_file in deduplicated.items():
+        assert fasta_indexes[asm] == fasta_index.build_index(assembly_file)
+    assert [entry.name for entry in fasta_indexes["asm"]] == ["c1_renamed_0", "c2_renamed_1", "new"]
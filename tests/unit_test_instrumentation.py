@@ -0,0 +1,68 @@
+import pytest
+
+import sys
+import os
+import json
+from argparse import Namespace
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import instrumentation
+
+def get_metrics(stage, name, start_time, end_time, **records):
+    return {"stage": stage, "name": name, "start_time": start_time, "end_time": end_time, "wall_seconds": end_time - start_time,
+            "cpu_seconds": 1.0, "peak_rss_bytes": 100, "read_bytes": 10, "write_bytes": 20, "records": records, "subprocesses": list()}
+
+def test_measure_and_run_command():
+    job = Namespace()
+    with instrumentation.measure("mapping", "map_a_to_b") as metrics:
+        job.stage_metrics = metrics
+        instrumentation.count_records(job, mappings=2)
+        instrumentation.count_records(job, mappings=3)
+        returncode = instrumentation.run_command(job, [sys.executable, "-c",
+            "import sys; sys.stderr.write('[M::main] Real time: 1.500 sec; CPU: 3.000 sec; Peak RSS: 0.500 GB\\n')"])
+
+    assert returncode == 0
+    assert metrics["records"] == {"mappings": 5}
+    assert metrics["wall_seconds"] >= 0 and metrics["cpu_seconds"] >= 0 and metrics["peak_rss_bytes"] > 0
+    subprocess_metrics = metrics["subprocesses"][0]
+    assert subprocess_metrics["returncode"] == 0
+    assert subprocess_metrics["stderr"].startswith("[M::main]")
+    assert (subprocess_metrics["real_seconds"], subprocess_metrics["cpu_seconds"], subprocess_metrics["peak_rss_bytes"]) == (1.5, 3.0, 1024**3 // 2)
+
+def test_run_command_failure():
+    job = Namespace()
+    with instrumentation.measure("mapping", "map_a_to_b") as metrics:
+        job.stage_metrics = metrics
+        with pytest.raises(RuntimeError, match="failed with exit status 3:\nno index"):
+            instrumentation.run_command(job, [sys.executable, "-c", "import sys; sys.stderr.write('no index'); sys.exit(3)"])
+    assert metrics["subprocesses"][0]["returncode"] == 3
+
+def test_critical_path_and_reports(tmp_path):
+    records = [get_metrics("index", "index_fasta", 0, 10),
+               get_metrics("mapping", "map_a_to_b", 11, 30, mappings=5),
+               get_metrics("mapping", "map_a_to_b", 11, 20, mappings=7),
+               get_metrics("conversion", "paf_to_lastz", 31, 35)]
+
+    assert instrumentation.get_critical_path(records) == [records[0], records[1], records[3]]
+
+    summary_file = str(tmp_path / "critical_path.txt")
+    instrumentation.write_critical_path_summary(records, summary_file)
+    with open(summary_file) as inf:
+        assert inf.read().splitlines() == ["critical_path;index;index_fasta 10000", "critical_path;toil_overhead 2000",
+                                           "critical_path;mapping;map_a_to_b 19000", "critical_path;conversion;paf_to_lastz 4000"]
+
+    report_file = str(tmp_path / "report.json")
+    instrumentation.write_report(records, report_file)
+    with open(report_file) as inf:
+        report = json.load(inf)
+    assert report["stages"]["mapping"]["jobs"] == 2
+    assert report["stages"]["mapping"]["wall_seconds"] == 28
+    assert report["stages"]["mapping"]["records"] == {"mappings": 12}
+
+    tsv_report_file = str(tmp_path / "report.tsv")
+    instrumentation.write_report(records, tsv_report_file)
+    with open(tsv_report_file) as inf:
+        rows = [line.rstrip("\n").split("\t") for line in inf]
+    assert rows[0] == instrumentation.TSV_FIELDS
+    assert len(rows) == 5
+    assert rows[2][rows[0].index("records")] == "mappings=5"
@@ -0,0 +1,47 @@
+import pytest
+
+import sys
+import os
+import random
+import shutil
+import subprocess
+from argparse import Namespace
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import local_executor
+from src import paf_to_lastz
+
+def write_fasta(path, contigs):
+    with open(path, "w") as outf:
+        for contig_id, seq in contigs:
+            outf.write(">" + contig_id + "\n" + seq + "\n")
+
+def test_get_threads():
+    options = Namespace(max_job_cores=2)
+    assert local_executor.get_threads(10**6, options) == 1
+    assert local_executor.get_threads(1, options) == min(2, os.cpu_count())
+
+@pytest.mark.skipif(shutil.which("minimap2") is None, reason="minimap2 isn't installed")
+def test_run_local_all_to_ref(tmp_path):
+    rng = random.Random(0)
+    ref_seq = "".join(rng.choices("ACGT", k=20000))
+    asm_seq = list(ref_seq)
+    for i in range(0, len(asm_seq), 500):
+        asm_seq[i] = "A" if asm_seq[i] != "A" else "C"
+    asms = {"ref": str(tmp_path / "ref.fa"), "asm": str(tmp_path / "asm.fa")}
+    write_fasta(asms["ref"], [("ref_contig", ref_seq)])
+    write_fasta(asms["asm"], [("asm_contig", "".join(asm_seq))])
+
+    options = Namespace(refID="ref", all_to_ref_only=True, workDir=None, max_job_cores=1, compress_outputs=False,
+                        sorted_output=None, validate_outputs=True, depth_track=None, aligner="minimap2", mask_repeats=False, merge_collinear_gap=0, secondary_top_n=0, secondary_max_containment=0, secondary_min_length=0, secondary_min_identity=0, secondary_min_mapq=0,
+                        primary=str(tmp_path / "primary.cigar"), secondary=str(tmp_path / "secondary.cigar"))
+    metrics = local_executor.run_local(asms, options, ["-x", "asm5"], ["-cx", "asm5"])
+    assert [task["stage"] for task in metrics] == ["index", "mapping", "concatenation", "validation"]
+
+    # the same as mapping with minimap2, then converting the paf.
+    paf = str(tmp_path / "asm.paf")
+    subprocess.run(["minimap2", "-cx", "asm5", "-o", paf, asms["ref"], asms["asm"]], check=True, stderr=subprocess.DEVNULL)
+    paf_to_lastz.split_paf_to_lastz(paf, str(tmp_path / "expected_primary.cigar"), str(tmp_path / "expected_secondary.cigar"))
+    with open(options.primary) as inf, open(str(tmp_path / "expected_primary.cigar")) as expectedf:
+        primary = inf.read()
+        assert primary and primary == expectedf.read()
@@ -0,0 +1,74 @@
+import pytest
+
+import sys
+import os
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import fasta_index
+from src import fasta_preprocessing
+from src import manifest
+
+def write_fasta(path, contig_ids):
+    with open(path, "w") as outf:
+        for contig_id in contig_ids:
+            outf.write(">" + contig_id + "\nACGT\n")
+
+def test_get_source_records(tmp_path, monkeypatch):
+    assembly_files = {"ref": str(tmp_path / "ref.fa"), "asm": str(tmp_path / "asm.fa")}
+    write_fasta(assembly_files["ref"], ["chr1"])
+    write_fasta(assembly_files["asm"], ["chr1", "c2"])
+    records = manifest.get_source_records(assembly_files, processes=1)
+    assert records["ref"]["digest"] != records["asm"]["digest"]
+
+    # files whose size and mtime are unchanged aren't hashed again.
+    records["asm"]["digest"] = "previous digest"
+    assert manifest.get_source_records(assembly_files, records, processes=1)["asm"]["digest"] == "previous digest"
+    write_fasta(assembly_files["asm"], ["chr1", "c3"])
+    os.utime(assembly_files["asm"], (0, 0))
+    assert manifest.get_source_records(assembly_files, records, processes=1)["asm"]["digest"] not in ("previous digest", records["ref"]["digest"])
+
+def test_get_unchanged_asms(tmp_path):
+    fasta = str(tmp_path / "asm.fa")
+    write_fasta(fasta, ["c1"])
+    previous_manifest = {"assemblies": {asm: {"digest": asm + "_digest", "fasta": fasta} for asm in ["ref", "a1", "a2"]}}
+    source_records = {asm: {"digest": asm + "_digest"} for asm in ["ref", "a1", "a2", "a3"]}
+    source_records["a2"]["digest"] = "changed"
+    assert sorted(manifest.get_unchanged_asms(previous_manifest, source_records, "ref")) == ["a1", "ref"]
+    # nothing can be reused if the reference changed.
+    source_records["ref"]["digest"] = "changed"
+    assert manifest.get_unchanged_asms(previous_manifest, source_records, "ref") == dict()
+    assert manifest.get_unchanged_asms(None, source_records, "ref") == dict()
+
+def test_rename_state_continues_renames():
+    indexes = {asm: [fasta_index.FaiEntry(contig_id, 4, 0, 4, 5) for contig_id in contig_ids]
+               for asm, contig_ids in [("ref", ["chr1", "chr2"]), ("a1", ["chr1", "c2"]), ("a2", ["chr1", "c2", "c3"])]}
+    full_renames = fasta_preprocessing.get_contig_renames(indexes, "ref")
+
+    # deduplicating a2 later, from the state left by deduplicating ref and a1, gives the same renames.
+    rename_state = {"contig_ids": set(), "unique_id": 0}
+    renames = fasta_preprocessing.get_contig_renames({asm: indexes[asm] for asm in ["ref", "a1"]}, "ref", rename_state)
+    assert rename_state["renames"] == renames
+    renames.update(fasta_preprocessing.get_contig_renames({"a2": indexes["a2"]}, "ref", rename_state))
+    assert renames == full_renames == {"a1": {0: "chr1_renamed_0"}, "a2": {0: "chr1_renamed_1", 1: "c2_renamed_2"}}
+    assert rename_state["unique_id"] == 3
+
+def test_get_pairs():
+    assert manifest.get_pairs(["ref", "a1", "a2"], "ref") == {"a1_to_a2": ["a1", "a2"], "a2_to_a1": ["a2", "a1"]}
+
+def test_remove_unused_files(tmp_path):
+    manifest_dir = str(tmp_path)
+    run_manifest = {"assemblies": {"a1": {"fai": os.path.join("fai", "a1.1.fai")}}, "files": manifest.new_outputs()}
+    run_manifest["files"]["lastz_mappings"]["a1"] = [os.path.join("lastz_mappings", "a1.0.primary.cigar"), os.path.join("lastz_mappings", "a1.0.secondary.cigar")]
+    paths = [os.path.join("fai", "a1.0.fai"), os.path.join("fai", "a1.1.fai"), os.path.join("lastz_mappings", "a1.0.primary.cigar"),
+             os.path.join("lastz_mappings", "a1.0.secondary.cigar"), os.path.join("lastz_mappings", "a2.0.primary.cigar")]
+    for path in paths:
+        os.makedirs(os.path.join(manifest_dir, os.path.dirname(path)), exist_ok=True)
+        open(os.path.join(manifest_dir, path), "w").close()
+    # files outside of the output directories are left alone.
+    open(os.path.join(manifest_dir, "notes.txt"), "w").close()
+
+    manifest.write(run_manifest, manifest_dir)
+    manifest.remove_unused_files(run_manifest, manifest_dir)
+    assert sorted(path for path in paths if os.path.exists(os.path.join(manifest_dir, path))) == sorted(paths[1:4])
+    assert os.path.exists(os.path.join(manifest_dir, "notes.txt"))
+    assert manifest.load(manifest_dir) == run_manifest
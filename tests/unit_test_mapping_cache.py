@@ -0,0 +1,29 @@
+import pytest
+
+import sys
+import os
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import mapping_cache
+
+def test_store_lookup_and_evict(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    infile = str(tmp_path / "in.paf")
+    outfile = str(tmp_path / "out.paf")
+    with open(infile, "w") as outf:
+        outf.write("x" * 100)
+
+    assert not mapping_cache.lookup(cache_dir, "a", outfile)
+    mapping_cache.store(cache_dir, "a", infile, 1000)
+    mapping_cache.store(cache_dir, "b", infile, 1000)
+    os.utime(os.path.join(cache_dir, "a"), (1, 1))
+    os.utime(os.path.join(cache_dir, "b"), (2, 2))
+
+    # a hit on "a" makes "b" the least recently used file.
+    assert mapping_cache.lookup(cache_dir, "a", outfile)
+    with open(outfile) as inf:
+        assert inf.read() == "x" * 100
+    mapping_cache.store(cache_dir, "c", infile, 250)
+
+    assert sorted(os.listdir(cache_dir)) == ["a", "c", mapping_cache.STATS_FILE]
+    assert mapping_cache.get_stats(cache_dir) == {"hits": 1, "misses": 1}
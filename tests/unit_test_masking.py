@@ -0,0 +1,127 @@
+import pytest
+
+import sys
+import os
+import collections
+import gzip
+import random
+import numpy as np
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import fasta_index
+from src import masking
+
+COMPLEMENT = str.maketrans("ACGT", "TGCA")
+
+def write_fasta(path, contigs, line_length=60, compress=False):
+    with (gzip.open(path, "wt") if compress else open(path, "w")) as outf:
+        for contig_id, seq in contigs:
+            outf.write(">" + contig_id + " description\n")
+            for i in range(0, len(seq), line_length):
+                outf.write(seq[i:i + line_length] + "\n")
+
+def read_fasta(path):
+    contigs = dict()
+    with open(path) as inf:
+        for line in inf:
+            if line.startswith(">"):
+                contig = contigs[line[1:].split()[0]] = list()
+            else:
+                contig.append(line.rstrip("\n"))
+    return {contig_id: "".join(lines) for contig_id, lines in contigs.items()}
+
+def get_reference(rng, repeat, copies):
+    """
+    Random contigs with copies of repeat spread over them, on both strands.
+    """
+    contigs = list()
+    for i in range(3):
+        pieces = list()
+        for j in range(copies // 3):
+            pieces.append("".join(rng.choices("ACGT", k=rng.randrange(200, 400))))
+            pieces.append(repeat if j % 2 else repeat.translate(COMPLEMENT)[::-1])
+        contigs.append(("r" + str(i), "".join(pieces)))
+    return contigs
+
+def test_get_sketch_width():
+    assert masking.get_sketch_width(0) == masking.MIN_SKETCH_WIDTH
+    assert masking.get_sketch_width(3 * 10**9) == 2**28
+
+def test_get_count_shards():
+    index = [fasta_index.FaiEntry("c" + str(i), length, 0, 60, 61) for i, length in enumerate([50, 60, 10, 100, 5])]
+    assert masking.get_count_shards(index, 100) == [["c0", "c1"], ["c2", "c3"], ["c4"]]
+    assert masking.get_count_shards(index) == [["c0", "c1", "c2", "c3", "c4"]]
+
+def test_count_kmers(tmp_path, monkeypatch):
+    # k-mers spanning chunks are counted once.
+    monkeypatch.setattr(masking, "CHUNK_LENGTH", 1000)
+    rng = random.Random(0)
+    repeat = "".join(rng.choices("ACGT", k=100))
+    contigs = get_reference(rng, repeat, 30)
+    fasta = str(tmp_path / "ref.fa.gz")
+    write_fasta(fasta, contigs, compress=True)
+
+    k = 15
+    sketch = masking.count_kmers(fasta, 2**16, k)
+    exact = collections.Counter()
+    for contig_id, seq in contigs:
+        for i in range(len(seq) - k + 1):
+            kmer = seq[i:i + k]
+            exact[min(kmer, kmer.translate(COMPLEMENT)[::-1])] += 1
+    kmers = list(exact)
+    hashes, valid = masking.sketches.hash_sequence("N".join(kmers).encode(), k)
+    estimates = masking.get_counts(sketch, hashes[valid])
+    counts = np.array([exact[kmer] for kmer in kmers])
+    # count-min sketches only overestimate, and rarely with this few k-mers.
+    assert np.all(estimates >= counts)
+    assert np.mean(estimates == counts) > 0.95
+    assert estimates[counts == 30].min() == 30
+
+    # only the contigs of a shard.
+    shard = masking.count_kmers(fasta, 2**16, k, ["r1"])
+    assert 0 < shard.sum() < sketch.sum()
+    masking.add_sketches(shard, masking.count_kmers(fasta, 2**16, k, ["r0", "r2"]))
+    assert np.array_equal(shard, sketch)
+
+def test_add_sketches_saturates():
+    sketch = np.full((masking.SKETCH_DEPTH, 4), 200, dtype=np.uint8)
+    masking.add_sketches(sketch, np.full((masking.SKETCH_DEPTH, 4), 100, dtype=np.uint8))
+    assert np.all(sketch == masking.MAX_COUNT)
+
+def test_get_dust_mask():
+    rng = random.Random(0)
+    sequence = "".join(rng.choices("ACGT", k=300)) + "A" * 200 + "".join(rng.choices("ACGT", k=300))
+    mask = masking.get_dust_mask(masking.sketches.BASE_CODES[np.frombuffer(sequence.encode(), dtype=np.uint8)], 20)
+    assert mask[320:480].all()
+    assert not mask[:250].any() and not mask[550:].any()
+    assert not masking.get_dust_mask(masking.sketches.BASE_CODES[np.frombuffer(sequence.encode(), dtype=np.uint8)], 0).any()
+
+def test_mask_fasta(tmp_path):
+    rng = random.Random(1)
+    repeat = "".join(rng.choices("ACGT", k=150))
+    reference = get_reference(rng, repeat, 30)
+    unique = ["".join(rng.choices("ACGT", k=500)) for i in range(3)]
+    assembly = [("a1", unique[0] + repeat + unique[1] + "T" * 100 + unique[2]), ("a2", unique[1].lower())]
+    ref_file, asm_file, masked_file = str(tmp_path / "ref.fa"), str(tmp_path / "asm.fa"), str(tmp_path / "asm.masked.fa")
+    write_fasta(ref_file, reference)
+    write_fasta(asm_file, assembly, line_length=70)
+
+    k = 19
+    sketch = masking.count_kmers(ref_file, 2**16, k)
+    counts = masking.mask_fasta(asm_file, masked_file, sketch, k, 10, 20)
+
+    masked = read_fasta(masked_file)
+    a1 = assembly[0][1]
+    # k-mers overlapping the ends of the repeat can be frequent too.
+    assert masked["a1"][:500 - k] == unique[0][:500 - k]
+    assert masked["a1"][500:650] == "N" * 150
+    assert masked["a1"][650 + k:1150 - masking.DUST_WINDOW] == unique[1][k:-masking.DUST_WINDOW]
+    assert set(masked["a1"][1160:1240]) == {"N"}
+    assert masked["a1"][1250 + masking.DUST_WINDOW:] == unique[2][masking.DUST_WINDOW:]
+    assert masked["a2"] == unique[1].lower()
+    assert counts["bases"] == len(a1) + 500
+    assert 150 <= counts["repeat_bases"] <= 150 + 2 * k
+    assert counts["masked_bases"] == a1.count("N") + masked["a1"].count("N")
+    assert 80 <= counts["low_complexity_bases"] <= 150
+    # the same layout, so the same fasta index.
+    assert fasta_index.build_index(masked_file) == fasta_index.build_index(asm_file)
@@ -0,0 +1,48 @@
+import pytest
+
+import sys
+import os
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import paf_to_lastz
+
+PAF_LINES = [
+    "q1\t100\t10\t60\t+\tt1\t500\t200\t252\t48\t52\t60\tNM:i:4\tAS:i:80\ttp:A:P\tcm:i:5\tcg:Z:20M2D30M\n",
+    "q2\t100\t0\t50\t-\tt1\t500\t300\t349\t45\t50\t0\tNM:i:5\tAS:i:70\ttp:A:S\tcg:Z:10M1I39M\n",
+    "q3\t80\t5\t25\t+\tt2\t90\t30\t50\t20\t20\t3\ttp:A:I\tcg:Z:20M\n",
+    "q4\t80\t5\t25\t+\tt2\t90\t30\t50\t20\t20\t3\ttp:A:P\n",
+]
+
+def test_paf_line_to_lastz():
+    assert paf_to_lastz.paf_line_to_lastz(PAF_LINES[0]) == "cigar: q1 10 60 + t1 200 252 + 80 M 20 D 2 M 30\n"
+    # "-" strand query coordinates are written larger coord first.
+    assert paf_to_lastz.paf_line_to_lastz(PAF_LINES[1]) == "cigar: q2 50 0 - t1 300 349 + 70 M 10 I 1 M 39\n"
+    # missing AS tag gives a score of 0.
+    assert paf_to_lastz.paf_line_to_lastz(PAF_LINES[2]) == "cigar: q3 5 25 + t2 30 50 + 0 M 20\n"
+    # missing cg tag can't be converted.
+    assert paf_to_lastz.paf_line_to_lastz(PAF_LINES[3]) is None
+
+def test_split_paf_to_lastz(tmp_path):
+    paf_file = str(tmp_path / "in.paf")
+    primary_file = str(tmp_path / "primary.cigar")
+    secondary_file = str(tmp_path / "secondary.cigar")
+    with open(paf_file, "w") as outf:
+        outf.writelines(PAF_LINES)
+
+    counts = paf_to_lastz.split_paf_to_lastz(paf_file, primary_file, secondary_file)
+
+    assert counts == {"primary": 2, "secondary": 1, "skipped": 1}
+    with open(primary_file) as inf:
+        assert inf.read() == "cigar: q1 10 60 + t1 200 252 + 80 M 20 D 2 M 30\ncigar: q3 5 25 + t2 30 50 + 0 M 20\n"
+    with open(secondary_file) as inf:
+        assert inf.read() == "cigar: q2 50 0 - t1 300 349 + 70 M 10 I 1 M 39\n"
+
+def test_split_paf_lines_to_lastz(tmp_path):
+    primary_file = str(tmp_path / "primary.cigar")
+    secondary_file = str(tmp_path / "secondary.cigar")
+    # the lines are converted as they are mapped; there's no paf file to read.
+    counts = paf_to_lastz.split_paf_to_lastz(None, primary_file, secondary_file, paf_lines=iter(PAF_LINES))
+
+    assert counts == {"primary": 2, "secondary": 1, "skipped": 1}
+    with open(primary_file) as inf:
+        assert inf.read() == "cigar: q1 10 60 + t1 200 252 + 80 M 20 D 2 M 30\ncigar: q3 5 25 + t2 30 50 + 0 M 20\n"
@@ -0,0 +1,44 @@
+import pytest
+
+import sys
+import os
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import poor_mappings
+from src import segments
+
+def test_segment_name_round_trip():
+    name = segments.segment_name("chr1_renamed_0", 100, 250, 1000)
+    assert segments.parse_segment_name(name) == ("chr1_renamed_0", 100, 250, 1000)
+    assert segments.parse_segment_name("chr1") is None
+    assert segments.parse_segment_name("chr1_segment_a_b_c") is None
+
+def test_lift_paf_line():
+    line = segments.segment_name("q1", 100, 250, 1000) + "\t150\t10\t60\t-\tt1\t500\t200\t250\t50\t50\t60\tcg:Z:50M\n"
+    assert segments.lift_paf_line(line) == "q1\t1000\t110\t160\t-\tt1\t500\t200\t250\t50\t50\t60\tcg:Z:50M\n"
+    unlifted = "q1\t1000\t110\t160\t-\tt1\t500\t200\t250\t50\t50\t60\tcg:Z:50M\n"
+    assert segments.lift_paf_line(unlifted) == unlifted
+
+def test_get_aligned_query_blocks():
+    assert poor_mappings.get_aligned_query_blocks("10M5I20M", 100, 135, "+") == [(100, 110), (115, 135)]
+    assert poor_mappings.get_aligned_query_blocks("10M5I20M", 100, 135, "-") == [(125, 135), (100, 120)]
+    assert poor_mappings.get_aligned_query_blocks("10M5D20M", 100, 130, "+") == [(100, 110), (110, 130)]
+
+def test_get_poor_segments(tmp_path):
+    paf_file = str(tmp_path / "in.paf")
+    with open(paf_file, "w") as outf:
+        # good mapping with a large insertion.
+        outf.write("q1\t1000\t0\t600\t+\tt1\t500\t0\t500\t500\t600\t60\ttp:A:P\tcg:Z:200M100I300M\n")
+        # poor mapping, ignored.
+        outf.write("q1\t1000\t700\t900\t+\tt1\t500\t0\t200\t100\t200\t60\ttp:A:P\tcg:Z:200M\n")
+        outf.write("q2\t1000\t0\t1000\t+\tt1\t500\t0\t1000\t1000\t1000\t60\ttp:A:P\n")
+        # poor mapping without a cigar: identity is over the alignment block length.
+        outf.write("q3\t1000\t0\t1000\t+\tt1\t500\t0\t1000\t850\t1000\t60\ttp:A:P\n")
+
+    coverage = poor_mappings.get_query_coverage(paf_file, 0.9)
+
+    assert coverage == {"q1": [[0, 200], [300, 600]], "q2": [[0, 1000]]}
+    assert poor_mappings.get_poor_segments(coverage["q1"], 1000, 100) == [(200, 300), (600, 1000)]
+    assert poor_mappings.get_poor_segments(coverage["q1"], 1000, 101) == [(600, 1000)]
+    assert poor_mappings.get_poor_segments(coverage["q2"], 1000, 0) == []
+    assert poor_mappings.get_poor_segments(list(), 1000, 100) == [(0, 1000)]
@@ -0,0 +1,70 @@
+import pytest
+
+import sys
+import os
+from argparse import Namespace
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import resources
+from toil.fileStores import FileID
+from toil.job import Job, PromisedRequirement
+
+def get_options():
+    return Namespace(max_job_cores=8, mapping_bases_per_core=100, index_memory_factor=4.0, mapping_memory_factor=1.5,
+                     job_memory_overhead=10, disk_factor=3.0, compress_outputs=False, merge_collinear_gap=0, sort_buffer_size=100)
+
+def test_mapping_requirements():
+    options = get_options()
+    query = FileID("query", 250)
+    index = (FileID("index", 1000), "digest")
+
+    assert resources.requirements(resources.mapping_requirements, options, query, index) == \
+        {"cores": 3, "memory": 1510, "disk": 3750 + resources.DISK_OVERHEAD}
+    # cores are capped by --max_job_cores.
+    assert resources.mapping_requirements(options, FileID("query", 10**6), index)["cores"] == 8
+    # merging collinear mappings sorts them in memory.
+    options.merge_collinear_gap = 50
+    assert resources.mapping_requirements(options, query, index)["memory"] == 1710
+
+def make_paf(job):
+    return FileID("paf", 100)
+
+def test_promised_requirements():
+    options = get_options()
+    resolved = resources.requirements(resources.paf_requirements, options, FileID("paf", 100), FileID("paf", 100))
+    assert resolved["disk"] == 600 + resources.DISK_OVERHEAD
+
+    # files promised by a job that hasn't run yet defer every requirement.
+    promised = resources.requirements(resources.paf_requirements, options, FileID("paf", 100), Job.wrapJobFn(make_paf).rv())
+    assert set(promised) == {"cores", "memory", "disk"}
+    assert all(isinstance(requirement, PromisedRequirement) for requirement in promised.values())
+
+    # once promises are resolved, each requirement is calculated from them.
+    assert resources.get_requirement(resources.paf_requirements, "disk", options, FileID("paf", 100)) == 300 + resources.DISK_OVERHEAD
+
+def test_fasta_requirements():
+    options = get_options()
+    assert resources.requirements(resources.fasta_requirements, options, FileID("fasta", 100), FileID("paf", 20)) == \
+        {"cores": 1, "memory": 110, "disk": 360 + resources.DISK_OVERHEAD}
+    # a gzipped fasta holds more sequence than its size.
+    gzipped = resources.requirements(resources.fasta_requirements, options, FileID("fasta.gz", 100), FileID("paf", 20), sequence_length=400)
+    assert gzipped == {"cores": 1, "memory": 410, "disk": 1260 + resources.DISK_OVERHEAD}
+    promised = resources.requirements(resources.fasta_requirements, options, Job.wrapJobFn(make_paf).rv(), sequence_length=400)
+    assert all(isinstance(requirement, PromisedRequirement) for requirement in promised.values())
+
+def test_validation_requirements():
+    options = get_options()
+    small = resources.validation_requirements(options, [FileID("primary", 100), FileID("secondary", 100)])
+    assert small["cores"] == 1
+    assert small["memory"] == 64 * resources.cigar_validation.BATCH_BYTES + 10
+    # a core per 64 MiB, up to --max_job_cores.
+    assert resources.validation_requirements(options, [FileID("primary", 100 * 1024**2), FileID("secondary", 100 * 1024**2)])["cores"] == 4
+    assert resources.validation_requirements(options, [FileID("primary", 10**12), FileID("secondary", 0)])["cores"] == 8
+
+def test_masking_requirements():
+    options = get_options()
+    chunk_memory = 64 * resources.sketches.CHUNK_LENGTH
+    assert resources.kmer_count_requirements(options, 1000, FileID("reference", 100)) == {"cores": 1, "memory": 2000 + chunk_memory + 10,
+                                                                                         "disk": 300 + 1000 + resources.DISK_OVERHEAD}
+    # the largest contig can be most of the assembly.
+    assert resources.masking_requirements(options, 1000, FileID("assembly", 100))["memory"] == 1000 + 400 + chunk_memory + 10
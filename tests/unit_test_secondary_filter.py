@@ -0,0 +1,96 @@
+import pytest
+
+import sys
+import os
+import io
+from argparse import Namespace
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import paf_to_lastz
+from src import secondary_filter
+
+def paf_line(query, query_start, query_end, target, target_start, target_end, score, primary=False, strand="+", mapq=0, matches=None):
+    block_length = max(query_end - query_start, target_end - target_start)
+    matches = block_length if matches is None else matches
+    return "\t".join([query, "100000", str(query_start), str(query_end), strand, target, "100000", str(target_start), str(target_end),
+                      str(matches), str(block_length), str(mapq), "AS:i:" + str(score), "tp:A:" + ("P" if primary else "S"),
+                      "cg:Z:" + str(block_length) + "M"]) + "\n"
+
+def filter_lines(lines, **kwargs):
+    """
+    Returns the outputs (here the lines themselves) of the secondary mappings kept by a
+    SecondaryFilter(**kwargs).
+    """
+    mapping_filter = secondary_filter.SecondaryFilter(**kwargs)
+    kept = list()
+    for line in lines:
+        kept.extend(mapping_filter.add(line, "tp:A:P" in line, line))
+    return kept + mapping_filter.finish()
+
+def test_from_options():
+    options = Namespace(secondary_top_n=0, secondary_region_length=10000, secondary_max_containment=0,
+                        secondary_min_length=0, secondary_min_identity=0, secondary_min_mapq=0)
+    assert secondary_filter.from_options(options) is None
+    options.secondary_top_n = 2
+    assert secondary_filter.from_options(options).top_n == 2
+
+def test_top_n_per_region():
+    lines = [paf_line("q1", 0, 1000, "t1", 0, 1000, 500, primary=True),
+             paf_line("q1", 100, 600, "t2", 0, 500, 100),
+             paf_line("q1", 200, 700, "t3", 0, 500, 300),
+             paf_line("q1", 300, 800, "t4", 0, 500, 200),
+             paf_line("q1", 300, 800, "t5", 0, 500, 300),
+             # another region of the query.
+             paf_line("q1", 5000, 5500, "t2", 0, 500, 10),
+             paf_line("q2", 0, 500, "t1", 0, 500, 50)]
+    # ties are broken in favour of the first mapping; outputs are in the input order.
+    assert filter_lines(lines, top_n=2, region_length=1000) == [lines[2], lines[4], lines[5], lines[6]]
+    assert filter_lines(lines, top_n=1, region_length=10000) == [lines[2], lines[6]]
+    assert filter_lines(lines) == [line for line in lines if "tp:A:S" in line]
+
+def test_thresholds():
+    lines = [paf_line("q1", 0, 100, "t1", 0, 100, 50),
+             paf_line("q1", 0, 1000, "t1", 0, 1000, 50, matches=800),
+             paf_line("q1", 0, 1000, "t1", 0, 1000, 50, mapq=10),
+             paf_line("q1", 0, 1000, "t1", 0, 1000, 50, primary=True, matches=10)]
+    assert filter_lines(lines, min_length=500) == lines[1:3]
+    assert filter_lines(lines, min_identity=0.9) == [lines[0], lines[2]]
+    assert filter_lines(lines, min_mapq=5) == [lines[2]]
+
+def test_containment():
+    lines = [paf_line("q1", 0, 1000, "t1", 1000, 2000, 900, primary=True),
+             # contained in the primary in both query and target.
+             paf_line("q1", 100, 900, "t1", 1100, 1900, 700),
+             # same target interval, from another part of the query: a different homology.
+             paf_line("q1", 5000, 5800, "t1", 1100, 1900, 700),
+             # other strand.
+             paf_line("q1", 100, 900, "t1", 1100, 1900, 700, strand="-"),
+             # contained in the secondary before it, which scores better.
+             paf_line("q1", 5050, 5750, "t1", 1150, 1850, 600),
+             # only half contained.
+             paf_line("q1", 600, 1400, "t1", 1600, 2400, 650),
+             paf_line("q1", 100, 900, "t2", 1100, 1900, 700)]
+    assert filter_lines(lines, max_containment=0.9) == [lines[2], lines[3], lines[5], lines[6]]
+    assert filter_lines(lines, max_containment=0.4) == [lines[2], lines[3], lines[6]]
+
+def test_target_interval_index():
+    index = secondary_filter.TargetIntervalIndex()
+    mappings = [secondary_filter.PafMapping(paf_line("q", 0, 10, "t", start, end, 0), i, None)
+                for i, (start, end) in enumerate([(0, 100), (50, 60), (200, 5000), (300, 400)])]
+    for mapping in mappings:
+        index.add(mapping)
+    assert sorted(mapping.order for mapping in index.overlapping(90, 250)) == [0, 2]
+    assert sorted(mapping.order for mapping in index.overlapping(4000, 4001)) == [2]
+    assert list(index.overlapping(5000, 6000)) == []
+
+def test_write_lastz_lines_with_filter():
+    lines = [paf_line("q1", 0, 1000, "t1", 0, 1000, 500, primary=True),
+             paf_line("q1", 100, 600, "t2", 0, 500, 100),
+             paf_line("q1", 200, 700, "t3", 0, 500, 300),
+             paf_line("q2", 0, 500, "t1", 0, 500, 50, primary=True)]
+    primaryf = io.StringIO()
+    secondaryf = io.StringIO()
+    counts = paf_to_lastz.write_lastz_lines(lines, primaryf, secondaryf, secondary_filter=secondary_filter.SecondaryFilter(top_n=1))
+    assert counts == {"primary": 2, "secondary": 1, "skipped": 0, "filtered": 1}
+    assert primaryf.getvalue() == paf_to_lastz.paf_line_to_lastz(lines[0]) + paf_to_lastz.paf_line_to_lastz(lines[3])
+    assert secondaryf.getvalue() == paf_to_lastz.paf_line_to_lastz(lines[2])
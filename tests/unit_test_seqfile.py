@@ -0,0 +1,55 @@
+import pytest
+
+import sys
+import os
+import importlib.util
+from argparse import Namespace
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+def load_aligner():
+    spec = importlib.util.spec_from_file_location("reference_based_cactus_aligner",
+                                                  os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "reference-based-cactus-aligner.py"))
+    aligner = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(aligner)
+    return aligner
+
+def write_seqfile(path, entries):
+    with open(path, "w") as outf:
+        outf.write("(ref,a1);\n")
+        for asm, asm_file in entries:
+            outf.write(asm + " " + asm_file + "\n")
+
+def test_get_asms_from_seqfile(tmp_path):
+    aligner = load_aligner()
+    for asm in ["ref", "a1"]:
+        with open(str(tmp_path / (asm + ".fa")), "w") as outf:
+            outf.write(">c1\nACGT\n")
+    seqfile = str(tmp_path / "seqfile")
+    write_seqfile(seqfile, [("ref", str(tmp_path / "ref.fa")), ("*a1", str(tmp_path / "a1.fa"))])
+    assert aligner.get_asms_from_seqfile(seqfile) == {"ref": str(tmp_path / "ref.fa"), "a1": str(tmp_path / "a1.fa")}
+
+def test_get_asms_from_seqfile_problems(tmp_path):
+    aligner = load_aligner()
+    with open(str(tmp_path / "ref.fa"), "w") as outf:
+        outf.write(">c1\nACGT\n")
+    open(str(tmp_path / "empty.fa"), "w").close()
+    seqfile = str(tmp_path / "seqfile")
+    write_seqfile(seqfile, [("ref", str(tmp_path / "ref.fa")), ("a1", str(tmp_path / "empty.fa")),
+                            ("a2", str(tmp_path / "missing.fa")), ("*ref", str(tmp_path / "ref.fa"))])
+
+    # every problem is reported at once.
+    with pytest.raises(ValueError) as error:
+        aligner.get_asms_from_seqfile(seqfile)
+    message = str(error.value)
+    assert "ref is used more than once" in message
+    assert "a1" in message and "is empty" in message
+    assert "a2" in message and "doesn't exist" in message
+
+def test_import_files_keeps_order():
+    aligner = load_aligner()
+    class Workflow:
+        def importFile(self, url, symlink=True):
+            return (url, symlink)
+    paths = ["/data/asm" + str(i) + ".fa" for i in range(20)]
+    assert aligner.import_files(Workflow(), paths, Namespace(import_threads=4), symlink=False) == [("file://" + path, False) for path in paths]
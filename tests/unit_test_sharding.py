@@ -0,0 +1,87 @@
+import pytest
+
+import sys
+import os
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import sharding
+from src import segments
+from Bio import SeqIO
+
+def test_get_windows():
+    assert sharding.get_windows("c", 100, 0, 10) == [("c", 0, 100)]
+    assert sharding.get_windows("c", 100, 100, 10) == [("c", 0, 100)]
+    windows = sharding.get_windows("c", 100, 40, 10)
+    assert [(start, end) for record_id, start, end in windows] == [(0, 40), (30, 70), (60, 100)]
+    assert segments.parse_segment_name(windows[1][0]) == ("c", 30, 70, 100)
+
+def test_shard_fasta(tmp_path):
+    fasta = str(tmp_path / "in.fa")
+    with open(fasta, "w") as outf:
+        outf.write(">a\n" + "A" * 30 + "\n>b\n" + "C" * 10 + "\n>c\n" + "G" * 100 + "\n")
+
+    shard_count = iter(range(100))
+    shards, window_cores = sharding.shard_fasta(fasta, lambda: str(tmp_path / ("shard_" + str(next(shard_count)))), 35, 50, 10)
+
+    shard_records = [[(record.id, len(record)) for record in SeqIO.parse(shard, "fasta")] for shard in shards]
+    assert shard_records == [[("a", 30), ("b", 10)],
+                             [(segments.segment_name("c", 0, 50, 100), 50)],
+                             [(segments.segment_name("c", 40, 90, 100), 50)],
+                             [(segments.segment_name("c", 80, 100, 100), 20)]]
+    # the cores split the contig at the middle of the overlaps; unwindowed contigs have none.
+    assert window_cores == {segments.segment_name("c", 0, 50, 100): (0, 45), segments.segment_name("c", 40, 90, 100): (45, 85),
+                            segments.segment_name("c", 80, 100, 100): (85, 100)}
+
+def test_merge_shard_mappings(tmp_path):
+    first_window = segments.segment_name("c", 0, 50, 100)
+    second_window = segments.segment_name("c", 40, 90, 100)
+    window_cores = sharding.get_window_cores(sharding.get_windows("c", 100, 50, 10), 100)
+    shard_files = [str(tmp_path / "shard_0.paf"), str(tmp_path / "shard_1.paf")]
+    with open(shard_files[0], "w") as outf:
+        outf.write("a\t30\t0\t30\t+\tt\t500\t0\t30\t30\t30\t60\ttp:A:P\tcg:Z:30M\n")
+        # an alignment crossing the overlap, cut at the end of the window.
+        outf.write(first_window + "\t50\t0\t50\t+\tt\t500\t100\t150\t50\t50\t60\ttp:A:P\tcg:Z:50M\n")
+        outf.write(first_window + "\t50\t42\t48\t+\tt\t500\t142\t148\t6\t6\t60\ttp:A:S\tcg:Z:6M\n")
+    with open(shard_files[1], "w") as outf:
+        # contained in the first window's mapping after lifting.
+        outf.write(second_window + "\t50\t2\t8\t+\tt\t500\t142\t148\t6\t6\t60\ttp:A:P\tcg:Z:6M\n")
+        # the same alignment, cut at the start of the window.
+        outf.write(second_window + "\t50\t0\t50\t+\tt\t500\t140\t190\t50\t50\t60\ttp:A:P\tcg:Z:50M\n")
+
+    merged = str(tmp_path / "merged.paf")
+    assert sharding.merge_shard_mappings(shard_files, merged, window_cores) == 2
+    with open(merged) as inf:
+        lines = inf.readlines()
+    assert lines == ["a\t30\t0\t30\t+\tt\t500\t0\t30\t30\t30\t60\ttp:A:P\tcg:Z:30M\n",
+                     "c\t100\t0\t45\t+\tt\t500\t100\t145\t45\t45\t60\ttp:A:P\tcg:Z:45M\n",
+                     "c\t100\t45\t85\t+\tt\t500\t145\t185\t40\t40\t60\ttp:A:P\tcg:Z:40M\n"]
+    # every base of the overlap of the windows is aligned once.
+    coverage = [0] * 100
+    for line in lines[1:]:
+        parsed = line.split("\t")
+        for i in range(int(parsed[2]), int(parsed[3])):
+            coverage[i] += 1
+    assert coverage[40:50] == [1] * 10
+
+def test_clip_paf_line():
+    line = "q\t100\t0\t100\t+\tt\t2000\t1000\t1102\t90\t102\t60\tNM:i:12\tAS:i:80\ttp:A:P\tcg:Z:40M2D20M5I35M\n"
+    assert sharding.clip_paf_line(line, 0, 100) == line
+    assert sharding.clip_paf_line(line, 0, 50) == "q\t100\t0\t50\t+\tt\t2000\t1000\t1052\t46\t52\t60\tNM:i:6\tAS:i:41\ttp:A:P\tcg:Z:40M2D10M\n"
+    # - strand cigars walk the query backwards.
+    line = "q\t100\t0\t100\t-\tt\t2000\t1000\t1100\t110\t110\t60\ttp:A:P\tcg:Z:30M10D30M10I30M\n"
+    assert sharding.clip_paf_line(line, 60, 100) == "q\t100\t60\t100\t-\tt\t2000\t1000\t1050\t50\t50\t60\ttp:A:P\tcg:Z:30M10D10M\n"
+    # clipped mappings start and end with aligned bases.
+    line = "q\t100\t0\t25\t+\tt\t2000\t0\t20\t20\t25\t60\ttp:A:P\tcg:Z:10M5I10M\n"
+    assert sharding.clip_paf_line(line, 12, 100) == "q\t100\t15\t25\t+\tt\t2000\t10\t20\t8\t10\t60\ttp:A:P\tcg:Z:10M\n"
+    assert sharding.clip_paf_line(line, 11, 14) is None
+    # without a cigar, the middle of the mapping decides.
+    line = "q\t100\t0\t40\t+\tt\t2000\t0\t40\t40\t40\t60\n"
+    assert sharding.clip_paf_line(line, 0, 25) == line
+    assert sharding.clip_paf_line(line, 25, 100) is None
+
+def test_remove_contained_mappings():
+    # of identical mappings, the primary one is kept.
+    assert sharding.remove_contained_mappings([(0, 10, 0, 10, False, "s"), (0, 10, 0, 10, True, "p")]) == [(0, 10, 0, 10, True, "p")]
+    # a primary mapping isn't discarded for a secondary mapping containing it.
+    mappings = [(0, 20, 0, 20, False, "s"), (5, 10, 5, 10, True, "p"), (12, 15, 12, 15, False, "s2")]
+    assert sharding.remove_contained_mappings(mappings) == mappings[:2]
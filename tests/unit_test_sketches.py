@@ -0,0 +1,91 @@
+import pytest
+
+import sys
+import os
+import random
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import sketches
+
+def write_fasta(path, contigs):
+    with open(path, "w") as outf:
+        for contig_id, seq in contigs:
+            outf.write(">" + contig_id + "\n")
+            for i in range(0, len(seq), 60):
+                outf.write(seq[i:i + 60] + "\n")
+
+def reverse_complement(seq):
+    return seq[::-1].translate(str.maketrans("ACGT", "TGCA"))
+
+def random_seq(rng, length):
+    return "".join(rng.choices("ACGT", k=length))
+
+def test_sketch_sequence_canonical_kmers():
+    rng = random.Random(0)
+    seq = random_seq(rng, 5000)
+    sketch = sketches.sketch_sequence(seq.encode(), 21, 1)
+    # with scale 1 every k-mer is kept; a sequence and its reverse complement have the same canonical k-mers.
+    assert len(set(sketch.tolist())) == len(set(seq[i:i + 21] for i in range(len(seq) - 20)))
+    assert sorted(sketch.tolist()) == sorted(sketches.sketch_sequence(reverse_complement(seq).encode(), 21, 1).tolist())
+    # lower case bases are the same k-mers.
+    assert sketch.tolist() == sketches.sketch_sequence(seq.lower().encode(), 21, 1).tolist()
+
+def test_sketch_sequence_skips_n():
+    assert len(sketches.sketch_sequence(b"ACGTACGTNACGTACGT", 5, 1)) == 8
+    assert len(sketches.sketch_sequence(b"ACG", 5, 1)) == 0
+
+def test_sketch_fasta(tmp_path, monkeypatch):
+    rng = random.Random(1)
+    contigs = [("c1", random_seq(rng, 3000)), ("c2", random_seq(rng, 1000)), ("empty", "")]
+    fasta = str(tmp_path / "asm.fa")
+    write_fasta(fasta, contigs)
+
+    expected = set()
+    for contig_id, seq in contigs:
+        expected.update(sketches.sketch_sequence(seq.encode(), 15, 4).tolist())
+    sketch = sketches.sketch_fasta(fasta, 15, 4)
+    assert sketch.tolist() == sorted(expected)
+
+    # k-mers spanning the chunks contigs are read in are sketched too.
+    monkeypatch.setattr(sketches, "CHUNK_LENGTH", 100)
+    assert sketches.sketch_fasta(fasta, 15, 4).tolist() == sketch.tolist()
+
+    sketch_file = str(tmp_path / "asm.sketch")
+    sketches.write_sketch(sketch, sketch_file)
+    assert sketches.read_sketch(sketch_file).tolist() == sketch.tolist()
+
+    with pytest.raises(ValueError):
+        sketches.sketch_fasta(fasta, 33)
+
+def test_containment():
+    rng = random.Random(2)
+    shared = random_seq(rng, 20000)
+    query = sketches.sketch_sequence((shared + random_seq(rng, 20000)).encode(), 21, 10)
+    target = sketches.sketch_sequence((random_seq(rng, 50000) + shared).encode(), 21, 10)
+    unrelated = sketches.sketch_sequence(random_seq(rng, 50000).encode(), 21, 10)
+    assert sketches.containment(query, target) == pytest.approx(0.5, abs=0.1)
+    assert sketches.containment(query, unrelated) == 0
+    assert sketches.containment(sketches.sketch_sequence(b"", 21, 10), target) is None
+
+def test_choose_partners():
+    containments = {"a": 0.1, "b": 0.5, "c": 0.001, "d": 0.3}
+    assert sketches.choose_partners(containments, 2, 0.01) == ["b", "d"]
+    assert sketches.choose_partners(containments, 10, 0.01) == ["a", "b", "d"]
+    assert sketches.choose_partners(containments, 10, 0) == ["a", "b", "c", "d"]
+    # without an estimate no partner can be ruled out.
+    assert sketches.choose_partners({"a": None, "b": None}, 1, 0.01) == ["a", "b"]
+
+def test_choose_remap_partners(tmp_path):
+    rng = random.Random(3)
+    seqs = {asm: random_seq(rng, 20000) for asm in ["a1", "a2", "a3"]}
+    # a1's poorly mapped segments are from a3.
+    segment_files = {"a1": str(tmp_path / "a1.segments.fa")}
+    write_fasta(segment_files["a1"], [("a1_seg", seqs["a3"][5000:10000])])
+    sketch_files = dict()
+    for asm, seq in seqs.items():
+        sketch_files[asm] = str(tmp_path / (asm + ".sketch"))
+        sketches.write_sketch(sketches.sketch_sequence(seq.encode(), 21, 10), sketch_files[asm])
+
+    assert sketches.choose_remap_partners(segment_files, sketch_files, 1, 0.01, 21, 10) == {"a1": ["a3"]}
+    assert sketches.choose_remap_partners(segment_files, sketch_files, 2, 0.01, 21, 10) == {"a1": ["a3"]}
+    assert sketches.choose_remap_partners(segment_files, sketch_files, 2, 0, 21, 10) == {"a1": ["a2", "a3"]}
@@ -0,0 +1,80 @@
+import pytest
+
+import sys
+import os
+import gzip
+import random
+# insert at 1, 0 is the script path (or '' in REPL)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from src import sorted_output
+
+def get_lastz_lines(count, seed=0):
+    rng = random.Random(seed)
+    lines = list()
+    for i in range(count):
+        start = rng.randrange(100000)
+        length = rng.randrange(1, 5000)
+        lines.append(" ".join(["cigar:", "q" + str(i), "0", str(length), "+", rng.choice(["chr1", "chr2", "chr10", "ctg/1"]),
+                               str(start), str(start + length), "+", "100", "M", str(length)]) + "\n")
+    return lines
+
+def write_lines(path, lines, compress=False):
+    with (gzip.open(path, "wt") if compress else open(path, "w")) as outf:
+        outf.writelines(lines)
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_sort_lastz_file(tmp_path, monkeypatch, compress):
+    lines = get_lastz_lines(1000)
+    infile = str(tmp_path / "in.cigar")
+    write_lines(infile, lines, compress)
+    # many small runs, merged in several passes.
+    monkeypatch.setattr(sorted_output, "MAX_MERGE_RUNS", 3)
+    outfile = str(tmp_path / "sorted.cigar")
+    sorted_output.sort_lastz_file(infile, outfile, 2000, str(tmp_path))
+    with open(outfile) as inf:
+        assert inf.readlines() == sorted(lines, key=sorted_output.get_sort_key)
+    # only the output is left.
+    assert sorted(os.listdir(str(tmp_path))) == ["in.cigar", "sorted.cigar"]
+
+def test_sort_empty_file(tmp_path):
+    infile = str(tmp_path / "in.cigar")
+    write_lines(infile, [])
+    sorted_output.sort_lastz_file(infile, str(tmp_path / "sorted.cigar"), 2000)
+    assert os.path.getsize(str(tmp_path / "sorted.cigar")) == 0
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_write_split(tmp_path, compress):
+    lines = get_lastz_lines(300)
+    infile = str(tmp_path / "in.cigar")
+    write_lines(infile, lines)
+    out_dir = str(tmp_path / "out")
+    names = sorted_output.write_sorted_output(infile, out_dir, "split", 1000, 1000, compress, str(tmp_path))
+    assert names[-1] == sorted_output.CONTIGS_FILE
+
+    with open(os.path.join(out_dir, sorted_output.CONTIGS_FILE)) as inf:
+        contig_files = [line.rstrip("\n").split("\t") for line in inf]
+    assert [contig for contig, name, count in contig_files] == ["chr1", "chr10", "chr2", "ctg/1"]
+    for contig, name, count in contig_files:
+        with (gzip.open if compress else open)(os.path.join(out_dir, name), "rt") as inf:
+            contig_lines = inf.readlines()
+        assert contig_lines == sorted([line for line in lines if line.split()[5] == contig], key=sorted_output.get_sort_key)
+        assert len(contig_lines) == int(count)
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_write_indexed_and_fetch(tmp_path, compress):
+    lines = get_lastz_lines(500)
+    infile = str(tmp_path / "in.cigar")
+    write_lines(infile, lines)
+    outfile = str(tmp_path / "out.cigar")
+    assert sorted_output.write_sorted_output(infile, outfile, "indexed", 1000, 10000, compress) == [outfile, outfile + sorted_output.INDEX_SUFFIX]
+
+    with (gzip.open if compress else open)(outfile, "rt") as inf:
+        assert inf.readlines() == sorted(lines, key=sorted_output.get_sort_key)
+
+    index = sorted_output.read_index(outfile + sorted_output.INDEX_SUFFIX)
+    assert sorted(index) == ["chr1", "chr10", "chr2", "ctg/1"]
+    assert all(block_start % 10000 == 0 for blocks in index.values() for block_start, offset, length, max_end in blocks)
+    for contig, start, end in [("chr1", 0, None), ("chr2", 25000, 25001), ("chr10", 50000, 70000), ("ctg/1", 99999, 200000), ("chrX", 0, 10)]:
+        expected = [line for line in sorted(lines, key=sorted_output.get_sort_key) if line.split()[5] == contig
+                    and int(line.split()[7]) > start and (end is None or int(line.split()[6]) < end)]
+        assert list(sorted_output.fetch(outfile, index, contig, start, end)) == expected